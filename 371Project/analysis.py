@@ -0,0 +1,130 @@
+"""
+Text analysis: document text -> index terms.
+
+An Analyzer is a chain of generator stages, so a document is scanned once
+and never materialized as a whole-document token list:
+
+    chunks -> lowercase (+ Unicode folding) -> regex tokenizer
+           -> stop-word filter -> stemmer
+
+Text is handled chunk_size characters at a time. A word cut by a chunk
+boundary is carried over into the next chunk, so a multi-GB file can be
+indexed in flat memory (see boolean_model.add_file). Token positions are
+counted before stop words are dropped, as positional postings expect.
+
+Queries must be analyzed like the documents were: boolean_model applies
+its analyzer to query terms and phrases as well, and storage.py saves the
+analyzer's settings with the index.
+"""
+
+import functools
+import re
+import unicodedata
+from array import array
+from itertools import filterfalse
+
+TOKEN_PATTERN = re.compile(r'\b[a-z]+\b')
+TRAILING_WORD = re.compile(r'\w*\Z')  # May continue in the next chunk
+CHUNK_SIZE = 1 << 20  # Characters
+STOP_WORDS = frozenset({'a', 'an', 'the', 'in', 'is', 'it', 'that', 'they',
+                        'can', 'be', 'will', 'but', 'such', 'also', 'have',
+                        'if', 'at', 'to', 'as'})
+
+
+def fold(text):
+    """Strip accents and compatibility forms (NFKD without combining marks)"""
+    if text.isascii():
+        return text
+    return ''.join(char for char in unicodedata.normalize('NFKD', text)
+                   if not unicodedata.combining(char))
+
+
+def s_stem(term):
+    """Harman's S stemmer: conflates regular English plurals"""
+    if term.endswith('ies') and not term.endswith(('eies', 'aies')):
+        return term[:-3] + 'y'
+    if term.endswith('es') and not term.endswith(('aes', 'ees', 'oes')):
+        return term[:-1]
+    if term.endswith('s') and not term.endswith(('us', 'ss')):
+        return term[:-1]
+    return term
+
+
+def read_chunks(file, chunk_size=CHUNK_SIZE):
+    """Yield a text file's contents chunk_size characters at a time"""
+    return iter(functools.partial(file.read, chunk_size), '')
+
+
+class Analyzer:
+    """
+    Tokenizer with a stop-word filter and optional folding and stemming.
+    Immutable and picklable, so worker processes can share it.
+    """
+    def __init__(self, stop_words=STOP_WORDS, fold=False, stem=False, chunk_size=CHUNK_SIZE):
+        self.stop_words = frozenset(stop_words)
+        self.fold = fold
+        self.stem = stem
+        self.chunk_size = chunk_size
+
+    def config(self):
+        """Settings saved with an index (see storage.py)"""
+        return {'stop_words': sorted(self.stop_words), 'fold': self.fold, 'stem': self.stem}
+
+    def _prepare(self, chunk):
+        chunk = chunk.lower()
+        return fold(chunk) if self.fold else chunk
+
+    def tokens(self, text):
+        """Yield every token of a document in order, stop words included"""
+        size = self.chunk_size
+        findall = TOKEN_PATTERN.findall  # At most one chunk's tokens at a time
+        if isinstance(text, str):
+            if len(text) <= size:
+                yield from findall(self._prepare(text))
+                return
+            chunks = (text[start:start + size] for start in range(0, len(text), size))
+        else:
+            chunks = read_chunks(text, size)
+
+        carry = ''
+        for chunk in chunks:
+            chunk = carry + self._prepare(chunk)
+            cut = TRAILING_WORD.search(chunk).start()
+            carry = chunk[cut:]
+            yield from findall(chunk, 0, cut)
+        yield from findall(carry)
+
+    def filter(self, tokens):
+        """Drop stop words from a token stream and stem the rest"""
+        terms = filterfalse(self.stop_words.__contains__, tokens)
+        return map(s_stem, terms) if self.stem else terms
+
+    def terms(self, text):
+        """Yield the indexed terms of a document in order (with repeats)"""
+        return self.filter(self.tokens(text))
+
+    def analyze(self, text):
+        """Yield (term, position) for the indexed terms of a document"""
+        stop_words = self.stop_words
+        stem = self.stem
+        for position, token in enumerate(self.tokens(text)):
+            if token not in stop_words:
+                yield (s_stem(token) if stem else token), position
+
+    def term_positions(self, text):
+        """term -> array of its token positions in a document"""
+        positions = {}
+        for term, position in self.analyze(text):
+            if term in positions:
+                positions[term].append(position)
+            else:
+                positions[term] = array('I', [position])
+        return positions
+
+    def query_term(self, term, wildcard=False):
+        """A lowercase query term as the documents' terms were analyzed"""
+        if self.fold:
+            term = fold(term)
+        if self.stem and not wildcard and term not in self.stop_words:
+            term = s_stem(term)
+        return term
@@ -0,0 +1,557 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the 2-3 tree inverted index
+
+    benchmark.py zipf [--docs 1000 100000 ...] [--json results.json]
+        Synthetic Zipfian corpora: ingest throughput, memory, latency
+        percentiles for every query shape, and a brute-force oracle check
+    benchmark.py insert
+        Micro-benchmark of single-pass upsert against the original
+        recursive search-then-update/insert path
+
+Corpora are reproducible: document i is generated from (seed, i) alone,
+so the oracle regenerates documents one at a time instead of keeping the
+corpus in memory. The exit status is 1 if any result disagrees with the
+oracle, so runs can gate regression tracking.
+"""
+
+import argparse
+import itertools
+import json
+import platform
+import random
+import re
+import sys
+import time
+import tracemalloc
+
+from analysis import STOP_WORDS
+from query import parse_query
+from postings import PostingList
+from tree23 import Node23, Tree23InvertedIndex, boolean_model, WILDCARD_CHARS
+
+
+class TwoWalkIndex(Tree23InvertedIndex):
+    """
+    Reference index with the original insert path: a recursive search,
+    then a second recursive walk that updates the posting list or inserts
+    and splits. Posting lists are the current PostingList, so only the
+    tree walks differ.
+    """
+    def insert(self, term, doc_id):
+        if self._search_recursive(self.root, term):
+            self._update_posting_list(self.root, term, doc_id)
+        else:
+            result = self._insert_recursive(self.root, term, PostingList([doc_id]))
+            if result is not None:  # Root split
+                new_root = Node23()
+                new_root.keys = [result[1]]
+                new_root.posting_lists = [result[3]]
+                new_root.children = [result[0], result[2]]
+                self.root = new_root
+
+    def _search_recursive(self, node, term):
+        for i, key in enumerate(node.keys):
+            if term == key:
+                return node.posting_lists[i]
+        if node.is_leaf():
+            return []
+        return self._search_recursive(node.children[self._child_index(node, term)], term)
+
+    def _update_posting_list(self, node, term, doc_id):
+        for i, key in enumerate(node.keys):
+            if term == key:
+                node.posting_lists[i].add(doc_id)
+                return True
+        if not node.is_leaf():
+            return self._update_posting_list(node.children[self._child_index(node, term)],
+                                             term, doc_id)
+
+    def _insert_recursive(self, node, term, posting_list):
+        """Insert below node; returns (left, middle key, right, middle posting) on a split"""
+        if node.is_leaf():
+            if not node.is_full():
+                node.insert_in_node(term, posting_list)
+                return None
+            return self._split_recursive(node, term, posting_list, None)
+
+        child_idx = self._child_index(node, term)
+        result = self._insert_recursive(node.children[child_idx], term, posting_list)
+        if result is None:
+            return None
+        if not node.is_full():
+            node.insert_in_node(result[1], result[3])
+            node.children[child_idx] = result[0]
+            node.children.insert(child_idx + 1, result[2])
+            return None
+        return self._split_recursive(node, result[1], result[3], result)
+
+    def _split_recursive(self, node, new_key, new_posting, split_result):
+        temp_keys = node.keys + [new_key]
+        temp_postings = node.posting_lists + [new_posting]
+        temp_children = node.children[:]
+        if split_result:
+            for i, key in enumerate(temp_keys[:-1]):
+                if new_key < key or i == len(temp_keys) - 2:
+                    idx = i if new_key < key else i + 1
+                    temp_children[idx] = split_result[0]
+                    temp_children.insert(idx + 1, split_result[2])
+                    break
+
+        order = sorted(range(3), key=temp_keys.__getitem__)
+        temp_keys = [temp_keys[i] for i in order]
+        temp_postings = [temp_postings[i] for i in order]
+
+        left = Node23()
+        left.keys = [temp_keys[0]]
+        left.posting_lists = [temp_postings[0]]
+        right = Node23()
+        right.keys = [temp_keys[2]]
+        right.posting_lists = [temp_postings[2]]
+        if temp_children:
+            left.children = temp_children[:2]
+            right.children = temp_children[2:]
+        return (left, temp_keys[1], right, temp_postings[1])
+
+
+def make_documents(num_docs=2000, vocab_size=5000, doc_length=60, seed=42):
+    """Generate random documents over a synthetic vocabulary"""
+    rng = random.Random(seed)
+    vocab = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 10)))
+             for _ in range(vocab_size)]
+    return [(i, ' '.join(rng.choice(vocab) for _ in range(doc_length)))
+            for i in range(num_docs)]
+
+
+def time_ingest(index_class, documents, repeat=3):
+    """Best-of-N time to insert every document's terms one at a time (analysis excluded)"""
+    analyzer = index_class().analyzer
+    analyzed = [(doc_id, set(analyzer.terms(text))) for doc_id, text in documents]
+    best = float('inf')
+    for _ in range(repeat):
+        index = index_class()
+        start = time.perf_counter()
+        for doc_id, terms in analyzed:
+            index.add_terms(doc_id, terms)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_insert():
+    """Compare single-pass upsert against the original two-walk recursive insert"""
+    documents = make_documents()
+    single = time_ingest(Tree23InvertedIndex, documents)
+    double = time_ingest(TwoWalkIndex, documents)
+    per_doc = 1e6 / len(documents)
+    print("=== INCREMENTAL INSERT ===")
+    print(f"two-walk recursive: {double * per_doc:8.1f} us/doc")
+    print(f"single-pass upsert: {single * per_doc:8.1f} us/doc")
+    print(f"speedup:            {double / single:8.2f}x")
+
+
+# Zipfian corpora
+
+class ZipfCorpus:
+    """
+    Synthetic corpus whose word frequencies follow Zipf's law: the word of
+    rank r occurs with probability proportional to 1 / r^exponent. The stop
+    words take the top ranks, and shorter words rank higher, as in English.
+    """
+    def __init__(self, num_docs, vocab_size=50000, doc_length=100, exponent=1.0, seed=42):
+        self.num_docs = num_docs
+        self.doc_length = doc_length
+        self.seed = seed
+        rng = random.Random(seed)
+        words = set()
+        while len(words) < vocab_size:
+            word = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz')
+                           for _ in range(rng.randint(2, 12)))
+            if word not in STOP_WORDS:
+                words.add(word)
+        self.content_words = sorted(words, key=lambda word: (len(word), word))
+        self.vocabulary = sorted(STOP_WORDS) + self.content_words  # By rank
+        self.cum_weights = list(itertools.accumulate(
+            1 / rank ** exponent for rank in range(1, len(self.vocabulary) + 1)))
+
+    def __len__(self):
+        return self.num_docs
+
+    def doc_id(self, i):
+        return f"doc{i}"
+
+    def words(self, i):
+        """Word list of document i"""
+        rng = random.Random(self.seed * 1000003 + i)
+        length = rng.randint(self.doc_length // 2, self.doc_length * 3 // 2)
+        return rng.choices(self.vocabulary, cum_weights=self.cum_weights, k=length)
+
+    def document(self, i):
+        return ' '.join(self.words(i))
+
+    def batches(self, size):
+        """Yield lists of (doc_id, text) and their total word count"""
+        for start in range(0, self.num_docs, size):
+            batch, tokens = [], 0
+            for i in range(start, min(start + size, self.num_docs)):
+                words = self.words(i)
+                tokens += len(words)
+                batch.append((self.doc_id(i), ' '.join(words)))
+            yield batch, tokens
+
+
+# Query shapes: each generator returns one query string for the corpus
+
+def _word(corpus, rng):
+    """Half Zipf-sampled (frequent) words, half uniform over the vocabulary (mostly rare)"""
+    if rng.random() < 0.5:
+        return rng.choice(corpus.content_words)
+    while True:
+        word = rng.choices(corpus.vocabulary, cum_weights=corpus.cum_weights)[0]
+        if word not in STOP_WORDS:
+            return word
+
+
+def _long_word(corpus, rng, length=4):
+    while True:
+        word = _word(corpus, rng)
+        if len(word) >= length:
+            return word
+
+
+def _window(corpus, rng, size):
+    """size consecutive words from a random document, so phrases can match"""
+    while True:
+        words = corpus.words(rng.randrange(len(corpus)))
+        if len(words) < size:
+            continue
+        start = rng.randrange(len(words) - size + 1)
+        window = words[start:start + size]
+        if any(word not in STOP_WORDS for word in window):
+            return window
+
+
+def _near(corpus, rng):
+    window = _window(corpus, rng, rng.randint(2, 5))
+    content = [word for word in window if word not in STOP_WORDS]
+    if len(content) < 2:
+        content.append(_word(corpus, rng))
+    return f"{content[0]} NEAR/{rng.randint(1, 4)} {content[-1]}"
+
+
+def _single_char(corpus, rng):
+    word = _long_word(corpus, rng)
+    i = rng.randrange(len(word))
+    return word[:i] + '?' + word[i + 1:]
+
+
+QUERY_SHAPES = {
+    'term': _word,
+    'and': lambda c, r: f"{_word(c, r)} AND {_word(c, r)}",
+    'or': lambda c, r: f"{_word(c, r)} OR {_word(c, r)}",
+    'not': lambda c, r: f"NOT {_word(c, r)}",
+    'and_not': lambda c, r: f"{_word(c, r)} AND NOT {_word(c, r)}",
+    'or_not': lambda c, r: f"{_word(c, r)} OR NOT {_word(c, r)}",
+    'xor': lambda c, r: f"{_word(c, r)} XOR {_word(c, r)}",
+    'nested': lambda c, r: (f"({_word(c, r)} OR {_word(c, r)}) AND "
+                            f"({_word(c, r)} OR {_word(c, r)}) AND NOT {_word(c, r)}"),
+    'prefix': lambda c, r: _long_word(c, r)[:3] + '*',
+    'suffix': lambda c, r: '*' + _long_word(c, r)[-3:],
+    'infix': lambda c, r: (lambda word: f"{word[:2]}*{word[-2:]}")(_long_word(c, r)),
+    'single_char': _single_char,
+    'multi_wildcard': lambda c, r: (lambda word: f"*{word[1]}*{word[-2:]}*")(_long_word(c, r)),
+    'wildcard_and': lambda c, r: f"{_long_word(c, r)[:3]}* AND {_word(c, r)}",
+    'phrase': lambda c, r: '"' + ' '.join(_window(c, r, r.randint(2, 4))) + '"',
+    'near': _near,
+}
+POSITIONAL_SHAPES = {'phrase', 'near'}
+
+
+def make_queries(corpus, shapes, per_shape, seed):
+    """shape -> list of distinct query strings"""
+    rng = random.Random(seed)
+    queries = {}
+    for shape in shapes:
+        found = []
+        for _ in range(per_shape * 20):
+            query = QUERY_SHAPES[shape](corpus, rng)
+            if query not in found:
+                found.append(query)
+            if len(found) == per_shape:
+                break
+        queries[shape] = found
+    return queries
+
+
+# Brute-force oracle: evaluates a query AST against one document's
+# term positions, independently of the index
+
+def _pattern_regex(pattern):
+    return re.compile(''.join('.*' if char == '*' else '.' if char == '?' else re.escape(char)
+                              for char in pattern) + r'\Z')
+
+
+def _oracle_positions(node, analyzer):
+    """Function of a document's term positions -> sorted (start, length) spans of a NEAR operand"""
+    if node[0] == 'phrase':
+        terms = list(analyzer.analyze(node[1]))
+        if not terms:
+            return lambda positions: []
+        first = terms[0][1]
+        length = terms[-1][1] - first + 1
+
+        def spans(positions):
+            if any(term not in positions for term, _ in terms):
+                return []
+            sets = [(set(positions[term]), offset - first) for term, offset in terms]
+            return [(start, length) for start in positions[terms[0][0]]
+                    if all(start + offset in members for members, offset in sets)]
+        return spans
+
+    term = node[1]
+    if WILDCARD_CHARS.search(term):
+        regex = _pattern_regex(term)
+        return lambda positions: sorted((position, 1) for word, offsets in positions.items()
+                                        if regex.match(word) for position in offsets)
+    return lambda positions: [(position, 1) for position in positions.get(term, ())]
+
+
+def oracle_predicate(node, analyzer):
+    """Compile a query AST into a predicate over a document's term positions"""
+    kind = node[0]
+    if kind == 'term':
+        term = node[1]
+        if WILDCARD_CHARS.search(term):
+            regex = _pattern_regex(term)
+            return lambda positions: any(regex.match(word) for word in positions)
+        return lambda positions: term in positions
+    if kind == 'phrase':
+        spans = _oracle_positions(node, analyzer)
+        return lambda positions: bool(spans(positions))
+    if kind == 'near':
+        left, right = (_oracle_positions(operand, analyzer) for operand in node[1])
+        distance = node[2]
+
+        def near(positions):
+            return any((b - (a + length_a - 1) if a <= b else a - (b + length_b - 1)) <= distance
+                       for a, length_a in left(positions) for b, length_b in right(positions))
+        return near
+    if kind == 'not':
+        inner = oracle_predicate(node[1], analyzer)
+        return lambda positions: not inner(positions)
+    children = [oracle_predicate(child, analyzer) for child in node[1]]
+    if kind == 'and':
+        return lambda positions: all(child(positions) for child in children)
+    if kind == 'or':
+        return lambda positions: any(child(positions) for child in children)
+    left, right = children
+    return lambda positions: left(positions) != right(positions)
+
+
+def check_oracle(model, corpus, queries):
+    """Compare boolean_query with a full scan of the regenerated corpus; returns mismatches"""
+    analyzer = model.analyzer
+    predicates = [oracle_predicate(parse_query(query), analyzer) for query in queries]
+    expected = [[] for _ in queries]
+    for i in range(len(corpus)):
+        positions = analyzer.term_positions(corpus.document(i))
+        for predicate, matches in zip(predicates, expected):
+            if predicate(positions):
+                matches.append(corpus.doc_id(i))
+    mismatches = []
+    for query, matches in zip(queries, expected):
+        model.cache.clear()
+        actual = model.boolean_query(query)
+        if actual != matches:
+            expected_set, actual_set = set(matches), set(actual)
+            mismatches.append({'query': query, 'expected': len(matches), 'actual': len(actual),
+                               'missing': [doc for doc in matches if doc not in actual_set][:5],
+                               'extra': [doc for doc in actual if doc not in expected_set][:5]})
+    return mismatches
+
+
+# Measurements
+
+def build_model(args):
+    return boolean_model(compact_permuterms=args.compact_permuterms, segment_docs=args.segment_docs,
+                         ranked=args.ranked, positional=args.positional, doc_store=args.doc_store)
+
+
+def ingest(model, corpus, args):
+    """Index the corpus; returns (seconds spent in the index, words indexed)"""
+    seconds, tokens = 0.0, 0
+    for batch, batch_tokens in corpus.batches(args.batch):
+        start = time.perf_counter()
+        if args.ingest == 'bulk':
+            model.add_documents(batch)
+        elif args.ingest == 'parallel':
+            model.add_documents_parallel(batch, args.processes)
+        else:
+            for doc_id, text in batch:
+                model.add_document(doc_id, text)
+        seconds += time.perf_counter() - start
+        tokens += batch_tokens
+    return seconds, tokens
+
+
+def measure_memory(corpus, args):
+    """tracemalloc bytes held by a freshly built model, and the peak while building it"""
+    tracemalloc.start()
+    try:
+        model = build_model(args)
+        ingest(model, corpus, args)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'index_bytes': current, 'peak_bytes': peak,
+            'bytes_per_doc': current / len(corpus)}
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def measure_latency(model, queries, repeat):
+    """Per-shape latency percentiles (ms) of uncached boolean_query calls"""
+    # Warm-up: lazily built structures (e.g. the sorted permuterms) aren't query latency
+    for shape_queries in queries.values():
+        model.boolean_query(shape_queries[0])
+    latencies = {}
+    for shape, shape_queries in queries.items():
+        samples, results = [], []
+        for query in shape_queries:
+            for _ in range(repeat):
+                model.cache.clear()
+                start = time.perf_counter()
+                result = model.boolean_query(query)
+                samples.append((time.perf_counter() - start) * 1000)
+            results.append(len(result))
+        samples.sort()
+        latencies[shape] = {
+            'queries': len(shape_queries), 'samples': len(samples),
+            'p50_ms': percentile(samples, 0.50), 'p90_ms': percentile(samples, 0.90),
+            'p99_ms': percentile(samples, 0.99), 'max_ms': samples[-1],
+            'mean_ms': sum(samples) / len(samples),
+            'mean_results': sum(results) / len(results),
+            'example': shape_queries[0],
+        }
+    return latencies
+
+
+def bench_zipf(args, num_docs):
+    """One corpus size: ingest, memory, latency and oracle results"""
+    corpus = ZipfCorpus(num_docs, args.vocab, args.doc_length, args.zipf, args.seed)
+    shapes = [shape for shape in args.shapes
+              if args.positional or shape not in POSITIONAL_SHAPES]
+    queries = make_queries(corpus, shapes, args.queries, args.seed + 1)
+
+    model = build_model(args)
+    seconds, tokens = ingest(model, corpus, args)
+    report = {
+        'docs': num_docs,
+        'ingest': {'mode': args.ingest, 'seconds': seconds, 'tokens': tokens,
+                   'docs_per_s': num_docs / seconds, 'tokens_per_s': tokens / seconds},
+        'index': model.stats(),
+        'latency': measure_latency(model, queries, args.repeat),
+    }
+    if args.memory:
+        report['memory'] = measure_memory(corpus, args)
+    if args.check and num_docs <= args.oracle_limit:
+        checked = [query for shape_queries in queries.values()
+                   for query in shape_queries[:args.check]]
+        mismatches = check_oracle(model, corpus, checked)
+        report['oracle'] = {'queries': len(checked), 'mismatches': mismatches}
+    else:
+        report['oracle'] = {'skipped': True}
+    return report
+
+
+def print_report(report):
+    ingest = report['ingest']
+    index = report['index']
+    print(f"=== ZIPF CORPUS: {report['docs']} docs ===")
+    print(f"ingest ({ingest['mode']}): {ingest['seconds']:.2f} s, "
+          f"{ingest['docs_per_s']:,.0f} docs/s, {ingest['tokens_per_s']:,.0f} tokens/s")
+    print(f"vocabulary: {index['inverted_index']['terms']:,} terms, "
+          f"{index['inverted_index']['postings']:,} postings")
+    if 'memory' in report:
+        memory = report['memory']
+        print(f"memory: {memory['index_bytes'] / 2**20:.1f} MiB held, "
+              f"{memory['peak_bytes'] / 2**20:.1f} MiB peak, "
+              f"{memory['bytes_per_doc']:.0f} B/doc")
+    print(f"{'shape':<16}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}{'results':>10}")
+    for shape, latency in report['latency'].items():
+        print(f"{shape:<16}{latency['p50_ms']:>10.3f}{latency['p90_ms']:>10.3f}"
+              f"{latency['p99_ms']:>10.3f}{latency['max_ms']:>10.3f}{latency['mean_results']:>10.0f}")
+    oracle = report['oracle']
+    if oracle.get('skipped'):
+        print("oracle: skipped")
+    else:
+        print(f"oracle: {oracle['queries']} queries, {len(oracle['mismatches'])} mismatches")
+        for mismatch in oracle['mismatches']:
+            print(f"  MISMATCH {mismatch['query']!r}: expected {mismatch['expected']}, "
+                  f"got {mismatch['actual']}")
+    print()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for the 2-3 tree inverted index")
+    parser.add_argument('suite', nargs='?', choices=['zipf', 'insert'], default='zipf')
+    parser.add_argument('--docs', type=int, nargs='+', default=[1000, 10000],
+                        help="corpus sizes to run")
+    parser.add_argument('--vocab', type=int, default=50000)
+    parser.add_argument('--doc-length', type=int, default=100, help="mean words per document")
+    parser.add_argument('--zipf', type=float, default=1.0, help="Zipf exponent")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--ingest', choices=['bulk', 'incremental', 'parallel'], default='bulk')
+    parser.add_argument('--batch', type=int, default=10000, help="documents per ingest batch")
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--segment-docs', type=int, default=None)
+    parser.add_argument('--compact-permuterms', action='store_true')
+    parser.add_argument('--ranked', action='store_true')
+    parser.add_argument('--no-positions', dest='positional', action='store_false',
+                        help="skip positional data (and phrase/NEAR queries)")
+    parser.add_argument('--doc-store', default='none', choices=['none', 'memory', 'compressed'])
+    parser.add_argument('--shapes', nargs='+', choices=list(QUERY_SHAPES), default=list(QUERY_SHAPES))
+    parser.add_argument('--queries', type=int, default=20, help="distinct queries per shape")
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs per query")
+    parser.add_argument('--check', type=int, default=5,
+                        help="queries per shape checked against the oracle (0 disables)")
+    parser.add_argument('--oracle-limit', type=int, default=100000,
+                        help="largest corpus the oracle scans")
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help="skip the tracemalloc ingest pass")
+    parser.add_argument('--json', metavar='PATH', help="write results as JSON ('-' for stdout)")
+    args = parser.parse_args(argv)
+
+    if args.suite == 'insert':
+        bench_insert()
+        return 0
+
+    reports = []
+    for num_docs in args.docs:
+        report = bench_zipf(args, num_docs)
+        reports.append(report)
+        if args.json != '-':
+            print_report(report)
+
+    if args.json:
+        output = {
+            'benchmark': 'zipf',
+            'created': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'config': {key: value for key, value in vars(args).items() if key != 'json'},
+            'runs': reports,
+        }
+        if args.json == '-':
+            json.dump(output, sys.stdout, indent=2)
+            print()
+        else:
+            with open(args.json, 'w') as f:
+                json.dump(output, f, indent=2)
+    failed = any(report['oracle'].get('mismatches') for report in reports)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
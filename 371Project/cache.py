@@ -0,0 +1,110 @@
+import sys
+import threading
+from array import array
+from collections import OrderedDict
+
+
+def sizeof(value):
+    """Approximate deep size of a cached value in bytes"""
+    size = sys.getsizeof(value)
+    if isinstance(value, (str, bytes, bytearray, array, int, range)):
+        return size
+    if isinstance(value, dict):
+        return size + sum(sizeof(k) + sizeof(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        if not value:
+            return size
+        first = next(iter(value))
+        if isinstance(first, int):
+            # Lists of ordinals: don't walk every element
+            return size + len(value) * sys.getsizeof(first)
+        return size + sum(sizeof(item) for item in value)
+    if hasattr(value, '__dict__'):
+        return size + sizeof(vars(value))
+    return size
+
+
+class LRUCache:
+    """
+    Least-recently-used cache bounded by an approximate memory budget.
+    Keys are (namespace, key) tuples; hit/miss counters are kept per
+    namespace. Entries carry tags so that callers can drop exactly the
+    entries that depend on something that changed. Safe to share between
+    threads.
+    """
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.entries = OrderedDict()  # key -> (value, size, tags)
+        self.tag_index = {}  # tag -> set of keys
+        self.counters = {}  # namespace -> [hits, misses]
+        self.lock = threading.RLock()
+
+    def get(self, key, default=None):
+        """Return the cached value (marking it recently used) or default"""
+        with self.lock:
+            counter = self.counters.setdefault(key[0], [0, 0])
+            entry = self.entries.get(key)
+            if entry is None:
+                counter[1] += 1
+                return default
+            counter[0] += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, tags=()):
+        """Cache a value, evicting least-recently-used entries over budget"""
+        size = sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            self.discard(key)
+            tags = frozenset(tags)
+            self.entries[key] = (value, size, tags)
+            self.bytes += size
+            for tag in tags:
+                self.tag_index.setdefault(tag, set()).add(key)
+            while self.bytes > self.max_bytes:
+                self.discard(next(iter(self.entries)))
+
+    def discard(self, key):
+        """Drop one entry if present"""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return
+            self.bytes -= entry[1]
+            for tag in entry[2]:
+                keys = self.tag_index[tag]
+                keys.discard(key)
+                if not keys:
+                    del self.tag_index[tag]
+
+    def invalidate(self, tags):
+        """Drop every entry carrying any of the tags"""
+        with self.lock:
+            for tag in tags:
+                for key in list(self.tag_index.get(tag, ())):
+                    self.discard(key)
+
+    def tags(self):
+        """All tags currently in use"""
+        with self.lock:
+            return list(self.tag_index)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tag_index.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """Hit/miss counters per namespace plus memory use"""
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'namespaces': {namespace: {'hits': hits, 'misses': misses}
+                               for namespace, (hits, misses) in self.counters.items()},
+            }
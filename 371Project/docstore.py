@@ -0,0 +1,279 @@
+"""
+Document stores: where boolean_model keeps the raw text of its documents.
+
+Queries never read document text; it is only fetched, one document at a
+time, when a caller wants to display hits (boolean_model.get_document and
+fetch_documents) or remove a document. The store is chosen per model:
+
+    'memory'      MemoryStore, a plain dict (the default)
+    'none'        NullStore, keeps nothing; only doc ids are known
+    'compressed'  CompressedStore, zlib-compressed blocks in memory
+    DiskStore(path)
+                  append-only file plus an in-memory offset index
+
+All stores support store[doc_id] = text, get, pop, in and len, plus
+compact() to reclaim the space of removed documents and nbytes().
+"""
+
+import os
+import struct
+import sys
+import threading
+import zlib
+
+RECORD_HEADER = struct.Struct('<II')  # Doc id length, text length
+DELETED = 0xFFFFFFFF  # Text length of a removal record
+
+
+class MemoryStore(dict):
+    """Document text in a dict"""
+    def nbytes(self):
+        return sum(map(sys.getsizeof, self.values()))
+
+    def compact(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class NullStore:
+    """Keeps no text: removals fall back to coarser cache invalidation"""
+    def __setitem__(self, doc_id, text):
+        pass
+
+    def get(self, doc_id, default=None):
+        return default
+
+    def pop(self, doc_id, default=None):
+        return default
+
+    def __contains__(self, doc_id):
+        return False
+
+    def __len__(self):
+        return 0
+
+    def nbytes(self):
+        return 0
+
+    def compact(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class CompressedStore:
+    """
+    Documents packed into blocks of about block_size bytes, each compressed
+    with zlib once full. Reading a document decompresses its block; the
+    last block read is kept, so fetching a page of hits added together
+    decompresses each block once.
+    """
+    def __init__(self, block_size=64 * 1024, level=6):
+        self.block_size = block_size
+        self.level = level
+        self.blocks = []  # Compressed, full blocks
+        self.open_block = bytearray()  # Block being filled, uncompressed
+        self.locations = {}  # doc_id -> (block number, start, end)
+        self.dead_bytes = 0  # Text of removed documents still in blocks
+        self._cached = (None, b'')  # (block number, decompressed block)
+        self._lock = threading.Lock()  # Readers may run alongside the writer
+
+    def __setitem__(self, doc_id, text):
+        data = text.encode('utf-8')
+        with self._lock:
+            if doc_id in self.locations:
+                self._forget(doc_id)
+            start = len(self.open_block)
+            self.open_block += data
+            self.locations[doc_id] = (len(self.blocks), start, start + len(data))
+            if len(self.open_block) >= self.block_size:
+                self.blocks.append(zlib.compress(bytes(self.open_block), self.level))
+                self.open_block = bytearray()
+
+    def _forget(self, doc_id):
+        _, start, end = self.locations.pop(doc_id)
+        self.dead_bytes += end - start
+
+    def _read(self, location):
+        block, start, end = location
+        if block == len(self.blocks):
+            return self.open_block[start:end].decode('utf-8')
+        cached_block, data = self._cached
+        if cached_block != block:
+            data = zlib.decompress(self.blocks[block])
+            self._cached = (block, data)
+        return data[start:end].decode('utf-8')
+
+    def get(self, doc_id, default=None):
+        with self._lock:
+            location = self.locations.get(doc_id)
+            return default if location is None else self._read(location)
+
+    def pop(self, doc_id, default=None):
+        with self._lock:
+            location = self.locations.get(doc_id)
+            if location is None:
+                return default
+            text = self._read(location)
+            self._forget(doc_id)
+            return text
+
+    def __contains__(self, doc_id):
+        return doc_id in self.locations
+
+    def __len__(self):
+        return len(self.locations)
+
+    def nbytes(self):
+        """Bytes used by the stored text"""
+        return sum(map(len, self.blocks)) + len(self.open_block)
+
+    def compact(self):
+        """Repack the live documents, dropping removed ones"""
+        if not self.dead_bytes:
+            return
+        packed = CompressedStore(self.block_size, self.level)
+        with self._lock:
+            for doc_id, location in self.locations.items():
+                packed[doc_id] = self._read(location)
+            self.blocks, self.open_block = packed.blocks, packed.open_block
+            self.locations, self.dead_bytes = packed.locations, 0
+            self._cached = (None, b'')
+
+    def close(self):
+        pass
+
+
+class DiskStore:
+    """
+    Append-only file of (doc id, text) records with an in-memory offset
+    index. Removals append a removal record; compact() rewrites the file
+    with the live documents only. Reopening a file rebuilds the index, so
+    the store survives restarts (doc ids come back as strings).
+
+    Record: RECORD_HEADER (id length, text length or DELETED), id, text.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.locations = {}  # doc_id -> (offset, length) of its text
+        self.dead_bytes = 0
+        self._lock = threading.Lock()
+        self._open()
+
+    def _open(self):
+        self.file = open(self.path, 'a+b')
+        self.reader = open(self.path, 'rb')
+        self.end = self._scan()
+
+    def _scan(self):
+        """Rebuild the offset index; returns the end of the last complete record"""
+        reader, offset = self.reader, 0
+        size = os.fstat(reader.fileno()).st_size
+        while True:
+            reader.seek(offset)
+            header = reader.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            id_length, length = RECORD_HEADER.unpack(header)
+            doc_id = reader.read(id_length)
+            text_offset = offset + RECORD_HEADER.size + id_length
+            end = text_offset + (0 if length == DELETED else length)
+            if len(doc_id) < id_length or end > size:
+                break
+            doc_id = doc_id.decode('utf-8')
+            if doc_id in self.locations:
+                self.dead_bytes += self.locations.pop(doc_id)[1]
+            if length != DELETED:
+                self.locations[doc_id] = (text_offset, length)
+            offset = end
+        # Drop a record cut short by a crash
+        self.file.truncate(offset)
+        return offset
+
+    def _append(self, doc_id, data, length):
+        key = str(doc_id).encode('utf-8')
+        record = RECORD_HEADER.pack(len(key), length) + key + data
+        self.file.write(record)
+        self.file.flush()
+        text_offset = self.end + RECORD_HEADER.size + len(key)
+        self.end += len(record)
+        return text_offset
+
+    def __setitem__(self, doc_id, text):
+        data = text.encode('utf-8')
+        with self._lock:
+            if doc_id in self.locations:
+                self.dead_bytes += self.locations[doc_id][1]
+            self.locations[doc_id] = (self._append(doc_id, data, len(data)), len(data))
+
+    def _read(self, location):
+        offset, length = location
+        self.reader.seek(offset)
+        return self.reader.read(length).decode('utf-8')
+
+    def get(self, doc_id, default=None):
+        with self._lock:
+            location = self.locations.get(doc_id)
+            return default if location is None else self._read(location)
+
+    def pop(self, doc_id, default=None):
+        with self._lock:
+            location = self.locations.pop(doc_id, None)
+            if location is None:
+                return default
+            self._append(doc_id, b'', DELETED)
+            self.dead_bytes += location[1]
+            return self._read(location)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.locations
+
+    def __len__(self):
+        return len(self.locations)
+
+    def nbytes(self):
+        """Size of the file"""
+        return self.end
+
+    def compact(self):
+        """Rewrite the file without removed and replaced documents"""
+        if not self.dead_bytes:
+            return
+        with self._lock:
+            temp_path = self.path + '.compact'
+            locations = {}
+            with open(temp_path, 'wb') as out:
+                for doc_id, location in self.locations.items():
+                    self.reader.seek(location[0])
+                    data = self.reader.read(location[1])
+                    key = str(doc_id).encode('utf-8')
+                    offset = out.tell() + RECORD_HEADER.size + len(key)
+                    out.write(RECORD_HEADER.pack(len(key), len(data)) + key + data)
+                    locations[doc_id] = (offset, len(data))
+            self.file.close()
+            self.reader.close()
+            os.replace(temp_path, self.path)
+            self.file = open(self.path, 'a+b')
+            self.reader = open(self.path, 'rb')
+            self.end = os.path.getsize(self.path)
+            self.locations, self.dead_bytes = locations, 0
+
+    def close(self):
+        self.file.close()
+        self.reader.close()
+
+
+def make_store(store):
+    """A document store from a boolean_model doc_store argument"""
+    if store is None or store == 'memory':
+        return MemoryStore()
+    if store == 'none':
+        return NullStore()
+    if store == 'compressed':
+        return CompressedStore()
+    if isinstance(store, str):
+        raise ValueError(f"Unknown document store {store!r}")
+    return store
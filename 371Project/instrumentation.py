@@ -0,0 +1,162 @@
+"""
+Index statistics helpers and per-query tracing.
+
+stats() on the indexes and on boolean_model reports sizes, shapes and
+approximate bytes per structure; distribution() summarizes a list of
+lengths for them.
+
+Tracing is off unless a hook is registered with
+boolean_model.add_trace_hook. Each boolean_query, query_page or
+ranked_query call then runs on a shallow copy of the model whose phase
+methods are wrapped with timers (the untraced path is untouched), and
+every hook receives the finished QueryTrace:
+
+    parse       parsing the query (cache misses only)
+    expand      wildcard expansion
+    fetch       exact-term posting list lookups
+    positions   phrase and NEAR position matching
+    merge       everything else: set operations, result mapping, scoring
+
+Phase times are exclusive (a phrase's posting lookups count as fetch,
+not positions), so they sum to the total. Counters include tree_nodes
+(dictionary nodes visited by lookups), query_nodes (AST nodes evaluated;
+0 when the result came from the cache), terms_fetched (exact terms and
+wildcard expansions) and postings_fetched.
+"""
+
+import copy
+import json
+import time
+from collections import Counter
+from time import perf_counter
+
+PHASES = ('parse', 'expand', 'fetch', 'positions', 'merge')
+
+
+def distribution(lengths):
+    """Summary of a list of lengths: extremes, percentiles, power-of-two histogram"""
+    if not len(lengths):
+        return {'count': 0}
+    lengths = sorted(lengths)
+    n = len(lengths)
+    histogram = Counter(length.bit_length() for length in lengths)
+    return {
+        'count': n,
+        'min': lengths[0],
+        'max': lengths[-1],
+        'mean': sum(lengths) / n,
+        'p50': lengths[n // 2],
+        'p90': lengths[min(n - 1, n * 9 // 10)],
+        'p99': lengths[min(n - 1, n * 99 // 100)],
+        # Bucket "4-7" holds lengths 4..7
+        'histogram': {(f"{1 << bits - 1}-{(1 << bits) - 1}" if bits > 1 else str(bits)): count
+                      for bits, count in sorted(histogram.items())},
+    }
+
+
+def array_bytes(values):
+    """Payload bytes of an array or memoryview"""
+    return len(values) * values.itemsize
+
+
+class QueryTrace:
+    """Timings and counters for one query"""
+    def __init__(self, query, method='boolean_query'):
+        self.query = query
+        self.method = method
+        self.started = time.time()
+        self.timings = dict.fromkeys(PHASES, 0.0)  # Seconds, exclusive
+        self.counters = Counter()
+        self.results = None
+        self.error = None
+        self._stack = []  # Open phases, innermost last
+        self._mark = None
+
+    def _switch(self, push=None):
+        """Charge the time since the last switch to the innermost phase"""
+        now = perf_counter()
+        if self._stack:
+            self.timings[self._stack[-1]] += now - self._mark
+        if push is None:
+            self._stack.pop()
+        else:
+            self._stack.append(push)
+        self._mark = now
+
+    def timed(self, phase, function, counter=None):
+        """
+        Wrap function so its calls are timed under phase. With counter,
+        the length of each result is added to that counter.
+        """
+        def call(*args, **kwargs):
+            self._switch(phase)
+            try:
+                result = function(*args, **kwargs)
+            finally:
+                self._switch()
+            if counter is not None:
+                self.counters[counter] += len(result)
+            return result
+        return call
+
+    def counted(self, counter, function):
+        """Wrap function to count its calls"""
+        def call(*args, **kwargs):
+            self.counters[counter] += 1
+            return function(*args, **kwargs)
+        return call
+
+    def run(self, function, *args):
+        """Call function under the merge phase and record its result size"""
+        self._switch('merge')
+        try:
+            result = function(*args)
+        except Exception as error:
+            self.error = str(error)
+            raise
+        finally:
+            self._switch()
+        # counted_page returns (total, page)
+        self.results = result[0] if isinstance(result, tuple) else len(result)
+        return result
+
+    @property
+    def total(self):
+        return sum(self.timings.values())
+
+    def to_dict(self):
+        return {
+            'query': self.query,
+            'method': self.method,
+            'started': self.started,
+            'total_ms': self.total * 1000,
+            'phases_ms': {phase: seconds * 1000 for phase, seconds in self.timings.items()},
+            'counters': dict(self.counters),
+            'results': self.results,
+            'error': self.error,
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+
+def instrument(model, trace):
+    """Shallow copy of a boolean_model whose query phases report to trace"""
+    view = copy.copy(model)
+    view._trace = trace
+    view._parse = trace.timed('parse', view._parse)
+    view._expand_wildcard = trace.timed('expand', view._expand_wildcard)
+    view._term_postings = trace.timed('fetch', view._term_postings, 'postings_fetched')
+    view._term_postings = trace.counted('terms_fetched', view._term_postings)
+    view._phrase_postings = trace.timed('positions', view._phrase_postings)
+    view._near_postings = trace.timed('positions', view._near_postings)
+    view._evaluate = trace.counted('query_nodes', view._evaluate)
+    return view
+
+
+def json_lines_hook(file, min_ms=0.0):
+    """Trace hook writing each trace as a JSON line; with min_ms, only slow queries"""
+    def hook(trace):
+        if trace.total * 1000 >= min_ms:
+            file.write(trace.to_json() + "\n")
+    return hook
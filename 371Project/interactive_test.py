@@ -84,7 +84,7 @@ def interactive_mode():
     doc2 = """If a small magnet is brought near a superconductor, 
               it will be repelled."""
     
-    bm = boolean_model()
+    bm = boolean_model(positional=True)
     bm.add_document("Doc1", doc1)
     bm.add_document("Doc2", doc2)
     
@@ -102,6 +102,9 @@ def interactive_mode():
                 print("   magnet AND superconductor")
                 print("   temperatures OR field")
                 print("   super* AND magnet")
+                print("   (magnet OR field) AND NOT small")
+                print('   "magnetic field"')
+                print("   magnet NEAR/5 superconductor")
                 continue
             elif not query:
                 continue
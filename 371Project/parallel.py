@@ -0,0 +1,80 @@
+"""
+Parallel corpus indexing.
+
+Documents are split into shards of consecutive ordinals. Each worker
+process analyzes its shard into a segment (a sorted term -> doc ids
+dictionary), and the segments are k-way merged into the 2-3 tree. Because
+shards cover increasing ordinal ranges, merging posting lists is plain
+concatenation, except for re-added doc ids, whose old ordinals are
+merged in.
+"""
+
+import os
+from array import array
+from multiprocessing import Pool
+
+from postings import insert_sorted
+
+
+def index_shard(args):
+    """
+    Worker: build one segment from (ordinals, texts, analyzer, keep_positions).
+    Returns the segment and, with keep_positions, each document's term positions.
+    """
+    ordinals, texts, analyzer, keep_positions = args
+    postings = {}  # term -> sorted, unique doc ids
+    documents = [] if keep_positions else None
+    last = -1  # Highest ordinal so far: a higher one can append to every run
+    for ordinal, text in zip(ordinals, texts):
+        if keep_positions:
+            terms = analyzer.term_positions(text)
+            documents.append(terms)
+        else:
+            terms = set(analyzer.terms(text))
+        # Re-added doc ids keep their old, lower ordinal
+        add = array.append if ordinal > last else insert_sorted
+        last = max(last, ordinal)
+        for term in terms:
+            if term in postings:
+                add(postings[term], ordinal)
+            else:
+                postings[term] = array('I', [ordinal])
+    return sorted(postings.items()), documents
+
+
+def add_documents_parallel(model, documents, processes=None, shard_size=None):
+    """Index (doc_id, text) pairs into a boolean_model across a process pool"""
+    if isinstance(documents, dict):
+        documents = documents.items()
+    documents = list(documents)
+    if not documents:
+        return
+    model._ensure_writable()
+    processes = processes or os.cpu_count() or 1
+    # Several shards per worker keeps the pool busy when shards are uneven
+    shard_size = shard_size or max(1, -(-len(documents) // (processes * 4)))
+
+    analyzer = model.analyzer
+    keep_positions = model.ranked or model.positional
+    shards = []
+    for start in range(0, len(documents), shard_size):
+        shard = documents[start:start + shard_size]
+        for doc_id, text in shard:
+            model.documents[doc_id] = text
+        # Re-added doc ids keep their old ordinal
+        ordinals = [model._assign_ordinal(doc_id) for doc_id, _ in shard]
+        shards.append((ordinals, [text for _, text in shard], analyzer, keep_positions))
+
+    with Pool(processes) as pool:
+        results = pool.map(index_shard, shards)
+    segments = [segment for segment, _ in results]
+
+    if model.ranked or model.positional:
+        for (ordinals, _, _, _), (_, documents) in zip(shards, results):
+            for ordinal, positions in zip(ordinals, documents):
+                model._record_document(ordinal, positions)
+    model.inverted_index.merge_segments(segments)
+    terms = set()
+    for segment in segments:
+        terms.update(term for term, _ in segment)
+    model._add_terms(terms)
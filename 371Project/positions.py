@@ -0,0 +1,165 @@
+"""
+Positional postings for phrase and proximity queries.
+
+A term's positions across all documents are one bytearray of entries in
+increasing document order:
+
+    varint(doc - previous doc)  varint(count)  count x varint(position delta)
+
+Positions are token offsets in the document, counted before stop words
+are dropped, so "held in a levitated position" still knows that "held"
+and "levitated" are three tokens apart. Phrase and NEAR queries decode
+the entries of a few terms in step over a sorted list of candidate
+documents (a merge join on documents), then join the position lists.
+"""
+
+from postings import intersect
+
+
+def encode_varint(value, out):
+    """Append value to out as a little-endian base-128 varint"""
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varint(data, pos):
+    """(value, next position) of the varint at data[pos]"""
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+class PositionalPostings:
+    """Encoded positions of one term, document by document"""
+    def __init__(self):
+        self.data = bytearray()
+        self.last_doc = -1
+
+    def add(self, doc, positions):
+        """Record a document's sorted positions; O(1) amortized for new documents"""
+        if doc > self.last_doc:
+            self._append(self.data, doc - self.last_doc, positions)
+            self.last_doc = doc
+            return
+        # Re-added document: merge into its entry and re-encode
+        entries = dict(self)
+        entries[doc] = sorted(set(entries.get(doc, ())) | set(positions))
+        self._rebuild(sorted(entries.items()))
+
+    def copy(self):
+        """Writable copy (of a memory-mapped one, see storage.py)"""
+        copy = PositionalPostings()
+        copy.data, copy.last_doc = bytearray(self.data), self.last_doc
+        return copy
+
+    def _append(self, data, doc_delta, positions):
+        encode_varint(doc_delta, data)
+        encode_varint(len(positions), data)
+        previous = 0
+        for position in positions:
+            encode_varint(position - previous, data)
+            previous = position
+
+    def _rebuild(self, entries):
+        # A new buffer, so readers still decoding the old one are unaffected
+        data, last_doc = bytearray(), -1
+        for doc, positions in entries:
+            self._append(data, doc - last_doc, positions)
+            last_doc = doc
+        self.data, self.last_doc = data, last_doc
+
+    def __iter__(self):
+        """(doc, positions) for every document"""
+        data = self.data
+        pos, doc, end = 0, -1, len(data)
+        while pos < end:
+            delta, pos = decode_varint(data, pos)
+            doc += delta
+            positions, pos = self._decode_positions(data, pos)
+            yield doc, positions
+
+    def _decode_positions(self, data, pos):
+        count, pos = decode_varint(data, pos)
+        positions, position = [], 0
+        for _ in range(count):
+            delta, pos = decode_varint(data, pos)
+            position += delta
+            positions.append(position)
+        return positions, pos
+
+    def positions_for(self, docs):
+        """
+        Positions in each of the sorted docs ([] where the term is absent).
+        Stops decoding after the last requested document.
+        """
+        data = self.data
+        pos, doc, end = 0, -1, len(data)
+        for target in docs:
+            positions = []
+            while pos < end:
+                delta, entry = decode_varint(data, pos)
+                if doc + delta > target:
+                    break
+                doc += delta
+                if doc == target:
+                    positions, pos = self._decode_positions(data, entry)
+                    break
+                # Skip this document's positions without building them
+                count, pos = decode_varint(data, entry)
+                for _ in range(count):
+                    while data[pos] >= 0x80:
+                        pos += 1
+                    pos += 1
+            yield positions
+
+    def renumber(self, tombstones):
+        """Copy without the sorted tombstoned docs, renumbered densely"""
+        copy = PositionalPostings()
+        j, n = 0, len(tombstones)
+        entries = []
+        for doc, positions in self:
+            while j < n and tombstones[j] < doc:
+                j += 1
+            if j < n and tombstones[j] == doc:
+                continue
+            entries.append((doc - j, positions))
+        copy._rebuild(entries)
+        return copy
+
+
+def phrase_starts(position_lists, offsets):
+    """Start positions where every term i occurs at start + offsets[i]"""
+    starts = [position - offsets[0] for position in position_lists[0]]
+    for positions, offset in zip(position_lists[1:], offsets[1:]):
+        if not starts:
+            break
+        starts = intersect(starts, [position - offset for position in positions])
+    return starts
+
+
+def within(starts1, length1, starts2, length2, distance):
+    """
+    True if some span of length1 starting in starts1 and some span of
+    length2 starting in starts2 are at most distance tokens apart (either
+    order). Both start lists are sorted; a two-pointer walk checks only
+    neighbouring pairs.
+    """
+    i = j = 0
+    while i < len(starts1) and j < len(starts2):
+        a, b = starts1[i], starts2[j]
+        if a <= b:
+            if b - (a + length1 - 1) <= distance:
+                return True
+            i += 1
+        else:
+            if a - (b + length2 - 1) <= distance:
+                return True
+            j += 1
+    return False
@@ -0,0 +1,565 @@
+from array import array
+from bisect import bisect_left
+import heapq
+import operator
+import sys
+from itertools import islice
+
+# A posting list switches to a bitmap once it holds at least
+# DENSE_MIN_LENGTH docs and covers 1 in DENSE_RATIO of the ordinals seen
+# so far (an array entry costs 32 bits, a dense bitmap ~1 bit per ordinal)
+DENSE_MIN_LENGTH = 4096
+DENSE_RATIO = 32
+
+
+class PostingList:
+    """Sorted, deduplicated document ordinals stored in a compact array"""
+    def __init__(self, ordinals=()):
+        self.ids = array('I', ordinals)  # Must be sorted and unique
+        self.bitmap = None  # RoaringBitmap replacing ids for dense terms
+
+    def add(self, ordinal):
+        """
+        Add a document ordinal, keeping the list sorted.
+        O(1) when ordinals arrive in increasing order (the ingestion case).
+        Returns True if the ordinal was new.
+        """
+        if self.bitmap is not None:
+            return self.bitmap.add(ordinal)
+
+        ids = self.ids
+        if not ids or ordinal > ids[-1]:
+            ids.append(ordinal)
+            n = len(ids)
+            # Re-check density each time the list doubles
+            if n >= DENSE_MIN_LENGTH and not n & (n - 1) and n * DENSE_RATIO > ordinal:
+                self._make_dense()
+            return True
+        if ordinal == ids[-1]:
+            return False
+
+        # Out-of-order insert
+        i = bisect_left(ids, ordinal)
+        if ids[i] == ordinal:
+            return False
+        ids.insert(i, ordinal)
+        return True
+
+    def extend(self, ordinals):
+        """
+        Add ordinals, in one bulk append when they are strictly increasing
+        and follow the current last; anything else goes through add()
+        """
+        trusted = isinstance(ordinals, PostingList)  # Sorted and unique already
+        if trusted:
+            ordinals = ordinals.postings()
+        ids = self.ids
+        if (self.bitmap is None and not isinstance(ordinals, RoaringBitmap)
+                and len(ordinals) and (not ids or ordinals[0] > ids[-1])
+                and (trusted or strictly_increasing(ordinals))):
+            ids.extend(ordinals)
+            if len(ids) >= DENSE_MIN_LENGTH and len(ids) * DENSE_RATIO > ids[-1]:
+                self._make_dense()
+            return
+        for ordinal in ordinals:
+            self.add(ordinal)
+
+    def _make_dense(self):
+        """Switch to the bitmap representation"""
+        self.bitmap = RoaringBitmap.from_sorted(self.ids)
+        self.ids = None
+
+    def postings(self):
+        """The underlying sorted array, or the bitmap for dense terms"""
+        # _make_dense sets bitmap before clearing ids, so a concurrent
+        # reader always sees one complete representation
+        ids = self.ids
+        return ids if ids is not None else self.bitmap
+
+    def __len__(self):
+        return len(self.postings())
+
+    def __iter__(self):
+        return iter(self.postings())
+
+    def __contains__(self, ordinal):
+        if self.bitmap is not None:
+            return ordinal in self.bitmap
+        i = bisect_left(self.ids, ordinal)
+        return i < len(self.ids) and self.ids[i] == ordinal
+
+    def nbytes(self):
+        """Approximate memory use"""
+        postings = self.postings()
+        if isinstance(postings, RoaringBitmap):
+            return sys.getsizeof(self) + postings.nbytes()
+        return sys.getsizeof(self) + sys.getsizeof(postings)
+
+    def __repr__(self):
+        return f"PostingList({list(self)})"
+
+
+def strictly_increasing(ordinals):
+    """True if every ordinal is greater than the one before it"""
+    return all(map(operator.lt, ordinals, islice(ordinals, 1, None)))
+
+
+def insert_sorted(ids, ordinal):
+    """Insert an ordinal into a sorted array unless it is already there"""
+    i = bisect_left(ids, ordinal)
+    if i == len(ids) or ids[i] != ordinal:
+        ids.insert(i, ordinal)
+
+
+ARRAY_MAX = 4096  # Chunks with more members are stored as raw bitmaps
+CHUNK_BYTES = 8192  # 2^16 bits per chunk
+_BYTE_BITS = [tuple(bit for bit in range(8) if byte >> bit & 1) for byte in range(256)]
+
+
+def _chunk_members(container):
+    """Sorted low 16-bit values in a container"""
+    if isinstance(container, array):
+        return container
+    members = []
+    for index, byte in enumerate(container):
+        if byte:
+            base = index << 3
+            members.extend(base + bit for bit in _BYTE_BITS[byte])
+    return members
+
+
+def _chunk_int(container):
+    """Container as a Python int, for word-level bitwise ops"""
+    if isinstance(container, array):
+        bits = bytearray(CHUNK_BYTES)
+        for low in container:
+            bits[low >> 3] |= 1 << (low & 7)
+        container = bits
+    return int.from_bytes(container, 'little')
+
+
+def _chunk_from_int(bits):
+    """Smallest container holding the set bits, or None if empty"""
+    count = bits.bit_count()
+    if count == 0:
+        return None
+    dense = bytearray(bits.to_bytes(CHUNK_BYTES, 'little'))
+    if count > ARRAY_MAX:
+        return dense
+    return array('H', _chunk_members(dense))
+
+
+def _chunk_from_sorted(lows):
+    """Container for a sorted list of low values, or None if empty"""
+    if not lows:
+        return None
+    if len(lows) > ARRAY_MAX:
+        return _chunk_from_int(_chunk_int(array('H', lows)))
+    return array('H', lows)
+
+
+class RoaringBitmap:
+    """
+    Compressed bitmap of document ordinals.
+    Ordinals are split into 2^16-wide chunks keyed by their high bits; each
+    chunk is a sorted array('H') when sparse or an 8 KB bitmap when dense.
+    """
+    def __init__(self):
+        self.containers = {}  # high 16 bits -> array('H') or bytearray
+
+    @classmethod
+    def from_sorted(cls, ordinals):
+        bitmap = cls()
+        for ordinal in ordinals:
+            bitmap.add(ordinal)
+        return bitmap
+
+    def add(self, ordinal):
+        """Add an ordinal; returns True if it was new"""
+        high, low = ordinal >> 16, ordinal & 0xFFFF
+        container = self.containers.get(high)
+        if container is None:
+            self.containers[high] = array('H', [low])
+            return True
+
+        if isinstance(container, bytearray):
+            byte, bit = container[low >> 3], 1 << (low & 7)
+            if byte & bit:
+                return False
+            container[low >> 3] = byte | bit
+            return True
+
+        if not container or low > container[-1]:
+            container.append(low)
+        else:
+            i = bisect_left(container, low)
+            if i < len(container) and container[i] == low:
+                return False
+            container.insert(i, low)
+        if len(container) > ARRAY_MAX:
+            self.containers[high] = _chunk_from_int(_chunk_int(container))
+        return True
+
+    def below(self, limit):
+        """New bitmap of the ordinals < limit"""
+        result = RoaringBitmap()
+        boundary, low_limit = limit >> 16, limit & 0xFFFF
+        # Snapshot the items: a writer may be adding chunks meanwhile
+        for high, container in list(self.containers.items()):
+            if high < boundary:
+                result.containers[high] = container[:]
+            elif high == boundary and low_limit:
+                if isinstance(container, array):
+                    container = _chunk_from_sorted(container[:bisect_left(container, low_limit)])
+                else:
+                    container = _chunk_from_int(_chunk_int(container) & ((1 << low_limit) - 1))
+                if container is not None:
+                    result.containers[high] = container
+        return result
+
+    def __contains__(self, ordinal):
+        container = self.containers.get(ordinal >> 16)
+        if container is None:
+            return False
+        low = ordinal & 0xFFFF
+        if isinstance(container, bytearray):
+            return bool(container[low >> 3] & (1 << (low & 7)))
+        i = bisect_left(container, low)
+        return i < len(container) and container[i] == low
+
+    def __len__(self):
+        total = 0
+        for container in self.containers.values():
+            if isinstance(container, bytearray):
+                total += int.from_bytes(container, 'little').bit_count()
+            else:
+                total += len(container)
+        return total
+
+    def nbytes(self):
+        """Approximate memory use"""
+        return sys.getsizeof(self.containers) + sum(
+            sys.getsizeof(container) for container in self.containers.values())
+
+    def __iter__(self):
+        for high in sorted(self.containers):
+            base = high << 16
+            for low in _chunk_members(self.containers[high]):
+                yield base + low
+
+    def _combine(self, other, keys, int_op, array_op):
+        result = RoaringBitmap()
+        for high in sorted(keys):
+            c1 = self.containers.get(high)
+            c2 = other.containers.get(high)
+            if c1 is None or c2 is None:
+                container = c1 if c2 is None else c2
+                if container is not None:
+                    container = container[:]  # Never share mutable containers
+            elif isinstance(c1, array) and isinstance(c2, array):
+                container = _chunk_from_sorted(array_op(c1, c2))
+            else:
+                container = _chunk_from_int(int_op(_chunk_int(c1), _chunk_int(c2)))
+            if container is not None:
+                result.containers[high] = container
+        return result
+
+    def __and__(self, other):
+        keys = self.containers.keys() & other.containers.keys()
+        return self._combine(other, keys, lambda a, b: a & b, intersect)
+
+    def __or__(self, other):
+        keys = self.containers.keys() | other.containers.keys()
+        return self._combine(other, keys, lambda a, b: a | b, union)
+
+    def __xor__(self, other):
+        keys = self.containers.keys() | other.containers.keys()
+        return self._combine(other, keys, lambda a, b: a ^ b, symmetric_difference)
+
+    def __sub__(self, other):
+        result = RoaringBitmap()
+        for high in sorted(self.containers):
+            c1 = self.containers[high]
+            c2 = other.containers.get(high)
+            if c2 is None:
+                container = c1[:]
+            elif isinstance(c1, array) and isinstance(c2, array):
+                container = _chunk_from_sorted(difference(c1, c2))
+            else:
+                container = _chunk_from_int(_chunk_int(c1) & ~_chunk_int(c2))
+            if container is not None:
+                result.containers[high] = container
+        return result
+
+    def __repr__(self):
+        return f"RoaringBitmap(len={len(self)}, chunks={len(self.containers)})"
+
+
+class Complement:
+    """
+    Lazy complement of a sorted posting list: every ordinal in
+    [0, universe) that is not in excluded. Nothing is materialized until
+    the caller iterates or asks for a page.
+    """
+    def __init__(self, excluded, universe):
+        self.excluded = excluded
+        self.universe = universe
+
+    def __len__(self):
+        return self.universe - len(self.excluded)
+
+    def __iter__(self):
+        start = 0
+        for doc in self.excluded:
+            yield from range(start, doc)
+            start = doc + 1
+        yield from range(start, self.universe)
+
+    def page(self, offset, limit):
+        """Ordinals offset .. offset + limit of the complement, as a list"""
+        excluded = self.excluded
+        if isinstance(excluded, RoaringBitmap):
+            return list(islice(self, offset, offset + limit))
+        # The complement has excluded[i] - i members below excluded[i]
+        lo, hi = 0, len(excluded)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if excluded[mid] - mid > offset:
+                hi = mid
+            else:
+                lo = mid + 1
+        doc = offset + lo  # First ordinal of the page
+        i = lo
+        result = []
+        while len(result) < limit and doc < self.universe:
+            if i < len(excluded) and excluded[i] == doc:
+                i += 1
+            else:
+                result.append(doc)
+            doc += 1
+        return result
+
+    def __repr__(self):
+        return f"Complement(excluded={len(self.excluded)}, universe={self.universe})"
+
+
+# Posting-list algebra over sorted sequences of ordinals.
+# Each function returns a new sorted list without building sets; when
+# either side is a RoaringBitmap they dispatch to word-level bitmap ops.
+
+GALLOP_RATIO = 16  # Gallop when one list is this many times longer
+
+
+def _gallop(seq, target, lo):
+    """Smallest index >= lo with seq[index] >= target (exponential search)"""
+    n = len(seq)
+    hi = lo
+    step = 1
+    while hi < n and seq[hi] < target:
+        lo = hi + 1
+        hi += step
+        step <<= 1
+    return bisect_left(seq, target, lo, min(hi, n))
+
+
+def _as_bitmap(postings):
+    if isinstance(postings, RoaringBitmap):
+        return postings
+    return RoaringBitmap.from_sorted(postings)
+
+
+def intersect(list1, list2):
+    """Documents in both lists"""
+    if isinstance(list1, RoaringBitmap) and isinstance(list2, RoaringBitmap):
+        return list1 & list2
+    if isinstance(list1, RoaringBitmap):
+        return [doc for doc in list2 if doc in list1]
+    if isinstance(list2, RoaringBitmap):
+        return [doc for doc in list1 if doc in list2]
+
+    if len(list1) > len(list2):
+        list1, list2 = list2, list1
+    result = []
+    if not list1:
+        return result
+
+    if len(list1) * GALLOP_RATIO < len(list2):
+        # Skewed sizes: O(small * log large)
+        pos, n = 0, len(list2)
+        for doc in list1:
+            pos = _gallop(list2, doc, pos)
+            if pos == n:
+                break
+            if list2[pos] == doc:
+                result.append(doc)
+                pos += 1
+        return result
+
+    i = j = 0
+    n1, n2 = len(list1), len(list2)
+    while i < n1 and j < n2:
+        a, b = list1[i], list2[j]
+        if a == b:
+            result.append(a)
+            i += 1
+            j += 1
+        elif a < b:
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+def union(list1, list2):
+    """Documents in either list"""
+    if isinstance(list1, RoaringBitmap) or isinstance(list2, RoaringBitmap):
+        return _as_bitmap(list1) | _as_bitmap(list2)
+
+    result = []
+    i = j = 0
+    n1, n2 = len(list1), len(list2)
+    while i < n1 and j < n2:
+        a, b = list1[i], list2[j]
+        if a == b:
+            result.append(a)
+            i += 1
+            j += 1
+        elif a < b:
+            result.append(a)
+            i += 1
+        else:
+            result.append(b)
+            j += 1
+    result.extend(list1[i:])
+    result.extend(list2[j:])
+    return result
+
+
+def difference(list1, list2):
+    """Documents in list1 but not in list2"""
+    if isinstance(list1, RoaringBitmap):
+        return list1 - _as_bitmap(list2)
+    if isinstance(list2, RoaringBitmap):
+        return [doc for doc in list1 if doc not in list2]
+
+    result = []
+    if not list2:
+        result.extend(list1)
+        return result
+
+    if len(list1) * GALLOP_RATIO < len(list2):
+        pos, n = 0, len(list2)
+        for doc in list1:
+            pos = _gallop(list2, doc, pos)
+            if pos == n or list2[pos] != doc:
+                result.append(doc)
+        return result
+
+    i = j = 0
+    n1, n2 = len(list1), len(list2)
+    while i < n1 and j < n2:
+        a, b = list1[i], list2[j]
+        if a == b:
+            i += 1
+            j += 1
+        elif a < b:
+            result.append(a)
+            i += 1
+        else:
+            j += 1
+    result.extend(list1[i:])
+    return result
+
+
+def symmetric_difference(list1, list2):
+    """Documents in exactly one of the lists"""
+    if isinstance(list1, RoaringBitmap) or isinstance(list2, RoaringBitmap):
+        return _as_bitmap(list1) ^ _as_bitmap(list2)
+
+    result = []
+    i = j = 0
+    n1, n2 = len(list1), len(list2)
+    while i < n1 and j < n2:
+        a, b = list1[i], list2[j]
+        if a == b:
+            i += 1
+            j += 1
+        elif a < b:
+            result.append(a)
+            i += 1
+        else:
+            result.append(b)
+            j += 1
+    result.extend(list1[i:])
+    result.extend(list2[j:])
+    return result
+
+
+def truncate(postings, limit):
+    """
+    Copy of the sorted ordinals below limit. Lets a reader pin a version
+    of a posting list that a writer keeps appending to.
+    """
+    if isinstance(postings, RoaringBitmap):
+        return postings.below(limit)
+    return postings[:bisect_left(postings, limit)]
+
+
+def renumber(postings, tombstones):
+    """
+    Posting list without the sorted tombstoned ordinals, with every
+    remaining ordinal shifted down by the number of tombstones below it
+    """
+    ordinals = array('I')
+    j, n = 0, len(tombstones)
+    for ordinal in postings:
+        while j < n and tombstones[j] < ordinal:
+            j += 1
+        if j < n and tombstones[j] == ordinal:
+            continue
+        ordinals.append(ordinal - j)
+    posting_list = PostingList()
+    posting_list.extend(ordinals)
+    return posting_list
+
+
+def union_all(lists):
+    """Documents in any of the lists (k-way merge, bitmaps OR-ed together)"""
+    bitmaps, sorted_lists = [], []
+    for postings in lists:
+        (bitmaps if isinstance(postings, RoaringBitmap) else sorted_lists).append(postings)
+
+    result = []
+    for doc in heapq.merge(*sorted_lists):
+        if not result or result[-1] != doc:
+            result.append(doc)
+    for bitmap in bitmaps:
+        result = union(bitmap, result)
+    return result
+
+
+def concatenate(lists):
+    """
+    PostingList of every ordinal in the given postings (arrays or bitmaps).
+    Bitmaps are OR-ed chunk by chunk and arrays that follow one another are
+    joined in bulk; overlapping arrays (re-added documents) are merged.
+    """
+    bitmap, runs = None, []
+    for postings in lists:
+        if isinstance(postings, RoaringBitmap):
+            bitmap = postings if bitmap is None else bitmap | postings
+        elif len(postings):
+            runs.append(postings)
+    ids = array('I')
+    if all(runs[i][0] > runs[i - 1][-1] for i in range(1, len(runs))):
+        for run in runs:
+            ids.extend(run)
+    else:
+        ids.extend(union_all(runs))
+    result = PostingList()
+    if bitmap is not None:
+        result.bitmap = bitmap | _as_bitmap(ids) if ids else bitmap
+        result.ids = None
+    else:
+        result.ids = ids
+    return result
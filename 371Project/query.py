@@ -0,0 +1,163 @@
+"""
+Tokenizer, parser and optimizer for Boolean queries.
+
+A query is parsed once into a small AST of tuples:
+    ('term', text)
+    ('phrase', text)                 "magnetic field"
+    ('near', (left, right), k)       magnet NEAR/5 superconductor
+    ('and', (child, ...))
+    ('or', (child, ...))
+    ('xor', (left, right))
+    ('not', child)
+
+Precedence, loosest first: OR, XOR, AND, NOT, NEAR. Parentheses group,
+and two operands with no operator between them are ANDed. "a NOT b" means
+"a AND NOT b". NEAR joins exactly two terms or phrases.
+"""
+
+import re
+
+TOKEN_PATTERN = re.compile(r'"[^"]*"?|\(|\)|[^\s()"]+')
+NEAR_PATTERN = re.compile(r'NEAR/(\d+)\Z')
+OPERATORS = {'AND', 'OR', 'XOR', 'NOT'}
+
+
+class QuerySyntaxError(ValueError):
+    """Raised for malformed Boolean queries"""
+
+
+def tokenize_query(query):
+    """Split a query into operators, parentheses and terms"""
+    tokens = []
+    for token in TOKEN_PATTERN.findall(query):
+        upper = token.upper()
+        if upper in OPERATORS or NEAR_PATTERN.match(upper):
+            tokens.append(upper)
+        elif token.startswith('"'):
+            if len(token) < 2 or not token.endswith('"'):
+                raise QuerySyntaxError("Unterminated phrase")
+            tokens.append(('phrase', token[1:-1].lower()))
+        elif token in '()':
+            tokens.append(token)
+        else:
+            tokens.append(('term', token.lower()))
+    return tokens
+
+
+class _Parser:
+    """Recursive-descent parser over the token list"""
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def parse(self):
+        node = self.parse_or()
+        if self.peek() is not None:
+            raise QuerySyntaxError(f"Unexpected {self.peek()!r}")
+        return node
+
+    def parse_or(self):
+        children = [self.parse_xor()]
+        while self.peek() == 'OR':
+            self.next()
+            children.append(self.parse_xor())
+        return children[0] if len(children) == 1 else ('or', tuple(children))
+
+    def parse_xor(self):
+        node = self.parse_and()
+        while self.peek() == 'XOR':
+            self.next()
+            node = ('xor', (node, self.parse_and()))
+        return node
+
+    def parse_and(self):
+        children = [self.parse_not()]
+        while True:
+            token = self.peek()
+            if token == 'AND':
+                self.next()
+            elif not (token == 'NOT' or token == '(' or isinstance(token, tuple)):
+                break
+            # "a NOT b" and "a b" both fall through to an AND
+            children.append(self.parse_not())
+        return children[0] if len(children) == 1 else ('and', tuple(children))
+
+    def parse_not(self):
+        if self.peek() == 'NOT':
+            self.next()
+            return ('not', self.parse_not())
+        return self.parse_near()
+
+    def parse_near(self):
+        node = self.parse_primary()
+        token = self.peek()
+        if isinstance(token, str) and NEAR_PATTERN.match(token):
+            self.next()
+            right = self.parse_primary()
+            for operand in (node, right):
+                if operand[0] not in ('term', 'phrase'):
+                    raise QuerySyntaxError(f"{token} needs a term or phrase on each side")
+            node = ('near', (node, right), int(NEAR_PATTERN.match(token).group(1)))
+            if isinstance(self.peek(), str) and NEAR_PATTERN.match(self.peek()):
+                raise QuerySyntaxError("NEAR can't be chained")
+        return node
+
+    def parse_primary(self):
+        token = self.next()
+        if token == '(':
+            node = self.parse_or()
+            if self.next() != ')':
+                raise QuerySyntaxError("Missing ')'")
+            return node
+        if isinstance(token, tuple):
+            return token
+        if token is None:
+            raise QuerySyntaxError("Unexpected end of query")
+        raise QuerySyntaxError(f"Unexpected {token!r}")
+
+
+def parse_query(query):
+    """Parse a query string into an optimized AST"""
+    tokens = tokenize_query(query)
+    if not tokens:
+        raise QuerySyntaxError("Empty query")
+    return optimize(_Parser(tokens).parse())
+
+
+def optimize(node):
+    """
+    Flatten nested AND/OR, cancel double negation and order AND operands
+    so that plain terms come first and negations last (folded into AND NOT
+    at evaluation time).
+    """
+    kind = node[0]
+    if kind in ('term', 'phrase', 'near'):
+        return node
+    if kind == 'not':
+        child = optimize(node[1])
+        if child[0] == 'not':
+            return child[1]
+        return ('not', child)
+    if kind == 'xor':
+        return ('xor', tuple(optimize(child) for child in node[1]))
+
+    children = []
+    for child in node[1]:
+        child = optimize(child)
+        if child[0] == kind:
+            children.extend(child[1])
+        else:
+            children.append(child)
+    if kind == 'and':
+        # Phrase and NEAR operands need positions, so they go after other composites
+        order = {'term': 0, 'phrase': 2, 'near': 2, 'not': 3}
+        children.sort(key=lambda child: order.get(child[0], 1))
+    return (kind, tuple(children))
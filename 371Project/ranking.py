@@ -0,0 +1,233 @@
+"""
+BM25 scoring and top-k retrieval.
+
+top_k walks the posting lists of the query terms document-at-a-time with
+WAND: every term carries an upper bound on its score contribution, and
+documents whose summed bounds can't beat the current k-th best score are
+skipped without being scored. Only a bounded heap of k results is kept.
+
+Term frequencies are stored per term (TermFrequencies), encoded like
+positional postings, with a skip entry every TF_BLOCK documents so a
+scorer following a WAND cursor jumps over the documents it skipped.
+"""
+
+import heapq
+import math
+import sys
+from array import array
+from bisect import bisect_left
+
+from postings import Complement, RoaringBitmap
+from positions import encode_varint, decode_varint
+
+K1 = 1.2  # Term-frequency saturation
+B = 0.75  # Document-length normalization
+END = float('inf')  # Cursor position past the last posting
+TF_BLOCK = 64  # Term frequency entries between skip entries
+
+
+def idf(num_docs, doc_freq):
+    """BM25 inverse document frequency (never negative)"""
+    return math.log(1 + (num_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+
+
+def term_weight(tf, doc_length, avg_length, k1=K1, b=B):
+    """BM25 term-frequency component"""
+    return tf * (k1 + 1) / (tf + k1 * (1 - b + b * doc_length / avg_length))
+
+
+class TermFrequencies:
+    """
+    Frequencies of one term, document by document: one bytearray of
+    varint(doc - previous doc) varint(tf) entries in increasing document
+    order, plus (previous doc, byte offset) skip entries, one per block of
+    TF_BLOCK entries after the first
+    """
+    def __init__(self):
+        self.blocks = (bytearray(), None)  # (data, skips); replaced whole, never half-updated
+        self.last_doc = -1
+        self.count = 0
+
+    def add(self, doc, tf):
+        """Record a document's frequency; O(1) amortized for new documents"""
+        if doc > self.last_doc:
+            self._append(doc, tf)
+            return
+        # Re-added document: replace its entry and re-encode
+        entries = dict(self)
+        entries[doc] = tf
+        self._rebuild(sorted(entries.items()))
+
+    def _append(self, doc, tf):
+        data, skips = self.blocks
+        if self.count and not self.count % TF_BLOCK:
+            if skips is None:
+                skips = array('I')
+                self.blocks = (data, skips)
+            # Before the data, so a reader never sees an offset past its end
+            skips.append(self.last_doc)
+            skips.append(len(data))
+        encode_varint(doc - self.last_doc, data)
+        encode_varint(tf, data)
+        self.last_doc = doc
+        self.count += 1
+
+    def _rebuild(self, entries):
+        # Built aside, so readers still decoding the old buffers are unaffected
+        fresh = TermFrequencies()
+        for doc, tf in entries:
+            fresh._append(doc, tf)
+        self.blocks, self.last_doc, self.count = fresh.blocks, fresh.last_doc, fresh.count
+
+    def copy(self):
+        """Writable copy (of a memory-mapped one, see storage.py)"""
+        data, skips = self.blocks
+        copy = TermFrequencies()
+        copy.blocks = (bytearray(data), array('I', skips) if skips else None)
+        copy.last_doc, copy.count = self.last_doc, self.count
+        return copy
+
+    def __iter__(self):
+        """(doc, tf) for every document"""
+        data = self.blocks[0]
+        pos, doc, end = 0, -1, len(data)
+        while pos < end:
+            delta, pos = decode_varint(data, pos)
+            doc += delta
+            tf, pos = decode_varint(data, pos)
+            yield doc, tf
+
+    def nbytes(self):
+        """Approximate memory use"""
+        data, skips = self.blocks
+        return sys.getsizeof(self) + sys.getsizeof(data) + (sys.getsizeof(skips) if skips else 0)
+
+    def reader(self):
+        """
+        tf(doc) for increasing docs (0 where the term is absent). Jumps over
+        whole blocks before target through the skip entries, then decodes.
+        """
+        data, skips = self.blocks
+        skips = skips or ()
+        end, num_skips = len(data), len(skips)
+        pos, doc, tf, skip = 0, -1, 0, 0
+
+        def lookup(target):
+            nonlocal pos, doc, tf, skip
+            # Every document before a block is <= its skip doc
+            while skip < num_skips and skips[skip] < target and skips[skip + 1] < end:
+                if skips[skip + 1] > pos:
+                    doc, pos = skips[skip], skips[skip + 1]
+                skip += 2
+            while doc < target and pos < end:
+                # Deltas and frequencies are almost always single-byte varints
+                delta = data[pos]
+                if delta < 0x80:
+                    pos += 1
+                else:
+                    delta, pos = decode_varint(data, pos)
+                doc += delta
+                tf = data[pos]
+                if tf < 0x80:
+                    pos += 1
+                else:
+                    tf, pos = decode_varint(data, pos)
+            return tf if doc == target else 0
+        return lookup
+
+    def renumber(self, tombstones):
+        """Copy without the sorted tombstoned docs, renumbered densely"""
+        copy = TermFrequencies()
+        j, n = 0, len(tombstones)
+        entries = []
+        for doc, tf in self:
+            while j < n and tombstones[j] < doc:
+                j += 1
+            if j < n and tombstones[j] == doc:
+                continue
+            entries.append((doc - j, tf))
+        copy._rebuild(entries)
+        return copy
+
+
+class TermCursor:
+    """Position in one term's sorted posting list, with its score bound"""
+    def __init__(self, term, postings, idf, upper_bound):
+        self.term = term
+        self.postings = postings
+        self.idf = idf
+        self.upper_bound = upper_bound
+        self.pos = 0
+        self.doc = postings[0] if len(postings) else END
+
+    def next(self):
+        self.pos += 1
+        self.doc = self.postings[self.pos] if self.pos < len(self.postings) else END
+
+    def seek(self, target):
+        """Advance to the first posting >= target"""
+        self.pos = bisect_left(self.postings, target, self.pos)
+        self.doc = self.postings[self.pos] if self.pos < len(self.postings) else END
+
+
+def member_test(result):
+    """
+    Membership test against a query result for increasing ordinals:
+    sorted lists are walked with a moving cursor instead of a set.
+    """
+    if isinstance(result, RoaringBitmap):
+        return result.__contains__
+    if isinstance(result, Complement):
+        inside = member_test(result.excluded)
+        return lambda doc: doc < result.universe and not inside(doc)
+
+    pos = 0
+    def test(doc):
+        nonlocal pos
+        pos = bisect_left(result, doc, pos)
+        return pos < len(result) and result[pos] == doc
+    return test
+
+
+def top_k(cursors, score, k, accept=None):
+    """
+    The k best (score, doc) pairs, best first; ties go to the lower doc.
+    score(doc, cursors) scores a document from the cursors positioned on
+    it, and accept(doc) (tested in increasing doc order) filters candidates.
+    """
+    heap = []  # Min-heap of (score, -doc)
+    threshold = 0.0
+    cursors = [cursor for cursor in cursors if cursor.doc != END]
+    while cursors:
+        cursors.sort(key=lambda cursor: cursor.doc)
+        # Pivot: the first cursor at which the summed bounds beat the threshold
+        # (later docs never win a tie, so they must beat it strictly)
+        bound, pivot = 0.0, None
+        for i, cursor in enumerate(cursors):
+            bound += cursor.upper_bound
+            if bound > threshold:
+                pivot = i
+                break
+        if pivot is None:
+            break
+        doc = cursors[pivot].doc
+
+        if cursors[0].doc == doc:
+            matched = [cursor for cursor in cursors if cursor.doc == doc]
+            if accept is None or accept(doc):
+                entry = (score(doc, matched), -doc)
+                if len(heap) < k:
+                    heapq.heappush(heap, entry)
+                elif entry > heap[0]:
+                    heapq.heapreplace(heap, entry)
+                if len(heap) == k:
+                    threshold = heap[0][0]
+            for cursor in matched:
+                cursor.next()
+        else:
+            # No document before the pivot can make the top k
+            for cursor in cursors[:pivot]:
+                cursor.seek(doc)
+        cursors = [cursor for cursor in cursors if cursor.doc != END]
+
+    return [(entry_score, -neg_doc) for entry_score, neg_doc in sorted(heap, reverse=True)]
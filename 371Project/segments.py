@@ -0,0 +1,359 @@
+"""
+Segmented (LSM-style) inverted index.
+
+New documents go into a small mutable write segment, a plain dict of
+term -> PostingList. Once it holds segment_docs documents it is sealed:
+its terms are sorted and built bottom-up into an immutable 2-3 tree, and
+a fresh write segment takes its place, so no tree is ever rebalanced by
+incremental inserts. A tiered merge policy combines runs of merge_factor
+neighbouring segments of similar size, either in a background thread or
+synchronously.
+
+SegmentedIndex exposes the Tree23InvertedIndex interface, so
+boolean_model queries across all segments transparently. Sealed segments
+are immutable, so with copy_on_write only the write segment needs
+copying for snapshots.
+"""
+
+import heapq
+import sys
+import threading
+from bisect import bisect_left
+from itertools import groupby
+
+from instrumentation import distribution
+from postings import PostingList, concatenate, renumber
+from tree23 import Tree23InvertedIndex
+
+
+class Segment:
+    """A sealed, immutable segment"""
+    def __init__(self, index, num_docs):
+        self.index = index
+        self.num_docs = num_docs
+
+    def tier(self, merge_factor):
+        """Size class: segments in one tier are within merge_factor x of each other"""
+        tier, size = 0, self.num_docs
+        while size >= merge_factor:
+            size //= merge_factor
+            tier += 1
+        return tier
+
+
+class WriteSegment:
+    """
+    The mutable write segment: term -> PostingList in a dict, with the read
+    side of Tree23InvertedIndex. With copy_on_write, snapshots share the
+    dict until the next new term, which copies it; ordinals at or above the
+    snapshot's limit are added in place, anything lower goes to a copied list.
+    """
+    read_only = False
+
+    def __init__(self, copy_on_write=False):
+        self.postings = {}
+        self.copy_on_write = copy_on_write
+        self._terms = None  # Sorted terms, until a new term arrives
+        self._shared = False  # The dict is referenced by a snapshot
+        self._private = set()  # Posting lists copied since the last snapshot
+        self._limit = 0  # Published posting lists only change in place from here up
+
+    def insert(self, term, doc_id):
+        posting_list = self.postings.get(term)
+        if posting_list is None:
+            self._own_postings()[term] = PostingList([doc_id])
+            self._terms = None
+            return
+        if self.copy_on_write and doc_id < self._limit and posting_list not in self._private:
+            clone = PostingList()
+            clone.extend(posting_list)
+            self._private.add(clone)
+            self._own_postings()[term] = posting_list = clone
+        posting_list.add(doc_id)
+
+    def _own_postings(self):
+        """The dict, copied first if a snapshot is reading it"""
+        if self._shared:
+            self.postings = dict(self.postings)
+            self._shared = False
+        return self.postings
+
+    def add_terms(self, doc_id, terms):
+        for term in terms:
+            self.insert(term, doc_id)
+
+    def snapshot(self, limit=None):
+        """Read-only view (see Tree23InvertedIndex.snapshot)"""
+        view = WriteSegment()
+        view.postings = self.postings
+        view.read_only = True
+        self._shared = True
+        self._private = set()
+        self._limit = float('inf') if limit is None else limit
+        return view
+
+    def seal(self):
+        """Balanced 2-3 tree of the buffered terms"""
+        index = Tree23InvertedIndex()
+        index.root = index._build_balanced(list(self.range_scan()))
+        index.num_terms = len(self.postings)
+        return index
+
+    def search(self, term, trace=None):
+        if trace is not None:
+            trace.counters['tree_nodes'] += 1
+        return self.postings.get(term, [])
+
+    def sorted_terms(self):
+        terms = self._terms
+        if terms is None:
+            terms = self._terms = sorted(self.postings)
+        return terms
+
+    def range_scan(self, lo=None, hi=None):
+        """(term, posting_list) for lo <= term < hi"""
+        terms, postings = self.sorted_terms(), self.postings
+        start = 0 if lo is None else bisect_left(terms, lo)
+        end = len(terms) if hi is None else bisect_left(terms, hi)
+        for term in terms[start:end]:
+            yield term, postings[term]
+
+    def stats(self):
+        """Tree23InvertedIndex.stats for the buffered terms (no tree yet)"""
+        postings = self.postings
+        lengths = [len(posting_list) for posting_list in postings.values()]
+        return {
+            'terms': len(lengths), 'nodes': 0, 'leaves': 0, 'height': 0,
+            'postings': sum(lengths),
+            'dense_terms': sum(posting_list.bitmap is not None for posting_list in postings.values()),
+            'posting_lengths': distribution(lengths),
+            'bytes': {'nodes': sys.getsizeof(postings),
+                      'terms': sum(sys.getsizeof(term) for term in postings),
+                      'postings': sum(posting_list.nbytes() for posting_list in postings.values())},
+        }
+
+
+class SegmentedIndex(Tree23InvertedIndex):
+    """Inverted index split into a write segment plus sealed segments"""
+    def __init__(self, segment_docs=1000, merge_factor=4, background=True,
+                 copy_on_write=False, analyzer=None):
+        super().__init__(copy_on_write, analyzer)
+        self.segment_docs = segment_docs
+        self.merge_factor = merge_factor
+        self.background = background
+        self.segments = []  # Sealed segments, oldest first; replaced, never mutated
+        self.write_index = WriteSegment(copy_on_write)
+        self.write_docs = 0
+        self._lock = threading.Lock()  # Guards segment list updates
+        self._merge_thread = None  # Background merger, if running
+        self._merge_requested = False  # Segments added while it was running
+
+    # Writes
+
+    def add_terms(self, doc_id, terms):
+        """Add a document to the write segment, sealing it when full"""
+        self.write_index.add_terms(doc_id, terms)
+        self.write_docs += 1
+        if self.write_docs >= self.segment_docs:
+            self.seal()
+
+    def insert(self, term, doc_id):
+        self.write_index.insert(term, doc_id)
+
+    def bulk_load_terms(self, documents):
+        """Index an analyzed batch as one new sealed segment"""
+        documents = list(documents)
+        index = Tree23InvertedIndex()
+        terms = index.bulk_load_terms(documents)
+        self.seal()
+        self._add_segment(Segment(index, len(documents)))
+        return terms
+
+    def merge_segments(self, segments):
+        """Add pre-built (term, doc ids) segments as one new sealed segment"""
+        index = Tree23InvertedIndex()
+        index.merge_segments(segments)
+        self.seal()
+        self._add_segment(Segment(index, len({doc for _, doc_ids in index.range_scan()
+                                               for doc in doc_ids})))
+
+    def seal(self):
+        """Freeze the write segment and start a new one"""
+        if not self.write_docs:
+            return
+        segment = Segment(self.write_index.seal(), self.write_docs)
+        self.write_index = WriteSegment(self.copy_on_write)
+        self.write_docs = 0
+        self._add_segment(segment)
+
+    def _add_segment(self, segment):
+        with self._lock:
+            self.segments = self.segments + [segment]
+        self._schedule_merge()
+
+    # Merging
+
+    def _schedule_merge(self):
+        if not self.background:
+            self.run_merges()
+            return
+        with self._lock:
+            if self._merge_thread is not None:
+                # The merger rechecks the policy before it exits
+                self._merge_requested = True
+                return
+            self._merge_thread = threading.Thread(target=self._merge_loop, daemon=True)
+            self._merge_thread.start()
+
+    def _merge_loop(self):
+        """Background merger: run merges until no segment arrived meanwhile"""
+        while True:
+            self.run_merges()
+            with self._lock:
+                if not self._merge_requested:
+                    self._merge_thread = None
+                    return
+                self._merge_requested = False
+
+    def _pick_merge(self, segments):
+        """(start, end) of the oldest run of merge_factor same-tier segments"""
+        start = 0
+        for i in range(1, len(segments) + 1):
+            if i == len(segments) or (segments[i].tier(self.merge_factor)
+                                      != segments[start].tier(self.merge_factor)):
+                if i - start >= self.merge_factor:
+                    return start, start + self.merge_factor
+                start = i
+        return None
+
+    def run_merges(self):
+        """Merge segments until the policy is satisfied"""
+        while True:
+            segments = self.segments
+            run = self._pick_merge(segments)
+            if run is None:
+                return
+            start, end = run
+            merged = self._merge(segments[start:end])
+            with self._lock:
+                # Sealed segments are only ever appended meanwhile
+                current = self.segments
+                self.segments = current[:start] + [merged] + current[end:]
+
+    def _merge(self, segments):
+        """Merge sealed segments into one, built bottom-up"""
+        merged = {}  # term -> posting lists, oldest segment first
+        for segment in segments:
+            for term, posting_list in segment.index.range_scan():
+                if term in merged:
+                    merged[term].append(posting_list)
+                else:
+                    merged[term] = [posting_list]
+        items = []
+        for term in sorted(merged):
+            found = merged[term]
+            posting_list = found[0]  # Sealed lists are immutable, so shared
+            if len(found) > 1:
+                posting_list = PostingList()
+                for other in found:
+                    posting_list.extend(other)
+            items.append((term, posting_list))
+        index = Tree23InvertedIndex()
+        index.root = index._build_balanced(items)
+        index.num_terms = len(items)
+        return Segment(index, sum(segment.num_docs for segment in segments))
+
+    def wait_for_merges(self):
+        """Block until background merging is idle"""
+        thread = self._merge_thread
+        if thread is not None:
+            thread.join()
+
+    def optimize(self):
+        """Seal the write segment and merge everything into one segment"""
+        self.seal()
+        self.wait_for_merges()
+        with self._lock:
+            segments = self.segments
+            if len(segments) > 1:
+                self.segments = [self._merge(segments)]
+
+    def purge(self, tombstones):
+        """
+        Rewrite every segment without the tombstoned ordinals, renumbering
+        as in Tree23InvertedIndex.purge. Returns the terms left in no segment.
+        """
+        self.seal()
+        self.wait_for_merges()
+        with self._lock:
+            terms = {term for term, _ in self.range_scan()}
+            segments = []
+            for segment in self.segments:
+                items = [(term, renumber(doc_ids, tombstones))
+                         for term, doc_ids in segment.index.range_scan()]
+                items = [(term, doc_ids) for term, doc_ids in items if doc_ids]
+                if items:
+                    index = Tree23InvertedIndex()
+                    index.merge_segments([items])
+                    num_docs = len({doc for _, doc_ids in items for doc in doc_ids})
+                    segments.append(Segment(index, num_docs))
+            self.segments = segments
+        return sorted(terms - {term for term, _ in self.range_scan()})
+
+    def snapshot(self, limit=None):
+        """Read-only view of the current segments (see Tree23InvertedIndex.snapshot)"""
+        view = SegmentedIndex(self.segment_docs, self.merge_factor, background=False,
+                              analyzer=self.analyzer)
+        view.segments = self.segments
+        view.write_index = self.write_index.snapshot(limit)
+        view.read_only = True
+        return view
+
+    # Reads
+
+    def _indexes(self):
+        """Every segment's tree, oldest first, write segment last"""
+        return [segment.index for segment in self.segments] + [self.write_index]
+
+    def search(self, term, trace=None):
+        """Posting list for a term, concatenated across segments"""
+        found = [index.search(term, trace) for index in self._indexes()]
+        found = [posting_list for posting_list in found if posting_list]
+        if len(found) <= 1:
+            return found[0] if found else []
+        return concatenate(posting_list.postings() for posting_list in found)
+
+    def range_scan(self, lo=None, hi=None):
+        """Lazily yield (term, posting_list) for lo <= term < hi across segments"""
+        streams = [((term, i, posting_list) for term, posting_list in index.range_scan(lo, hi))
+                   for i, index in enumerate(self._indexes())]
+        for term, group in groupby(heapq.merge(*streams, key=lambda entry: entry[:2]),
+                                   key=lambda entry: entry[0]):
+            found = [entry[2] for entry in group]
+            if len(found) == 1:
+                yield term, found[0]
+            else:
+                yield term, concatenate(posting_list.postings() for posting_list in found)
+
+    def stats(self):
+        """Tree23InvertedIndex.stats for each segment (write segment last) plus totals"""
+        segments, write_index, write_docs = self.segments, self.write_index, self.write_docs
+        per_segment = []
+        terms = set()
+        for index, num_docs in ([(segment.index, segment.num_docs) for segment in segments]
+                                + [(write_index, write_docs)]):
+            stats = index.stats()
+            stats['docs'] = num_docs
+            per_segment.append(stats)
+            terms.update(term for term, _ in index.range_scan())
+        return {
+            'terms': len(terms),
+            'postings': sum(stats['postings'] for stats in per_segment),
+            'bytes': {part: sum(stats['bytes'][part] for stats in per_segment)
+                      for part in ('nodes', 'terms', 'postings')},
+            'segments': per_segment,
+        }
+
+    def segment_sizes(self):
+        """Document counts of the sealed segments and the write segment"""
+        return [segment.num_docs for segment in self.segments] + [self.write_docs]
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Asyncio query server for boolean_model.
+
+Line protocol over TCP or a Unix socket. Every request is one line and
+gets exactly one response line, in request order:
+
+    magnet AND NOT small
+        -> OK Doc1 Doc3            (or: ERR <message>)
+    {"id": 7, "query": "super*", "offset": 0, "limit": 10}
+        -> {"id": 7, "total": 2, "results": ["Doc1", "Doc2"]}
+                                   (or: {"id": 7, "error": "<message>"})
+
+Queries that arrive within batch_window of each other are evaluated
+together in a worker thread (boolean_model.batch_query), so a term shared
+by many concurrent queries has its posting list fetched once per batch.
+Results stay lazy until then: a JSON request only looks up the doc ids of
+its offset/limit page.
+
+Backpressure: at most max_pending queries wait for a batch and at most
+max_inflight responses are outstanding per connection. Beyond either
+limit the server stops reading from that client's socket, and a client
+that doesn't read its responses stalls on the transport's write buffer.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+
+
+class QueryServer:
+    """Serves boolean_query over a line protocol, batching concurrent queries"""
+    def __init__(self, model, batch_window=0.002, max_batch=256, max_pending=1024,
+                 max_inflight=64, max_line=64 * 1024):
+        self.model = model
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.max_inflight = max_inflight
+        self.max_line = max_line
+        self.pending = None  # Queue of (query, page, future), created on the server's loop
+        self.server = None
+        self._batcher = None
+        self.batches = 0
+        self.queries = 0
+
+    async def start(self, host='127.0.0.1', port=8023, path=None):
+        """Listen on a Unix socket if path is given, else on TCP host:port"""
+        self.pending = asyncio.Queue(self.max_pending)
+        self._batcher = asyncio.create_task(self._run_batches())
+        if path:
+            self.server = await asyncio.start_unix_server(self._handle, path, limit=self.max_line)
+        else:
+            self.server = await asyncio.start_server(self._handle, host, port, limit=self.max_line)
+        return self.server
+
+    async def serve_forever(self):
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self._batcher.cancel()
+
+    # Connections
+
+    async def _handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        responses = asyncio.Queue(self.max_inflight)  # (request, future) in arrival order
+        sender = asyncio.create_task(self._send(responses, writer))
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    await responses.put((None, self._failed(f"Line longer than {self.max_line} bytes")))
+                    break
+                except ConnectionError:
+                    break
+                if not line:
+                    break
+                line = line.decode('utf-8', 'replace').strip()
+                if not line:
+                    continue
+
+                request, query, page = None, line, (0, None)
+                if line.startswith('{'):
+                    try:
+                        request, query = self._parse_request(line)
+                    except ValueError as exc:
+                        await responses.put(({}, self._failed(str(exc))))
+                        continue
+                    page = (request.get('offset') or 0, request.get('limit'))
+                future = loop.create_future()
+                # Both puts block when full, which stops us reading the socket
+                await responses.put((request, future))
+                await self.pending.put((query, page, future))
+        finally:
+            await responses.put(None)
+            await sender
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    def _parse_request(self, line):
+        """(request, query) from a JSON request line"""
+        try:
+            request = json.loads(line)
+        except ValueError:
+            raise ValueError("Malformed JSON request")
+        if not isinstance(request, dict) or not isinstance(request.get('query'), str):
+            raise ValueError("JSON requests need a \"query\" string")
+        for field in ('offset', 'limit'):
+            value = request.get(field)
+            if value is not None and (not isinstance(value, int) or value < 0):
+                raise ValueError(f"\"{field}\" must be a non-negative integer")
+        return request, request['query']
+
+    def _failed(self, message):
+        future = asyncio.get_running_loop().create_future()
+        future.set_exception(ValueError(message))
+        return future
+
+    async def _send(self, responses, writer):
+        """Write responses in request order"""
+        connected = True
+        while True:
+            item = await responses.get()
+            if item is None:
+                return
+            request, future = item
+            try:
+                results, error = await future, None
+            except Exception as exc:
+                results, error = None, str(exc)
+            if not connected:
+                continue  # Keep draining so the reader never blocks on a dead client
+            writer.write(self._format(request, results, error).encode('utf-8'))
+            try:
+                await writer.drain()
+            except ConnectionError:
+                connected = False
+
+    def _format(self, request, results, error):
+        """Response line for a request; results is (total, doc ids of the page)"""
+        if request is None:
+            if error is not None:
+                return f"ERR {error}\n"
+            return "OK " + " ".join(map(str, results[1])) + "\n"
+
+        response = {'id': request.get('id')}
+        if error is not None:
+            response['error'] = error
+        else:
+            response['total'], response['results'] = results
+        return json.dumps(response) + "\n"
+
+    # Batching
+
+    async def _run_batches(self):
+        """Collect queries for batch_window, then evaluate them together"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.pending.get()]
+            if self.batch_window:
+                await asyncio.sleep(self.batch_window)
+            while len(batch) < self.max_batch and not self.pending.empty():
+                batch.append(self.pending.get_nowait())
+
+            queries = [query for query, _, _ in batch]
+            pages = [page for _, page, _ in batch]
+            try:
+                results = await loop.run_in_executor(None, self.model.batch_query, queries, pages)
+            except Exception as exc:
+                results = [exc] * len(batch)
+            self.batches += 1
+            self.queries += len(batch)
+
+            for (_, _, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+
+def load_model(args):
+    """Build the boolean_model to serve from the command-line arguments"""
+    from tree23 import boolean_model
+    if args.index:
+        return boolean_model.load(args.index)
+    model = boolean_model(concurrent=True)
+    documents = {}
+    for name in sorted(os.listdir(args.docs)):
+        with open(os.path.join(args.docs, name), encoding='utf-8') as f:
+            documents[name] = f.read()
+    model.add_documents(documents)
+    return model
+
+
+async def main(args):
+    server = QueryServer(load_model(args), batch_window=args.batch_window / 1000,
+                         max_batch=args.max_batch, max_pending=args.max_pending,
+                         max_inflight=args.max_inflight)
+    await server.start(args.host, args.port, args.unix)
+    where = args.unix or f"{args.host}:{args.port}"
+    print(f"Serving {len(server.model.doc_ids)} documents on {where}")
+    await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve Boolean queries over a line protocol")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--index', help="index file written by boolean_model.save")
+    source.add_argument('--docs', help="directory of text files to index")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8023)
+    parser.add_argument('--unix', help="listen on this Unix socket path instead of TCP")
+    parser.add_argument('--batch-window', type=float, default=2.0, help="milliseconds")
+    parser.add_argument('--max-batch', type=int, default=256)
+    parser.add_argument('--max-pending', type=int, default=1024)
+    parser.add_argument('--max-inflight', type=int, default=64)
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""
+Sharded boolean_model: documents partitioned across worker processes.
+
+A ShardedModel coordinator assigns every document to one of N shards by a
+stable hash of its doc id. Each shard is a ShardWorker process owning an
+ordinary boolean_model (its own 2-3 tree, permuterm and k-gram indexes),
+reached over a multiprocessing Pipe; shards on other machines can be
+served with "shards.py --listen" and attached with ShardedModel.connect.
+
+Queries are scatter-gather: the coordinator sends the query to every
+shard, and each shard evaluates all of it against its own documents.
+A Boolean query decides every document on that document alone, so NOT
+and OR NOT computed against one shard's documents, unioned over shards,
+give exactly the single-model result. Wildcards expand against each
+shard's own vocabulary.
+
+Results stream back in chunks of (sequence number, doc id), where the
+sequence number is the document's global insertion order. Every shard's
+stream is already in that order, so the coordinator merges them with a
+k-way heap merge as they arrive, and results come out in the order one
+boolean_model would return them.
+"""
+
+import argparse
+import heapq
+import multiprocessing
+import threading
+import zlib
+from itertools import islice
+from multiprocessing.connection import Client, Listener
+
+from query import parse_query
+from tree23 import boolean_model
+
+RESULT_CHUNK = 4096  # (sequence, doc id) pairs per result message
+ADD_BATCH = 1000  # Documents per add message
+ADD_WINDOW = 4  # Unacknowledged add messages per shard
+BULK_MIN_DOCS = 64  # Smaller add batches are indexed one document at a time
+
+
+class ShardWorker:
+    """One shard: a boolean_model plus the global sequence numbers of its documents"""
+    def __init__(self, **options):
+        self.model = boolean_model(**options)
+        self.sequence = {}  # doc_id -> global sequence number (the merge key)
+
+    def serve(self, conn):
+        """Answer coordinator requests until it closes the connection"""
+        while True:
+            try:
+                request = conn.recv()
+            except EOFError:
+                return
+            op, args = request[0], request[1:]
+            if op == 'close':
+                conn.send(('ok', None))
+                return
+            try:
+                if op == 'query':
+                    self._stream_query(conn, *args)
+                else:
+                    conn.send(('ok', getattr(self, '_' + op)(*args)))
+            except Exception as error:
+                conn.send(('error', error))
+
+    def _stream_query(self, conn, query, limit):
+        """Send the results in chunks, then an end marker"""
+        sequence = self.sequence
+        results = self.model.iter_query(query)
+        if limit is not None:
+            results = islice(results, limit)
+        chunk = []
+        for doc_id in results:
+            chunk.append((sequence[doc_id], doc_id))
+            if len(chunk) == RESULT_CHUNK:
+                conn.send(('chunk', chunk))
+                chunk = []
+        if chunk:
+            conn.send(('chunk', chunk))
+        conn.send(('done', None))
+
+    def _add(self, documents):
+        """Add (sequence, doc_id, text) triples; small batches skip the bulk-load path"""
+        def indexed():
+            for seq, doc_id, text in documents:
+                # A re-added document keeps its ordinal, so it keeps its place too
+                self.sequence.setdefault(doc_id, seq)
+                yield doc_id, text
+
+        if len(documents) >= BULK_MIN_DOCS:
+            self.model.add_documents(indexed())
+            return
+        for doc_id, text in indexed():
+            self.model.add_document(doc_id, text)
+
+    def _remove(self, doc_id):
+        self.model.remove_document(doc_id)
+        del self.sequence[doc_id]
+
+    def _update(self, seq, doc_id, text):
+        # Like boolean_model.update_document, the new version moves to the end
+        self.model.update_document(doc_id, text)
+        self.sequence[doc_id] = seq
+
+    def _compact(self):
+        self.model.compact()
+
+    def _next_sequence(self):
+        return max(self.sequence.values(), default=-1) + 1
+
+    def _count(self):
+        return len(self.sequence)
+
+    def _stats(self):
+        return self.model.stats()
+
+
+def _run_worker(conn, options):
+    ShardWorker(**options).serve(conn)
+
+
+def shard_of(doc_id, num_shards):
+    """Shard owning doc_id; stable across processes, unlike hash()"""
+    return zlib.crc32(str(doc_id).encode('utf-8')) % num_shards
+
+
+class ShardedModel:
+    """
+    Coordinator for a boolean_model partitioned across shard processes.
+    options (positional, analyzer, doc_store, ...) are passed to every
+    shard's boolean_model. The coordinator handles one request at a time;
+    finish or close iter_query generators before the next request.
+    """
+    def __init__(self, num_shards=None, connections=None, **options):
+        self.workers = []
+        if connections is None:
+            num_shards = num_shards or multiprocessing.cpu_count()
+            connections = []
+            for _ in range(num_shards):
+                parent, child = multiprocessing.Pipe()
+                worker = multiprocessing.Process(target=_run_worker, args=(child, options),
+                                                 daemon=True)
+                worker.start()
+                child.close()
+                connections.append(parent)
+                self.workers.append(worker)
+        self.connections = connections
+        self._lock = threading.RLock()
+        self.next_seq = max(self._broadcast('next_sequence'))
+
+    @classmethod
+    def connect(cls, addresses, authkey):
+        """Coordinator for shards already listening (see main), in shard order"""
+        return cls(connections=[Client(address, authkey=authkey) for address in addresses])
+
+    @property
+    def num_shards(self):
+        return len(self.connections)
+
+    def _reply(self, conn):
+        status, value = conn.recv()
+        if status == 'error':
+            raise value
+        return value
+
+    def _call(self, shard, *request):
+        with self._lock:
+            conn = self.connections[shard]
+            conn.send(request)
+            return self._reply(conn)
+
+    def _broadcast(self, *request):
+        """Send a request to every shard, then gather the replies in shard order"""
+        with self._lock:
+            for conn in self.connections:
+                conn.send(request)
+            return self._gather([(conn, 1) for conn in self.connections])
+
+    def _gather(self, outstanding):
+        """Read the given number of replies per connection; raises the first error after all"""
+        replies, error = [], None
+        for conn, count in outstanding:
+            for _ in range(count):
+                try:
+                    replies.append(self._reply(conn))
+                except Exception as exc:
+                    error = error or exc
+        if error is not None:
+            raise error
+        return replies
+
+    # Writes
+
+    def _sequence(self):
+        seq = self.next_seq
+        self.next_seq += 1
+        return seq
+
+    def add_document(self, doc_id, text):
+        with self._lock:
+            self._call(shard_of(doc_id, self.num_shards), 'add', [(self._sequence(), doc_id, text)])
+
+    def add_documents(self, documents):
+        """
+        Add (doc_id, text) pairs (or a dict), streamed to the shards in
+        batches. Shards index their batches concurrently.
+        """
+        if isinstance(documents, dict):
+            documents = documents.items()
+        with self._lock:
+            batches = [[] for _ in self.connections]
+            outstanding = [0] * self.num_shards
+            try:
+                for doc_id, text in documents:
+                    shard = shard_of(doc_id, self.num_shards)
+                    batch = batches[shard]
+                    batch.append((self._sequence(), doc_id, text))
+                    if len(batch) < ADD_BATCH:
+                        continue
+                    conn = self.connections[shard]
+                    if outstanding[shard] == ADD_WINDOW:
+                        # Keep the reply pipe from filling up
+                        self._gather([(conn, 1)])
+                        outstanding[shard] -= 1
+                    conn.send(('add', batch))
+                    outstanding[shard] += 1
+                    batches[shard] = []
+                for shard, batch in enumerate(batches):
+                    if batch:
+                        self.connections[shard].send(('add', batch))
+                        outstanding[shard] += 1
+            finally:
+                self._gather(list(zip(self.connections, outstanding)))
+
+    def remove_document(self, doc_id):
+        self._call(shard_of(doc_id, self.num_shards), 'remove', doc_id)
+
+    def update_document(self, doc_id, text):
+        with self._lock:
+            self._call(shard_of(doc_id, self.num_shards), 'update', self._sequence(), doc_id, text)
+
+    def compact(self):
+        self._broadcast('compact')
+
+    # Queries
+
+    def iter_query(self, query, limit=None):
+        """
+        Lazily yield matching doc ids in insertion order, merging the
+        shards' result streams; with limit, each shard sends at most that many
+        """
+        parse_query(query)  # Syntax errors fail before any shard is asked
+        with self._lock:
+            for conn in self.connections:
+                conn.send(('query', query, limit))
+            pending = list(self.connections)  # Shards whose end marker is unread
+            streams = [self._stream(conn, pending) for conn in self.connections]
+            try:
+                for _, doc_id in heapq.merge(*streams):
+                    yield doc_id
+            finally:
+                # Never leave a partial stream in a pipe for the next request
+                for conn in pending:
+                    status = 'chunk'
+                    while status == 'chunk':
+                        status, _ = conn.recv()
+
+    def _stream(self, conn, pending):
+        """(sequence, doc_id) pairs from one shard, up to its end marker"""
+        while True:
+            status, value = conn.recv()
+            if status == 'chunk':
+                yield from value
+                continue
+            pending.remove(conn)
+            if status == 'error':
+                raise value
+            return
+
+    def boolean_query(self, query):
+        """Matching doc ids in insertion order (see boolean_model.boolean_query)"""
+        return list(self.iter_query(query))
+
+    def query_page(self, query, offset=0, limit=10):
+        """One page of matching doc ids; no shard sends more than offset + limit"""
+        results = self.iter_query(query, offset + limit)
+        try:
+            return list(islice(results, offset, offset + limit))
+        finally:
+            results.close()
+
+    # Management
+
+    def __len__(self):
+        return sum(self._broadcast('count'))
+
+    def shard_sizes(self):
+        """Documents per shard"""
+        return self._broadcast('count')
+
+    def stats(self):
+        """boolean_model.stats() of every shard"""
+        return self._broadcast('stats')
+
+    def close(self):
+        """Stop the shards (remote ones only drop this connection)"""
+        with self._lock:
+            for conn in self.connections:
+                try:
+                    conn.send(('close',))
+                    conn.recv()
+                except (EOFError, OSError):
+                    pass
+                conn.close()
+            for worker in self.workers:
+                worker.join()
+            self.connections = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve one shard of a ShardedModel")
+    parser.add_argument('--listen', required=True, metavar='HOST:PORT')
+    parser.add_argument('--authkey', required=True,
+                        help="shared secret; requests are pickled, so never expose a shard without one")
+    parser.add_argument('--positional', action='store_true')
+    parser.add_argument('--doc-store', default='memory', choices=['none', 'memory', 'compressed'])
+    args = parser.parse_args()
+
+    host, port = args.listen.rsplit(':', 1)
+    worker = ShardWorker(positional=args.positional, doc_store=args.doc_store)
+    with Listener((host, int(port)), authkey=args.authkey.encode('utf-8')) as listener:
+        print(f"Shard listening on {args.listen}")
+        while True:
+            # The shard's documents outlive any one coordinator connection
+            with listener.accept() as conn:
+                worker.serve(conn)
+
+
+if __name__ == "__main__":
+    main()
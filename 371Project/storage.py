@@ -0,0 +1,414 @@
+"""
+Binary on-disk format for boolean_model, loaded with mmap.
+
+Layout: an 8-byte magic, an 8-byte header length, a JSON header naming
+every section, then the sections themselves (8-byte aligned):
+
+    doc_offsets / doc_blob          doc ids (UTF-8), ordinal order
+    term_offsets / term_blob        sorted term dictionary
+    posting_offsets / postings      uint32 ordinals, one run per term
+    permuterm_buffer / _starts / _offsets
+                                    compact permuterm index (suffix array)
+    gram_offsets / gram_blob / gram_list_offsets / gram_terms
+                                    k-gram index as sorted grams -> term ids
+    doc_lengths / max_tfs / tf_offsets / tf_data / tf_skip_offsets / tf_skips
+                                    ranked mode: per-ordinal lengths, and per
+                                    term the TermFrequencies buffers (ranking.py)
+    position_offsets / position_data
+                                    positional mode: each term's encoded
+                                    PositionalPostings (positions.py)
+
+Offset sections are uint64, ordinal and term-id sections uint32. Loading
+only maps the file; posting lists and term frequencies are read zero-copy
+on demand, so any number of processes can share one page-cached index.
+Document text is not stored.
+"""
+
+import json
+import mmap
+import sys
+from array import array
+
+from analysis import Analyzer
+from instrumentation import distribution, array_bytes
+from positions import PositionalPostings
+from postings import PostingList, intersect
+from ranking import TermFrequencies
+from tree23 import Tree23InvertedIndex, PermutermIndex, KGramIndex, wildcard_regex, boolean_model
+
+MAGIC = b'T23IDX01'
+
+
+def _strings_section(strings):
+    """(offsets, blob) for a list of strings"""
+    offsets = array('Q', [0])
+    blob = bytearray()
+    for string in strings:
+        blob += string.encode('utf-8')
+        offsets.append(len(blob))
+    return offsets, bytes(blob)
+
+
+def save_index(model, path):
+    """Write a boolean_model to path"""
+    terms, posting_offsets, postings = [], array('Q', [0]), array('I')
+    for term, posting_list in model.inverted_index.range_scan():
+        terms.append(term)
+        postings.extend(posting_list)
+        posting_offsets.append(len(postings))
+    term_ids = {term: i for i, term in enumerate(terms)}
+
+    # Compact permuterm index over the sorted vocabulary
+    permuterm = PermutermIndex(compact=True)
+    permuterm.add_terms(terms)
+    permuterm._merge_pending()
+
+    kgram = model.kgram_index
+    grams = sorted(kgram.grams)
+    gram_list_offsets, gram_terms = array('Q', [0]), array('I')
+    for gram in grams:
+        gram_terms.extend(sorted(term_ids[term] for term in kgram.grams[gram]))
+        gram_list_offsets.append(len(gram_terms))
+
+    doc_offsets, doc_blob = _strings_section(list(model.doc_ids))
+    term_offsets, term_blob = _strings_section(terms)
+    gram_offsets, gram_blob = _strings_section(grams)
+    sections = [
+        ('doc_offsets', doc_offsets), ('doc_blob', doc_blob),
+        ('term_offsets', term_offsets), ('term_blob', term_blob),
+        ('posting_offsets', posting_offsets), ('postings', postings),
+        ('permuterm_buffer', permuterm._buffer.encode('utf-8')),
+        ('permuterm_starts', permuterm._term_starts),
+        ('permuterm_offsets', permuterm._offsets),
+        ('gram_offsets', gram_offsets), ('gram_blob', gram_blob),
+        ('gram_list_offsets', gram_list_offsets), ('gram_terms', gram_terms),
+    ]
+    if model.ranked:
+        sections += _ranked_sections(model, terms)
+    if model.positional:
+        position_offsets, position_data = array('Q', [0]), bytearray()
+        for term in terms:
+            position_data += model.positions[term].data
+            position_offsets.append(len(position_data))
+        sections += [('position_offsets', position_offsets), ('position_data', bytes(position_data))]
+
+    # Lay the sections out after the header, 8-byte aligned
+    layout, position = {}, 0
+    for name, data in sections:
+        typecode = data.typecode if isinstance(data, array) else 'B'
+        nbytes = len(data) * (data.itemsize if isinstance(data, array) else 1)
+        layout[name] = [position, nbytes, typecode]
+        position += (nbytes + 7) & ~7
+    header = json.dumps({
+        'byteorder': sys.byteorder,
+        'k': kgram.k,
+        'compact_permuterms': model.permuterm_index.compact,
+        'analyzer': model.analyzer.config(),
+        'ranked': {'total_length': model.total_length,
+                   'min_doc_length': model.min_doc_length} if model.ranked else None,
+        'positional': model.positional,
+        'sections': layout,
+    }).encode('utf-8')
+    header += b' ' * (-len(header) % 8)
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(len(header).to_bytes(8, 'little'))
+        f.write(header)
+        for name, data in sections:
+            raw = data.tobytes() if isinstance(data, array) else data
+            f.write(raw)
+            f.write(b'\0' * (-len(raw) % 8))
+
+
+def _ranked_sections(model, terms):
+    """Sections holding the ranked-mode statistics, per term in term order"""
+    max_tfs, tf_offsets, tf_data = array('I'), array('Q', [0]), bytearray()
+    tf_skip_offsets, tf_skips = array('Q', [0]), array('I')
+    for term in terms:
+        data, skips = model.term_freqs[term].blocks
+        max_tfs.append(model.max_tfs[term])
+        tf_data += data
+        tf_offsets.append(len(tf_data))
+        if skips:
+            tf_skips.extend(skips)
+        tf_skip_offsets.append(len(tf_skips))
+    return [('doc_lengths', array('I', model.doc_lengths)), ('max_tfs', max_tfs),
+            ('tf_offsets', tf_offsets), ('tf_data', bytes(tf_data)),
+            ('tf_skip_offsets', tf_skip_offsets), ('tf_skips', tf_skips)]
+
+
+class MappedStrings:
+    """Read-only sequence of strings stored as offsets + UTF-8 blob"""
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return bytes(self.blob[self.offsets[index]:self.offsets[index + 1]]).decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def nbytes(self):
+        return array_bytes(self.offsets) + len(self.blob)
+
+    def bisect_left(self, string, lo=0):
+        """First index whose string is >= string"""
+        hi = len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[mid] < string:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+class MappedTermTable:
+    """
+    Read-only term -> value mapping over the mapped sorted term dictionary;
+    build(i) makes the value of the i-th term on lookup
+    """
+    def __init__(self, terms, build):
+        self.terms = terms
+        self.build = build
+
+    def get(self, term, default=None):
+        i = self.terms.bisect_left(term)
+        if i < len(self.terms) and self.terms[i] == term:
+            return self.build(i)
+        return default
+
+    def __getitem__(self, term):
+        i = self.terms.bisect_left(term)
+        if i < len(self.terms) and self.terms[i] == term:
+            return self.build(i)
+        raise KeyError(term)
+
+    def __contains__(self, term):
+        i = self.terms.bisect_left(term)
+        return i < len(self.terms) and self.terms[i] == term
+
+    def __len__(self):
+        return len(self.terms)
+
+    def items(self):
+        for i, term in enumerate(self.terms):
+            yield term, self.build(i)
+
+    def values(self):
+        for i in range(len(self.terms)):
+            yield self.build(i)
+
+
+class MappedPostingList(PostingList):
+    """Read-only posting list backed by a slice of the mapped file"""
+    def __init__(self, view):
+        self.ids = view
+        self.bitmap = None
+
+    def add(self, ordinal):
+        raise TypeError("Mapped posting lists are read-only")
+
+
+class MappedInvertedIndex(Tree23InvertedIndex):
+    """Read-only inverted index over the mapped sorted term dictionary"""
+    read_only = True
+
+    def __init__(self, terms, posting_offsets, postings, analyzer=None):
+        super().__init__(analyzer=analyzer)
+        self.terms = terms
+        self.posting_offsets = posting_offsets
+        self.postings = postings
+
+    def _posting_list(self, i):
+        return MappedPostingList(self.postings[self.posting_offsets[i]:self.posting_offsets[i + 1]])
+
+    def search(self, term, trace=None):
+        """Binary search the term dictionary"""
+        if trace is not None:
+            trace.counters['tree_nodes'] += len(self.terms).bit_length()  # Probes
+        i = self.terms.bisect_left(term)
+        if i < len(self.terms) and self.terms[i] == term:
+            return self._posting_list(i)
+        return []
+
+    def range_scan(self, lo=None, hi=None):
+        """Lazily yield (term, posting_list) for lo <= term < hi"""
+        i = 0 if lo is None else self.terms.bisect_left(lo)
+        while i < len(self.terms):
+            term = self.terms[i]
+            if hi is not None and term >= hi:
+                return
+            yield term, self._posting_list(i)
+            i += 1
+
+    def stats(self):
+        """Tree23InvertedIndex.stats for the mapped term dictionary (no tree)"""
+        offsets = self.posting_offsets
+        lengths = [offsets[i + 1] - offsets[i] for i in range(len(self.terms))]
+        return {
+            'terms': len(self.terms), 'nodes': 0, 'leaves': 0, 'height': 0,
+            'postings': len(self.postings), 'dense_terms': 0,
+            'posting_lengths': distribution(lengths),
+            'bytes': {'nodes': 0, 'terms': self.terms.nbytes(),
+                      'postings': array_bytes(self.postings) + array_bytes(offsets)},
+            'mapped': True,
+        }
+
+    def insert(self, term, doc_id):
+        raise TypeError("Mapped indexes are read-only")
+
+    def add_terms(self, doc_id, terms):
+        raise TypeError("Mapped indexes are read-only")
+
+    def bulk_load_terms(self, documents):
+        raise TypeError("Mapped indexes are read-only")
+
+
+class MappedKGramIndex(KGramIndex):
+    """Read-only k-gram index: sorted grams -> sorted term ids"""
+    def __init__(self, k, grams, list_offsets, term_ids, terms):
+        super().__init__(k)
+        self.gram_strings = grams
+        self.list_offsets = list_offsets
+        self.term_ids = term_ids
+        self.vocabulary = terms
+
+    def add_term(self, term):
+        raise TypeError("Mapped indexes are read-only")
+
+    def stats(self):
+        return {'k': self.k, 'terms': len(self.vocabulary), 'grams': len(self.gram_strings),
+                'entries': len(self.term_ids),
+                'bytes': (self.gram_strings.nbytes() + array_bytes(self.list_offsets)
+                          + array_bytes(self.term_ids))}
+
+    def _gram_terms(self, gram):
+        i = self.gram_strings.bisect_left(gram)
+        if i < len(self.gram_strings) and self.gram_strings[i] == gram:
+            return self.term_ids[self.list_offsets[i]:self.list_offsets[i + 1]]
+        return []
+
+    def wildcard_search(self, pattern):
+        """Intersect the gram lists of term ids, then post-filter"""
+        grams = self._pattern_grams(pattern)
+        if grams:
+            lists = sorted((self._gram_terms(gram) for gram in grams), key=len)
+            candidates = lists[0]
+            for term_ids in lists[1:]:
+                candidates = intersect(candidates, term_ids)
+        else:
+            candidates = range(len(self.vocabulary))
+        regex = wildcard_regex(pattern)
+        terms = (self.vocabulary[i] for i in candidates)
+        return sorted(term for term in terms if regex.match(term))
+
+
+class MappedFile:
+    """An open index file and typed views of its sections"""
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.map)
+        if view[:8] != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not an index file")
+        header_length = int.from_bytes(view[8:16], 'little')
+        self.header = json.loads(bytes(view[16:16 + header_length]))
+        if self.header['byteorder'] != sys.byteorder:
+            self.close()
+            raise ValueError(f"{path} was written on a {self.header['byteorder']}-endian machine")
+
+        base = 16 + header_length
+        self.sections = {}
+        for name, (offset, nbytes, typecode) in self.header['sections'].items():
+            section = view[base + offset:base + offset + nbytes]
+            self.sections[name] = section if typecode == 'B' else section.cast(typecode)
+
+    def close(self):
+        # Views into the map must be released before it can close
+        for section in getattr(self, 'sections', {}).values():
+            section.release()
+        self.sections = {}
+        try:
+            self.map.close()
+        except BufferError:
+            pass  # Still referenced by live posting lists; freed with them
+        self.file.close()
+
+
+def load_index(path):
+    """Open a saved index as a read-only, memory-mapped boolean_model"""
+    mapped = MappedFile(path)
+    s = mapped.sections
+    terms = MappedStrings(s['term_offsets'], s['term_blob'])
+
+    # Files written before analyzers were saved used the defaults
+    analyzer = Analyzer(**mapped.header.get('analyzer', {}))
+    ranked = mapped.header.get('ranked')
+    model = boolean_model(compact_permuterms=mapped.header['compact_permuterms'],
+                          analyzer=analyzer, ranked=ranked is not None,
+                          positional=mapped.header.get('positional', False))
+    model.mapped_file = mapped
+    model.doc_ids = MappedStrings(s['doc_offsets'], s['doc_blob'])
+    model.inverted_index = MappedInvertedIndex(terms, s['posting_offsets'], s['postings'],
+                                               analyzer)
+
+    permuterm = PermutermIndex(compact=True)
+    permuterm._buffer = bytes(s['permuterm_buffer']).decode('utf-8')
+    permuterm._term_starts = s['permuterm_starts']
+    permuterm._offsets = s['permuterm_offsets']
+    model.permuterm_index = permuterm
+
+    model.kgram_index = MappedKGramIndex(mapped.header['k'], MappedStrings(s['gram_offsets'], s['gram_blob']),
+                                         s['gram_list_offsets'], s['gram_terms'], terms)
+    if ranked is not None:
+        _load_ranked(model, s, terms, ranked)
+    if model.positional:
+        _load_positions(model, s, terms)
+    return model
+
+
+def _load_ranked(model, s, terms, header):
+    """Ranked-mode statistics over the mapped sections"""
+    model.total_length = header['total_length']
+    model.min_doc_length = header['min_doc_length']
+    model.doc_lengths = s['doc_lengths']
+    model.max_tfs = MappedTermTable(terms, s['max_tfs'].__getitem__)
+    posting_offsets, postings = s['posting_offsets'], s['postings']
+    tf_offsets, tf_data = s['tf_offsets'], s['tf_data']
+    tf_skip_offsets, tf_skips = s['tf_skip_offsets'], s['tf_skips']
+
+    def term_freqs(i):
+        tfs = TermFrequencies()
+        skips = tf_skips[tf_skip_offsets[i]:tf_skip_offsets[i + 1]]
+        tfs.blocks = (tf_data[tf_offsets[i]:tf_offsets[i + 1]], skips if len(skips) else None)
+        # Saved compacted: the entries are exactly the term's postings
+        tfs.last_doc = postings[posting_offsets[i + 1] - 1]
+        tfs.count = posting_offsets[i + 1] - posting_offsets[i]
+        return tfs
+    model.term_freqs = MappedTermTable(terms, term_freqs)
+
+
+def _load_positions(model, s, terms):
+    """Positional postings over the mapped sections"""
+    posting_offsets, postings = s['posting_offsets'], s['postings']
+    position_offsets, position_data = s['position_offsets'], s['position_data']
+
+    def positions(i):
+        term_positions = PositionalPostings()
+        term_positions.data = position_data[position_offsets[i]:position_offsets[i + 1]]
+        # Saved compacted: the entries are exactly the term's postings
+        term_positions.last_doc = postings[posting_offsets[i + 1] - 1]
+        return term_positions
+    model.positions = MappedTermTable(terms, positions)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Document stores: the same operations against every store and a dict,
+CompressedStore and DiskStore compaction, DiskStore reopen and recovery
+from a truncated record, and boolean_model's use of a store.
+
+Run with: python -m unittest test_docstore
+"""
+
+import os
+import random
+import tempfile
+import unittest
+
+from docstore import CompressedStore, DiskStore, MemoryStore, NullStore
+from tree23 import boolean_model
+
+
+class StoreTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'docs.log')
+
+    def disk_store(self):
+        store = DiskStore(self.path)
+        self.addCleanup(store.close)
+        return store
+
+    def run_random(self, store, steps=2000):
+        """Random sets, replacements and pops, checked against a dict; returns the dict"""
+        rng = random.Random(4)
+        expected = {}
+        for step in range(steps):
+            doc_id = 'd%d' % rng.randrange(300)
+            if rng.random() < 0.7:
+                text = ''.join(rng.choice('abcé ') for _ in range(rng.randint(0, 300)))
+                store[doc_id] = text
+                expected[doc_id] = text
+            else:
+                self.assertEqual(store.pop(doc_id, None), expected.pop(doc_id, None), step)
+            if step % 500 == 499:
+                store.compact()
+            self.assertEqual(len(store), len(expected))
+        for doc_id in ['d%d' % i for i in range(300)]:
+            self.assertEqual(store.get(doc_id), expected.get(doc_id))
+            self.assertEqual(doc_id in store, doc_id in expected)
+        return expected
+
+    def test_memory(self):
+        self.run_random(MemoryStore())
+
+    def test_compressed(self):
+        self.run_random(CompressedStore(block_size=1000))
+
+    def test_compressed_compact(self):
+        store = CompressedStore(block_size=100)
+        store['a'] = 'é' * 80
+        store['b'] = 'hello'
+        store['c'] = 'x' * 200
+        store['a'] = 'new'
+        self.assertEqual(store.pop('b'), 'hello')
+        self.assertGreater(store.dead_bytes, 0)
+        before = store.nbytes()
+        store.compact()
+        self.assertEqual(store.dead_bytes, 0)
+        self.assertLess(store.nbytes(), before)
+        self.assertEqual((store.get('a'), store.get('b'), store.get('c')), ('new', None, 'x' * 200))
+        store['d'] = 'after'
+        self.assertEqual(store.get('d'), 'after')
+        self.assertEqual(len(store), 3)
+
+    def test_disk(self):
+        self.run_random(self.disk_store())
+
+    def test_disk_reopen(self):
+        store = DiskStore(self.path)
+        expected = self.run_random(store)
+        store.pop('d0')
+        expected.pop('d0', None)
+        store['d1'] = 'replaced'
+        expected['d1'] = 'replaced'
+        store.close()
+
+        store = self.disk_store()
+        self.assertEqual(len(store), len(expected))
+        for doc_id, text in expected.items():
+            self.assertEqual(store.get(doc_id), text)
+        self.assertNotIn('d0', store)
+        self.assertGreater(store.dead_bytes, 0)  # The replaced and removed records
+        store.compact()
+        self.assertEqual(store.nbytes(), os.path.getsize(self.path))
+        store.close()
+
+        store = self.disk_store()
+        self.assertEqual(store.dead_bytes, 0)
+        self.assertEqual({doc_id: store.get(doc_id) for doc_id in expected}, expected)
+
+    def test_disk_truncated_record(self):
+        store = DiskStore(self.path)
+        store['a'] = 'first'
+        store['b'] = 'second'
+        store.pop('a')
+        store.close()
+        intact = os.path.getsize(self.path)
+        for torn in [b'\x05\x00\x00', b'\x01\x00\x00\x00\x09\x00\x00\x00cpart']:
+            with open(self.path, 'ab') as f:
+                f.write(torn)  # A write cut short by a crash
+            store = DiskStore(self.path)
+            self.assertEqual(os.path.getsize(self.path), intact)
+            self.assertEqual((store.get('a'), store.get('b'), len(store)), (None, 'second', 1))
+            store.close()
+
+        store = self.disk_store()
+        store['c'] = 'third'
+        store.close()
+        store = self.disk_store()
+        self.assertEqual((store.get('b'), store.get('c')), ('second', 'third'))
+
+    def test_null(self):
+        store = NullStore()
+        store['a'] = 'text'
+        self.assertIsNone(store.get('a'))
+        self.assertIsNone(store.pop('a'))
+
+
+class ModelStoreTest(unittest.TestCase):
+    def test_stores(self):
+        rng = random.Random(5)
+        words = ['w' + ''.join(rng.choice('abcdefgh') for _ in range(5)) for _ in range(100)]
+        docs = {'d%d' % i: ' '.join(rng.choice(words) for _ in range(rng.randint(5, 50)))
+                for i in range(300)}
+        with tempfile.TemporaryDirectory() as directory:
+            for store in ['memory', 'none', 'compressed', DiskStore(os.path.join(directory, 'log'))]:
+                model = boolean_model(doc_store=store)
+                model.add_documents(list(docs.items())[:150])
+                for doc_id, text in list(docs.items())[150:]:
+                    model.add_document(doc_id, text)
+                keep = store != 'none'
+                for doc_id in rng.sample(list(docs), 20):
+                    self.assertEqual(model.get_document(doc_id), docs[doc_id] if keep else None)
+
+                model.update_document('d1', 'replaced text')
+                hits = model.boolean_query(words[0])
+                model.remove_document(hits[0])
+                model.compact()
+                self.assertIsNone(model.get_document(hits[0]))
+                self.assertEqual(model.get_document('d1'), 'replaced text' if keep else None)
+                self.assertEqual(len(list(model.fetch_documents(model.boolean_query(words[0])))),
+                                 len(hits) - 1)
+                model.documents.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
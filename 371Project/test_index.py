@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""
+Randomized tests: 2-3 tree invariants under insert/delete, and
+boolean_model query results against a brute-force oracle under
+add/remove/update/compact (plain, concurrent, segmented and dense).
+
+Run with: python -m unittest test_index
+"""
+
+import random
+import re
+import unittest
+from unittest import mock
+
+from tree23 import PENDING_ROTATIONS, PermutermIndex, Tree23InvertedIndex, boolean_model
+
+WORDS = [a + b + c for a in 'xyz' for b in 'pqr' for c in 'kmn']
+
+
+def check_tree(test, index):
+    """Assert the 2-3 tree invariants; returns the terms in order"""
+    leaf_depths = set()
+    terms = []
+
+    def visit(node, depth, lo, hi):
+        test.assertIn(len(node.keys), (1, 2))
+        test.assertEqual(len(node.posting_lists), len(node.keys))
+        test.assertEqual(node.keys, sorted(set(node.keys)))
+        for key in node.keys:
+            test.assertTrue(lo is None or key > lo)
+            test.assertTrue(hi is None or key < hi)
+        if node.is_leaf():
+            leaf_depths.add(depth)
+            terms.extend(node.keys)
+            return
+        test.assertEqual(len(node.children), len(node.keys) + 1)
+        bounds = [lo] + node.keys + [hi]
+        for i, child in enumerate(node.children):
+            visit(child, depth + 1, bounds[i], bounds[i + 1])
+            if i < len(node.keys):
+                terms.append(node.keys[i])
+
+    if index.root.keys:
+        visit(index.root, 0, None, None)
+        test.assertEqual(len(leaf_depths), 1)
+    else:
+        test.assertEqual(index.root.children, [])
+    test.assertEqual(terms, sorted(terms))
+    return terms
+
+
+class TreeInvariantTest(unittest.TestCase):
+    def run_random(self, copy_on_write):
+        rng = random.Random(7)
+        index = Tree23InvertedIndex(copy_on_write)
+        expected = {}  # term -> set of doc ids
+        for step in range(3000):
+            term = 't%03d' % rng.randrange(400)
+            if rng.random() < 0.6:
+                doc_id = rng.randrange(50)
+                index.insert(term, doc_id)
+                expected.setdefault(term, set()).add(doc_id)
+            else:
+                self.assertEqual(index.delete(term), term in expected)
+                expected.pop(term, None)
+            if copy_on_write and step % 100 == 0:
+                index.snapshot()
+            if step % 50 == 0:
+                self.assertEqual(check_tree(self, index), sorted(expected))
+        self.assertEqual(check_tree(self, index), sorted(expected))
+        self.assertEqual(index.num_terms, len(expected))
+        for term, doc_ids in expected.items():
+            self.assertEqual(list(index.search(term)), sorted(doc_ids))
+
+    def test_insert_delete(self):
+        self.run_random(copy_on_write=False)
+
+    def test_insert_delete_copy_on_write(self):
+        self.run_random(copy_on_write=True)
+
+    def test_bulk_load(self):
+        for size in range(0, 60):
+            index = Tree23InvertedIndex()
+            index.merge_segments([[('t%03d' % i, [i]) for i in range(size)]])
+            self.assertEqual(check_tree(self, index), ['t%03d' % i for i in range(size)])
+
+    def test_merge_in_place(self):
+        # Small batches are inserted into the existing tree, large ones rebuild it
+        rng = random.Random(3)
+        for copy_on_write in (False, True):
+            index = Tree23InvertedIndex(copy_on_write)
+            expected = {}
+            for batch in range(40):
+                terms = rng.sample(range(2000), rng.choice([3, 30, 600]))
+                segment = sorted(('t%04d' % t, sorted(rng.sample(range(batch * 10, batch * 10 + 10),
+                                                                rng.randint(1, 3))))
+                                 for t in terms)
+                index.merge_segments([segment])
+                for term, doc_ids in segment:
+                    expected.setdefault(term, []).extend(doc_ids)
+                if copy_on_write:
+                    index.snapshot()
+                self.assertEqual(check_tree(self, index), sorted(expected))
+                self.assertEqual(index.num_terms, len(expected))
+            for term, doc_ids in expected.items():
+                self.assertEqual(list(index.search(term)), doc_ids)
+
+
+class PermutermTest(unittest.TestCase):
+    PATTERNS = ['ab*', '*cd', 'a*f', '*bc*', 'a*b*c', '*e*a', 'fa*', '*']
+
+    def check(self, index, vocabulary, rng):
+        terms = sorted(vocabulary)
+        for pattern in self.PATTERNS + [rng.choice(terms), rng.choice(terms) + 'x']:
+            regex = re.compile(pattern.replace('*', '.*'))
+            self.assertEqual(index.wildcard_search(pattern),
+                             [term for term in terms if regex.fullmatch(term)], pattern)
+
+    def test_compact_folds(self):
+        # Enough rotations to fold the pending run into the suffix array many times,
+        # incrementally once the array is over 16x the pending run
+        rng = random.Random(5)
+        index = PermutermIndex(compact=True)
+        folds, rebuilds, bisects = [], [], []
+        fold, build, bisect = index._fold_compact, index._build_compact, index._bisect_offsets
+
+        def counted(calls, function):
+            def call(*args):
+                calls.append(args)
+                return function(*args)
+            return call
+
+        index._fold_compact = counted(folds, fold)
+        index._build_compact = counted(rebuilds, build)
+        index._bisect_offsets = counted(bisects, bisect)
+
+        vocabulary = set()
+        while len(vocabulary) < 12000:
+            batch = [''.join(rng.choice('abcdef') for _ in range(rng.randint(3, 9)))
+                     for _ in range(rng.randint(1, 40))]
+            index.add_terms(batch)
+            vocabulary.update(batch)
+            if rng.random() < 0.01:
+                self.check(index, vocabulary, rng)
+        self.check(index, vocabulary, rng)
+        rotations = sum(len(term) + 1 for term in vocabulary)
+        self.assertGreater(rotations, 16 * PENDING_ROTATIONS)
+        self.assertGreater(len(folds), 10)
+        self.assertLess(len(rebuilds), len(folds))  # Most folds merged in place
+        self.assertTrue(any(len(args) > 1 and args[1] for args in bisects))  # Resumed from lo
+
+        # A batch large relative to the index takes the full-rebuild branch
+        rebuilds.clear()
+        batch = [''.join(rng.choice('abcdefg') for _ in range(rng.randint(6, 12)))
+                 for _ in range(12000)]
+        index.add_terms(batch)
+        vocabulary.update(batch)
+        self.assertEqual(len(rebuilds), 1)
+        self.check(index, vocabulary, rng)
+
+        removed = set(rng.sample(sorted(vocabulary), 500))
+        index.remove_terms(removed)
+        vocabulary -= removed
+        self.check(index, vocabulary, rng)
+        self.assertEqual([term for _, term in index.rotations()
+                          if term in removed], [])
+
+
+def oracle(docs, query):
+    """Brute-force result of the simple query forms used below"""
+    def has(doc_id, word):
+        if '*' in word:
+            regex = re.compile(word.replace('*', '.*'))
+            return any(regex.fullmatch(term) for term in docs[doc_id].split())
+        return word in docs[doc_id].split()
+
+    tokens = query.split()
+    if tokens[0] == 'NOT':
+        return [d for d in docs if not has(d, tokens[1])]
+    if len(tokens) == 1:
+        return [d for d in docs if has(d, tokens[0])]
+    if tokens[1:3] == ['AND', 'NOT']:
+        return [d for d in docs if has(d, tokens[0]) and not has(d, tokens[3])]
+    if tokens[1] == 'AND':
+        return [d for d in docs if has(d, tokens[0]) and has(d, tokens[2])]
+    return [d for d in docs if has(d, tokens[0]) or has(d, tokens[2])]
+
+
+class ModelOracleTest(unittest.TestCase):
+    def run_random(self, steps=400, **options):
+        rng = random.Random(11)
+        model = boolean_model(**options)
+        if options.get('segment_docs'):
+            model.inverted_index.background = False
+        docs = {}  # doc_id -> text, in result order
+        next_doc = 0
+
+        def text():
+            return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 8)))
+
+        for step in range(steps):
+            r = rng.random()
+            if r < 0.4 or not docs:
+                doc_id = 'd%d' % next_doc
+                next_doc += 1
+                docs[doc_id] = text()
+                model.add_document(doc_id, docs[doc_id])
+            elif r < 0.5:
+                batch = [('d%d' % (next_doc + i), text()) for i in range(rng.randint(1, 20))]
+                next_doc += len(batch)
+                docs.update(batch)
+                model.add_documents(batch)
+            elif r < 0.65:
+                doc_id = rng.choice(list(docs))
+                model.remove_document(doc_id)
+                del docs[doc_id]
+            elif r < 0.8:
+                doc_id = rng.choice(list(docs))
+                del docs[doc_id]  # The new version moves to the end
+                docs[doc_id] = text()
+                model.update_document(doc_id, docs[doc_id])
+            elif r < 0.83:
+                model.compact()
+
+            a, b = rng.sample(WORDS, 2)
+            for query in [a, f'{a} AND {b}', f'{a} OR {b}', f'{a} AND NOT {b}',
+                          f'NOT {a}', 'xp*', '*n', 'y*k']:
+                self.assertEqual(model.boolean_query(query), oracle(docs, query),
+                                 (step, query))
+            expected = oracle(docs, f'NOT {a}')
+            self.assertEqual(model.query_page(f'NOT {a}', 2, 3), expected[2:5])
+            self.assertEqual(model.all_doc_ids, set(docs))
+
+        model.compact()
+        live = {term for text in docs.values() for term in text.split()}
+        self.assertEqual({term for term, _ in model.inverted_index.range_scan()}, live)
+        self.assertEqual(set(model.kgram_index.terms), live)
+        self.assertEqual({term for _, term in model.permuterm_index.rotations()}, live)
+        self.assertEqual(model.doc_ids, list(docs))
+        if not options.get('segment_docs'):
+            check_tree(self, model.inverted_index)
+        return model
+
+    def test_plain(self):
+        self.run_random()
+
+    def test_compact_permuterms(self):
+        self.run_random(compact_permuterms=True)
+
+    def test_concurrent(self):
+        self.run_random(concurrent=True)
+
+    def test_segmented(self):
+        self.run_random(segment_docs=16)
+
+    def test_segmented_concurrent(self):
+        self.run_random(segment_docs=16, concurrent=True)
+
+    def test_dense(self):
+        with mock.patch('postings.DENSE_MIN_LENGTH', 4):
+            self.run_random()
+            self.run_random(segment_docs=16)
+
+    def test_concurrent_compact_isolation(self):
+        model = boolean_model(concurrent=True, ranked=True, positional=True)
+        for i in range(6):
+            model.add_document('d%d' % i, 'alpha beta gamma' if i % 2 else 'beta gamma')
+        model.remove_document('d0')
+        model.remove_document('d1')
+        expected_ranked = model.ranked_query('gamma')
+        expected_phrase = model.boolean_query('"beta gamma"')
+        seen = []
+        remove_terms = model.permuterm_index.remove_terms
+
+        def query_midway(terms):
+            # compact() has renumbered everything but not yet published
+            seen.append((model.ranked_query('gamma'), model.boolean_query('"beta gamma"')))
+            remove_terms(terms)
+
+        model.permuterm_index.remove_terms = query_midway
+        model.compact()
+        self.assertEqual(seen, [(expected_ranked, expected_phrase)])
+        self.assertEqual(expected_phrase, ['d2', 'd3', 'd4', 'd5'])
+        self.assertEqual(model.ranked_query('gamma'), expected_ranked)
+        self.assertEqual(model.boolean_query('"beta gamma"'), expected_phrase)
+
+    def test_readd_in_batch(self):
+        model = boolean_model()
+        model.add_documents([('a', 'alpha'), ('a', 'alpha beta')])
+        self.assertEqual(model.boolean_query('alpha'), ['a'])
+
+        model = boolean_model()
+        model.add_document('x', 'alpha')
+        model.add_document('y', 'beta')
+        model.add_documents([('y', 'gamma'), ('x', 'gamma')])
+        self.assertEqual(list(model.inverted_index.search('gamma')), [0, 1])
+        self.assertEqual(model.boolean_query('gamma'), ['x', 'y'])
+
+
+if __name__ == '__main__':
+    unittest.main()
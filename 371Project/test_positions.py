@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Phrase and NEAR/k queries against a brute-force scan of each document's
+tokens, under add/remove/update/compact.
+
+Run with: python -m unittest test_positions
+"""
+
+import random
+import re
+import unittest
+from unittest import mock
+
+from query import QuerySyntaxError
+from tree23 import boolean_model
+
+WORDS = ['alpha', 'beta', 'gamma', 'delta', 'the', 'a', 'eps', 'zeta']
+STOP = {'the', 'a'}  # Dropped by the default analyzer, but they still take a position
+
+
+def phrase_spans(text, phrase):
+    """(first, last) token positions of each occurrence of a phrase"""
+    tokens = text.split()
+    words = [(offset, word) for offset, word in enumerate(phrase.split()) if word not in STOP]
+    first = words[0][0]
+    length = words[-1][0] - first + 1
+    return [(start, start + length - 1) for start in range(len(tokens))
+            if all(start + offset - first < len(tokens)
+                   and tokens[start + offset - first] == word for offset, word in words)]
+
+
+def spans(text, operand):
+    """Token spans of a NEAR operand: a quoted phrase, a term or a wildcard"""
+    if operand.startswith('"'):
+        return phrase_spans(text, operand.strip('"'))
+    regex = re.compile(operand.replace('*', '.*'))
+    return [(i, i) for i, word in enumerate(text.split())
+            if regex.fullmatch(word) and word not in STOP]
+
+
+def near(text, left, right, k):
+    """Whether some span of left and span of right are at most k positions apart"""
+    return any((b[0] - a[1] if a[0] <= b[0] else a[0] - b[1]) <= k
+               for a in spans(text, left) for b in spans(text, right))
+
+
+class PositionalOracleTest(unittest.TestCase):
+    def run_random(self, steps=300, **options):
+        rng = random.Random(2)
+        model = boolean_model(positional=True, **options)
+        if options.get('segment_docs'):
+            model.inverted_index.background = False
+        docs = {}
+        next_doc = 0
+        content = [word for word in WORDS if word not in STOP]
+
+        def text():
+            return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 15)))
+
+        for step in range(steps):
+            r = rng.random()
+            if r < 0.6 or len(docs) < 3:
+                doc_id = 'd%d' % next_doc
+                next_doc += 1
+                docs[doc_id] = text()
+                model.add_document(doc_id, docs[doc_id])
+            elif r < 0.7:
+                doc_id = rng.choice(list(docs))
+                model.remove_document(doc_id)
+                del docs[doc_id]
+            elif r < 0.8:
+                doc_id = rng.choice(list(docs))
+                del docs[doc_id]
+                docs[doc_id] = text()
+                model.update_document(doc_id, docs[doc_id])
+            elif r < 0.83:
+                model.compact()
+            else:
+                batch = [('b%d' % (next_doc + i), text()) for i in range(4)]
+                next_doc += len(batch)
+                docs.update(batch)
+                model.add_documents(batch)
+
+            a, b, c = rng.sample(content, 3)
+            phrase = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 3)))
+            if all(word in STOP for word in phrase.split()):
+                phrase = a + ' ' + phrase
+            k = rng.randint(0, 4)
+            right = rng.choice([b, f'"{b} {a}"', b[0] + '*'])
+            cases = [(f'"{phrase}"', lambda text: bool(phrase_spans(text, phrase))),
+                     (f'{a} NEAR/{k} {right}', lambda text: near(text, a, right, k)),
+                     (f'"{a} {b}" AND NOT {c}',
+                      lambda text: bool(phrase_spans(text, f'{a} {b}')) and c not in text.split()),
+                     (f'NOT "{a} {b}"', lambda text: not phrase_spans(text, f'{a} {b}'))]
+            for query, matches in cases:
+                self.assertEqual(model.boolean_query(query),
+                                 [doc_id for doc_id, text in docs.items() if matches(text)],
+                                 (step, query))
+
+    def test_plain(self):
+        self.run_random()
+
+    def test_concurrent(self):
+        self.run_random(concurrent=True)
+
+    def test_segmented(self):
+        self.run_random(segment_docs=16)
+
+    def test_dense(self):
+        with mock.patch('postings.DENSE_MIN_LENGTH', 4):
+            self.run_random()
+
+    def test_needs_positions(self):
+        model = boolean_model()
+        model.add_document('d0', 'alpha beta')
+        with self.assertRaises(QuerySyntaxError):
+            model.boolean_query('"alpha beta"')
+
+
+if __name__ == '__main__':
+    unittest.main()
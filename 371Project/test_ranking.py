@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Ranked retrieval: WAND top-k results against exhaustive BM25 scoring of
+every live document, under add/remove/update/compact.
+
+Run with: python -m unittest test_ranking
+"""
+
+import random
+import re
+import unittest
+from collections import Counter
+from unittest import mock
+
+from ranking import idf, term_weight
+from tree23 import boolean_model
+
+WORDS = [a + b + c for a in 'xyz' for b in 'pqr' for c in 'km']
+
+
+def exhaustive(docs, terms, k, accept=lambda text: True):
+    """The k best (doc_id, score) pairs, scoring every document that has a query term"""
+    counts = {doc_id: Counter(text.split()) for doc_id, text in docs.items()}
+    num_docs = len(docs)
+    avg_length = sum(sum(c.values()) for c in counts.values()) / num_docs or 1
+    expanded = {word for term in terms for word in WORDS
+                if re.fullmatch(term.replace('*', '.*'), word)}
+    doc_freqs = {term: sum(1 for c in counts.values() if c[term]) for term in expanded}
+    scored = []
+    for order, (doc_id, c) in enumerate(counts.items()):
+        matched = [term for term in expanded if c[term]]
+        if not matched or not accept(docs[doc_id]):
+            continue
+        length = sum(c.values())
+        score = sum(idf(num_docs, doc_freqs[term]) * term_weight(c[term], length, avg_length)
+                    for term in matched)
+        scored.append((-score, order, doc_id))
+    scored.sort()
+    return [(doc_id, -score) for score, _, doc_id in scored[:k]]
+
+
+class RankedOracleTest(unittest.TestCase):
+    def assert_ranked(self, got, docs, terms, k, accept=lambda text: True, msg=None):
+        # Equal scores may tie-break differently after float summation, so
+        # compare the score sequence, then each result's own exhaustive score
+        expected = exhaustive(docs, terms, k, accept)
+        self.assertEqual(len(got), len(expected), msg)
+        for (_, got_score), (_, expected_score) in zip(got, expected):
+            self.assertAlmostEqual(got_score, expected_score, 9, msg)
+        scores = dict(exhaustive(docs, terms, len(docs), accept))
+        for doc_id, score in got:
+            self.assertAlmostEqual(score, scores[doc_id], 9, msg)
+
+    def run_random(self, steps=300, **options):
+        rng = random.Random(3)
+        model = boolean_model(ranked=True, **options)
+        if options.get('segment_docs'):
+            model.inverted_index.background = False
+        docs = {}
+        next_doc = 0
+
+        def text():
+            return ' '.join(rng.choice(WORDS[:rng.randint(3, len(WORDS))])
+                            for _ in range(rng.randint(1, 12)))
+
+        for step in range(steps):
+            r = rng.random()
+            if r < 0.6 or len(docs) < 3:
+                doc_id = 'd%d' % next_doc
+                next_doc += 1
+                docs[doc_id] = text()
+                model.add_document(doc_id, docs[doc_id])
+            elif r < 0.7:
+                doc_id = rng.choice(list(docs))
+                model.remove_document(doc_id)
+                del docs[doc_id]
+            elif r < 0.8:
+                doc_id = rng.choice(list(docs))
+                del docs[doc_id]
+                docs[doc_id] = text()
+                model.update_document(doc_id, docs[doc_id])
+            elif r < 0.83:
+                model.compact()
+            else:
+                batch = [('b%d' % (next_doc + i), text()) for i in range(4)]
+                next_doc += len(batch)
+                docs.update(batch)
+                model.add_documents(batch)
+            if step % 3:
+                continue
+
+            a, b, c = rng.sample(WORDS, 3)
+            k = rng.choice([1, 3, 10])
+            cases = [(f'{a} OR {b} OR {c}', [a, b, c], lambda text: True),
+                     (a, [a], lambda text: True),
+                     (f'{a[0]}p*', [a[0] + 'p*'], lambda text: True),
+                     (f'({a} OR {b}) AND NOT {c}', [a, b], lambda text: c not in text.split()),
+                     (f'{a} AND {b}', [a, b],
+                      lambda text: a in text.split() and b in text.split())]
+            for query, terms, accept in cases:
+                self.assert_ranked(model.ranked_query(query, k), docs, terms, k, accept,
+                                   (step, query))
+
+    def test_plain(self):
+        self.run_random()
+
+    def test_concurrent(self):
+        self.run_random(concurrent=True)
+
+    def test_segmented(self):
+        self.run_random(segment_docs=16)
+
+    def test_dense(self):
+        with mock.patch('postings.DENSE_MIN_LENGTH', 4):
+            self.run_random()
+
+    def test_long_lists(self):
+        # Enough postings per term to cross TF_BLOCK skips and let WAND prune
+        rng = random.Random(8)
+        model = boolean_model(ranked=True)
+        docs = {'d%d' % i: ' '.join(rng.choice(WORDS[:rng.randint(2, len(WORDS))])
+                                     for _ in range(rng.randint(1, 60)))
+                for i in range(1500)}
+        model.add_documents(list(docs.items()))
+        for query, terms in [('xpk', ['xpk']), ('xpk OR zrm', ['xpk', 'zrm']),
+                             ('xpk OR yqm OR zrm OR xqk', ['xpk', 'yqm', 'zrm', 'xqk'])]:
+            for k in (1, 10, 50):
+                self.assert_ranked(model.ranked_query(query, k), docs, terms, k, msg=query)
+
+    def test_unranked_model(self):
+        model = boolean_model()
+        model.add_document('d0', 'xpk')
+        with self.assertRaises(ValueError):
+            model.ranked_query('xpk')
+
+
+if __name__ == '__main__':
+    unittest.main()
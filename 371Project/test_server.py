@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+QueryServer over TCP on an ephemeral port: line and JSON responses,
+paging, malformed requests and batching of concurrent clients.
+
+Run with: python -m unittest test_server
+"""
+
+import asyncio
+import json
+import random
+import unittest
+
+from server import QueryServer
+from tree23 import boolean_model
+
+WORDS = ['alpha', 'beta', 'gamma', 'delta', 'eps', 'zeta']
+QUERIES = ['alpha', 'alpha AND NOT beta', 'NOT gamma', 'be*', '(alpha OR zeta) AND eps',
+           'alpha XOR beta']
+
+
+class QueryServerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        rng = random.Random(0)
+        self.model = boolean_model(concurrent=True)
+        self.model.add_documents({'d%d' % i: ' '.join(rng.choice(WORDS) for _ in range(4))
+                                  for i in range(300)})
+        self.server = QueryServer(self.model, max_pending=32, max_inflight=8, max_line=1024)
+        await self.server.start(port=0)
+        self.addAsyncCleanup(self.server.close)
+        self.port = self.server.server.sockets[0].getsockname()[1]
+
+    async def exchange(self, lines):
+        """Send request lines pipelined; returns the response lines"""
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        writer.write(''.join(line + '\n' for line in lines).encode('utf-8'))
+        writer.write_eof()
+        responses = (await reader.read()).decode('utf-8').splitlines()
+        # The server closes the connection after the last response
+        writer.close()
+        await writer.wait_closed()
+        return responses
+
+    async def test_line_protocol(self):
+        responses = await self.exchange(QUERIES + ['( alpha', 'alpha AND', 'nothing'])
+        for query, response in zip(QUERIES, responses):
+            self.assertEqual(response, 'OK ' + ' '.join(self.model.boolean_query(query)))
+        self.assertTrue(responses[-3].startswith('ERR '))
+        self.assertTrue(responses[-2].startswith('ERR '))
+        self.assertEqual(responses[-1], 'OK ')
+
+    async def test_json(self):
+        requests = [{'id': 1, 'query': 'NOT gamma'},
+                    {'id': 2, 'query': 'NOT gamma', 'offset': 10, 'limit': 5},
+                    {'id': 'x', 'query': 'alpha', 'limit': 0},
+                    {'id': 4, 'query': 'alpha', 'offset': 10000},
+                    {'query': 'be*', 'offset': 3},
+                    {'id': 6, 'query': '( alpha'}]
+        responses = [json.loads(line) for line in
+                     await self.exchange([json.dumps(request) for request in requests])]
+        for request, response in zip(requests[:5], responses):
+            full = self.model.boolean_query(request['query'])
+            offset = request.get('offset', 0)
+            limit = request.get('limit')
+            end = None if limit is None else offset + limit
+            self.assertEqual(response, {'id': request.get('id'), 'total': len(full),
+                                        'results': full[offset:end]})
+        self.assertEqual(responses[-1]['id'], 6)
+        self.assertIn('error', responses[-1])
+
+    async def test_bad_json(self):
+        lines = ['{"id": 1, "query": ', '{"id": 2}', '{"id": 3, "query": 5}', '{"query"}',
+                 '{"id": 4, "query": "alpha", "limit": -1}',
+                 '{"id": 5, "query": "alpha", "offset": "2"}',
+                 '{"id": 6, "query": "alpha", "limit": 2}']
+        responses = [json.loads(line) for line in await self.exchange(lines)]
+        self.assertEqual(responses[0], {'id': None, 'error': 'Malformed JSON request'})
+        for response in responses[1:-1]:
+            self.assertIn('error', response)
+            self.assertNotIn('results', response)
+        self.assertEqual(responses[-1]['results'], self.model.boolean_query('alpha')[:2])
+
+    async def test_long_line(self):
+        responses = await self.exchange(['a' * 2000, 'alpha'])
+        self.assertEqual(len(responses), 1)  # The connection is dropped
+        self.assertTrue(responses[0].startswith('ERR Line longer than'))
+
+    async def test_concurrent_clients(self):
+        async def client(i):
+            lines = [QUERIES[(i + k) % len(QUERIES)] for k in range(20)]
+            responses = await self.exchange(lines)
+            return [response == 'OK ' + ' '.join(self.model.boolean_query(query))
+                    for query, response in zip(lines, responses)]
+
+        results = await asyncio.gather(*(client(i) for i in range(50)))
+        self.assertTrue(all(all(ok) for ok in results))
+        self.assertEqual(self.server.queries, 1000)
+        self.assertLess(self.server.batches, self.server.queries)
+
+
+if __name__ == '__main__':
+    unittest.main()
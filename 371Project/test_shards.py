@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Sharded model: ShardedModel results against a single boolean_model
+holding the same documents, under add/remove/update/compact.
+
+Run with: python -m unittest test_shards
+"""
+
+import random
+import unittest
+
+from query import QuerySyntaxError
+from shards import ShardedModel, shard_of
+from tree23 import boolean_model
+
+WORDS = 'apple banana cherry date elder fig grape honey iris jade kiwi lemon mango'.split()
+QUERIES = ['apple', 'NOT apple', 'apple OR NOT banana', 'apple AND banana', 'NOT (apple OR cherry)',
+           'ap*', '*ana', 'm*go AND NOT kiwi', 'apple XOR fig', '"apple banana"', 'apple NEAR/2 fig',
+           'zzz', 'NOT zzz']
+
+
+class ShardedModelTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(5)
+        self.single = boolean_model(positional=True)
+        self.sharded = ShardedModel(3, positional=True)
+        self.addCleanup(self.sharded.close)
+        self.next_doc = 0
+
+    def text(self):
+        return ' '.join(self.rng.choice(WORDS) for _ in range(self.rng.randint(1, 12)))
+
+    def batch(self, size):
+        batch = [('d%d' % (self.next_doc + i), self.text()) for i in range(size)]
+        self.next_doc += size
+        return batch
+
+    def assert_same(self, step=None):
+        for query in QUERIES:
+            self.assertEqual(self.sharded.boolean_query(query), self.single.boolean_query(query),
+                             (step, query))
+            self.assertEqual(self.sharded.query_page(query, 7, 20),
+                             self.single.query_page(query, 7, 20), (step, query))
+        self.assertEqual(len(self.sharded), len(self.single.doc_ids) - len(self.single.tombstones))
+
+    def test_random(self):
+        # Batches above and below BULK_MIN_DOCS and above ADD_BATCH
+        batch = self.batch(2500)
+        self.single.add_documents(batch)
+        self.sharded.add_documents(iter(batch))
+        self.assert_same()
+        doc_ids = [doc_id for doc_id, _ in batch]
+        for step in range(60):
+            r = self.rng.random()
+            if r < 0.3:
+                doc_id, text = self.batch(1)[0]
+                self.single.add_document(doc_id, text)
+                self.sharded.add_document(doc_id, text)
+                doc_ids.append(doc_id)
+            elif r < 0.5:
+                batch = self.batch(self.rng.choice([2, 10, 100]))
+                self.single.add_documents(batch)
+                self.sharded.add_documents(dict(batch))
+                doc_ids.extend(doc_id for doc_id, _ in batch)
+            elif r < 0.65:
+                doc_id = doc_ids.pop(self.rng.randrange(len(doc_ids)))
+                self.single.remove_document(doc_id)
+                self.sharded.remove_document(doc_id)
+            elif r < 0.8:
+                doc_id = self.rng.choice(doc_ids)
+                text = self.text()
+                self.single.update_document(doc_id, text)
+                self.sharded.update_document(doc_id, text)
+            elif r < 0.9:
+                # Re-adding an existing id keeps its place
+                doc_id = self.rng.choice(doc_ids)
+                self.single.add_document(doc_id, 'apple fig')
+                self.sharded.add_document(doc_id, 'apple fig')
+            else:
+                self.single.compact()
+                self.sharded.compact()
+            if step % 10 == 9:
+                self.assert_same(step)
+        self.assert_same()
+        sizes = self.sharded.shard_sizes()
+        self.assertEqual(len(sizes), 3)
+        self.assertEqual(sizes, [sum(1 for doc_id in doc_ids if shard_of(doc_id, 3) == shard)
+                                 for shard in range(3)])
+
+    def test_iter_query(self):
+        batch = self.batch(300)
+        self.single.add_documents(batch)
+        self.sharded.add_documents(batch)
+        results = self.sharded.iter_query('NOT zzz')
+        self.assertEqual([next(results) for _ in range(5)], self.single.query_page('NOT zzz', 0, 5))
+        results.close()
+        abandoned = self.sharded.iter_query('apple')
+        next(abandoned)
+        del abandoned
+        # The connection is usable after abandoned streams
+        self.assertEqual(self.sharded.boolean_query('fig'), self.single.boolean_query('fig'))
+
+    def test_errors(self):
+        self.sharded.add_documents(self.batch(50))
+        for query in ['apple AND', '(apple']:
+            with self.assertRaises(QuerySyntaxError):
+                self.sharded.boolean_query(query)
+        with self.assertRaises(KeyError):
+            self.sharded.remove_document('missing')
+        self.assertEqual(len(self.sharded), 50)
+
+    def test_not_positional(self):
+        documents = self.batch(100)
+        with ShardedModel(2) as sharded:
+            sharded.add_documents(documents)
+            with self.assertRaises(QuerySyntaxError):
+                sharded.boolean_query('"apple banana"')
+            self.assertEqual(sharded.boolean_query('apple'),
+                             [doc_id for doc_id, text in documents if 'apple' in text.split()])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Save/load round trips of the on-disk index format: a loaded model must
+answer every query like the model that was saved, keep doing so after
+further writes and compaction, and save again.
+
+Run with: python -m unittest test_storage
+"""
+
+import os
+import random
+import tempfile
+import unittest
+
+from tree23 import boolean_model
+
+WORDS = ['w' + a + b for a in 'abcdef' for b in 'ghij']
+QUERIES = ['wag', 'wag AND wbh', 'wag OR NOT wbh', 'wa*', '*h', 'w*b*', 'wa? AND NOT wc*',
+           'NOT wdg', 'wag XOR wci', 'zzz', 'NOT zzz']
+
+
+def build(options, seed=3, num_docs=400):
+    """A model with a random corpus, some removals and an update"""
+    rng = random.Random(seed)
+    docs = {'d%d' % i: ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 40)))
+            for i in range(num_docs)}
+    model = boolean_model(**options)
+    model.add_documents(list(docs.items()))
+    for doc_id in list(docs)[:30]:
+        model.remove_document(doc_id)
+    model.update_document('d100', 'wag wag wbh')
+    return model
+
+
+class StorageTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def round_trip(self, model, name='index.bin'):
+        path = os.path.join(self.directory, name)
+        model.save(path)
+        loaded = boolean_model.load(path)
+        self.addCleanup(loaded.close)
+        return loaded
+
+    def assert_same(self, loaded, model, queries=QUERIES):
+        for query in queries:
+            self.assertEqual(loaded.boolean_query(query), model.boolean_query(query), query)
+        self.assertEqual(loaded.query_page('NOT wag', 5, 5), model.query_page('NOT wag', 5, 5))
+        self.assertEqual(list(loaded.doc_ids), list(model.doc_ids))
+        self.assertEqual(loaded.all_doc_ids, model.all_doc_ids)
+
+    def test_round_trip(self):
+        model = build({})
+        loaded = self.round_trip(model)
+        self.assert_same(loaded, model)
+
+    def test_writes_after_load(self):
+        model = build({})
+        loaded = self.round_trip(model)
+        for doc_id, text in [('n1', 'wag zzz wbh'), ('d100', 'wci'), ('n2', 'zzz zzy')]:
+            model.add_document(doc_id, text)
+            loaded.add_document(doc_id, text)
+        model.remove_document('d200')
+        loaded.remove_document('d200')
+        self.assertFalse(loaded.inverted_index.read_only)
+        self.assert_same(loaded, model, QUERIES + ['zz*', 'wci'])
+
+        model.compact()
+        loaded.compact()
+        self.assert_same(loaded, model, QUERIES + ['zz*', 'wci'])
+        self.assert_same(self.round_trip(loaded, 'again.bin'), model, QUERIES + ['zz*', 'wci'])
+
+    def test_compact_permuterms(self):
+        model = build({'compact_permuterms': True})
+        loaded = self.round_trip(model)
+        self.assert_same(loaded, model)
+        loaded.add_document('n1', 'wzz')
+        model.add_document('n1', 'wzz')
+        self.assert_same(loaded, model, QUERIES + ['wz*', '*z'])
+
+    def assert_same_ranked(self, loaded, model):
+        for query in ['wag', 'wag OR wbh OR wci', 'wa*', 'wag AND NOT wbh', 'wdj OR zzz']:
+            got, expected = loaded.ranked_query(query, 7), model.ranked_query(query, 7)
+            self.assertEqual([doc_id for doc_id, _ in got], [doc_id for doc_id, _ in expected])
+            for (_, got_score), (_, expected_score) in zip(got, expected):
+                self.assertAlmostEqual(got_score, expected_score, 9, query)
+
+    def test_ranked(self):
+        model = build({'ranked': True})
+        loaded = self.round_trip(model)
+        self.assertTrue(loaded.ranked)
+        self.assert_same_ranked(loaded, model)
+
+        for doc_id, text in [('n1', 'wag wag wag wdj'), ('d100', 'wag'), ('n2', 'wbh zzz')]:
+            model.add_document(doc_id, text)
+            loaded.add_document(doc_id, text)
+        model.remove_document('d300')
+        loaded.remove_document('d300')
+        self.assert_same_ranked(loaded, model)
+        model.compact()
+        loaded.compact()
+        self.assert_same_ranked(loaded, model)
+        self.assert_same_ranked(self.round_trip(loaded, 'again.bin'), model)
+
+    def test_positional(self):
+        model = build({'positional': True, 'ranked': True})
+        phrases = ['"wag wbh"', '"wbh wag wci"', 'wag NEAR/2 wci', '"wag wag" NEAR/5 wb*',
+                   'wdg AND NOT "wdg wdh"', 'NOT "wag wbh"']
+        loaded = self.round_trip(model)
+        self.assertTrue(loaded.positional)
+        self.assert_same(loaded, model, QUERIES + phrases)
+        self.assert_same_ranked(loaded, model)
+
+        for doc_id, text in [('n1', 'wag wbh wci'), ('d100', 'wbh wag'), ('n2', 'wag zzz wbh')]:
+            model.add_document(doc_id, text)
+            loaded.add_document(doc_id, text)
+        model.remove_document('d250')
+        loaded.remove_document('d250')
+        self.assert_same(loaded, model, QUERIES + phrases + ['"wag zzz"'])
+        model.compact()
+        loaded.compact()
+        again = self.round_trip(loaded, 'again.bin')
+        self.assert_same(again, model, QUERIES + phrases + ['"wag zzz"'])
+        self.assertIn('n1', again.boolean_query('"wag wbh" AND "wbh wci"'))
+
+    def test_unranked_load(self):
+        loaded = self.round_trip(build({}))
+        with self.assertRaises(ValueError):
+            loaded.ranked_query('wag')
+
+
+if __name__ == '__main__':
+    unittest.main()
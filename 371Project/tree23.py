@@ -1,4 +1,40 @@
+import copy
+import functools
+import heapq
 import re
+import sys
+import threading
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from itertools import groupby, islice
+
+from postings import (PostingList, Complement, RoaringBitmap, intersect, union,
+                      difference, symmetric_difference, union_all, renumber, truncate,
+                      insert_sorted)
+from cache import LRUCache, sizeof
+from query import QuerySyntaxError, parse_query
+from positions import PositionalPostings, phrase_starts, within
+from ranking import TermCursor, TermFrequencies, idf, term_weight, member_test, top_k
+from analysis import Analyzer
+from docstore import make_store
+from instrumentation import QueryTrace, array_bytes, distribution, instrument
+
+WILDCARD_CHARS = re.compile(r'[*?]')
+PENDING_ROTATIONS = 4096  # Permuterm rotations kept out of the large sorted run
+MERGE_IN_PLACE_RATIO = 2  # Batches with under num_terms / this terms are inserted, not rebuilt
+
+
+def wildcard_regex(pattern):
+    """Compile a wildcard pattern (* = any run, ? = one character)"""
+    parts = []
+    for char in pattern:
+        if char == '*':
+            parts.append('.*')
+        elif char == '?':
+            parts.append('.')
+        else:
+            parts.append(re.escape(char))
+    return re.compile(''.join(parts) + r'\Z')
 
 class Node23:
     """Node in a 2-3 tree"""
@@ -22,131 +58,206 @@ class Node23:
         self.posting_lists.insert(i, posting_list)
 
 class Tree23InvertedIndex:
-    def __init__(self):
+    """
+    Inverted index stored in a 2-3 tree keyed by term.
+    
+    With copy_on_write, nodes reachable from a published root (see
+    snapshot()) are never modified: writes copy the path from the root
+    down and swap in the new root, so readers of a snapshot need no locks.
+    Published posting lists may still take ordinals at or above the
+    snapshot's limit in place; readers ignore those (see postings.truncate).
+    """
+    read_only = False
+    
+    def __init__(self, copy_on_write=False, analyzer=None):
         self.root = Node23()
-        self.stop_words = {'a', 'an', 'the', 'in', 'is', 'it', 'that', 'they', 
-                           'can', 'be', 'will', 'but', 'such', 'also', 'have',
-                           'if', 'at', 'to', 'as'}
+        self.num_terms = 0
+        self.copy_on_write = copy_on_write
+        self._private = set()  # Nodes and posting lists created since the last snapshot
+        self._limit = 0  # Published posting lists only change in place from here up
+        self.analyzer = analyzer or Analyzer()  # Text -> terms (see analysis.py)
+    
+    @property
+    def stop_words(self):
+        return self.analyzer.stop_words
     
     def tokenize(self, text):
-        text = text.lower()
-        tokens = re.findall(r'\b[a-z]+\b', text)
-        return tokens
+        return list(self.analyzer.tokens(text))
     
     def normalize(self, tokens):
-        return [token for token in tokens if token not in self.stop_words]
+        return list(self.analyzer.filter(tokens))
     
-    def search(self, term):
+    def search(self, term, trace=None):
         """Search for a term and return its posting list"""
-        return self._search_recursive(self.root, term)
+        node = self.root
+        while True:
+            if trace is not None:
+                trace.counters['tree_nodes'] += 1
+            for i, key in enumerate(node.keys):
+                if term == key:
+                    return node.posting_lists[i]
+            if node.is_leaf():
+                return []
+            node = node.children[self._child_index(node, term)]
     
-    def _search_recursive(self, node, term):
-        """Recursive search in 2-3 tree"""
-        if node is None:
-            return []
-        
-        # Check keys in current node
-        for i, key in enumerate(node.keys):
-            if term == key:
-                return node.posting_lists[i]
-        
-        # If leaf and not found
-        if node.is_leaf():
-            return []
-        
-        # Find appropriate child to search
+    def _child_index(self, node, term):
+        """Index of the child subtree that may contain term"""
         if term < node.keys[0]:
-            return self._search_recursive(node.children[0], term)
+            return 0
         elif len(node.keys) == 1 or term < node.keys[1]:
-            return self._search_recursive(node.children[1], term)
+            return 1
         else:
-            return self._search_recursive(node.children[2], term)
+            return 2
     
     def insert(self, term, doc_id):
-        """Insert term into 2-3 tree"""
-        # Check if term already exists
-        existing = self.search(term)
-        if existing:
-            # Term exists, update posting list
-            self._update_posting_list(self.root, term, doc_id)
-        else:
-            # New term, insert it
-            result = self._insert_recursive(self.root, term, [doc_id])
-            if result is not None:  # Root split
-                new_root = Node23()
-                new_root.keys = [result[1]]
-                new_root.posting_lists = [result[3]]  # Use the actual posting list
-                new_root.children = [result[0], result[2]]
-                self.root = new_root
-    
-    def _update_posting_list(self, node, term, doc_id):
-        """Update posting list for existing term"""
-        for i, key in enumerate(node.keys):
-            if term == key:
-                if doc_id not in node.posting_lists[i]:
-                    node.posting_lists[i].append(doc_id)
-                return True
-        
-        if not node.is_leaf():
-            if term < node.keys[0]:
-                return self._update_posting_list(node.children[0], term, doc_id)
-            elif len(node.keys) == 1 or term < node.keys[1]:
-                return self._update_posting_list(node.children[1], term, doc_id)
-            else:
-                return self._update_posting_list(node.children[2], term, doc_id)
-    
-    def _insert_recursive(self, node, term, posting_list):
-        """Recursive insertion with node splitting"""
-        if node.is_leaf():
-            if not node.is_full():
-                node.insert_in_node(term, posting_list)
-                return None
+        """Insert term into 2-3 tree, or add doc_id to its posting list"""
+        # Single descent; remember the path in case the leaf has to split.
+        # One comparison chain per node both finds the term and picks the child.
+        path = []  # (node, child_idx) from the root down
+        node = self.root
+        keys = node.keys  # Only an empty tree's root has none
+        child_idx = 0
+        while keys:
+            key = keys[0]
+            if term < key:
+                child_idx = 0
+            elif term == key:
+                self._add_posting(path, node, 0, doc_id)
+                return
+            elif len(keys) == 1 or term < keys[1]:
+                child_idx = 1
+            elif term == keys[1]:
+                self._add_posting(path, node, 1, doc_id)
+                return
             else:
-                # Split leaf node
-                return self._split_node(node, term, posting_list, None)
+                child_idx = 2
+            children = node.children
+            if not children:
+                break
+            path.append((node, child_idx))
+            node = children[child_idx]
+            keys = node.keys
         
-        # Find child to insert into
-        if term < node.keys[0]:
-            child_idx = 0
-        elif len(node.keys) == 1 or term < node.keys[1]:
-            child_idx = 1
-        else:
-            child_idx = 2
+        # New term, insert it into the leaf at child_idx
+        self.num_terms += 1
+        if len(keys) < 2:
+            node = self._writable(path, node)
+            node.keys.insert(child_idx, term)
+            node.posting_lists.insert(child_idx, PostingList([doc_id]))
+            return
+        left, mid_key, right, mid_posting = self._split_node(node, term, PostingList([doc_id]),
+                                                             child_idx=child_idx)
         
-        result = self._insert_recursive(node.children[child_idx], term, posting_list)
+        # Push the middle key up until a parent has room
+        while path:
+            parent, child_idx = path.pop()
+            if not parent.is_full():
+                parent = self._writable(path, parent)
+                parent.keys.insert(child_idx, mid_key)
+                parent.posting_lists.insert(child_idx, mid_posting)
+                parent.children[child_idx] = left
+                parent.children.insert(child_idx + 1, right)
+                return
+            left, mid_key, right, mid_posting = self._split_node(
+                parent, mid_key, mid_posting, (left, right), child_idx)
         
-        if result is None:
-            return None
-        
-        # Child split, need to insert middle value
-        if not node.is_full():
-            node.insert_in_node(result[1], result[3])
-            node.children[child_idx] = result[0]
-            node.children.insert(child_idx + 1, result[2])
-            return None
-        else:
-            return self._split_node(node, result[1], result[3], result)
+        # Root split
+        new_root = Node23()
+        new_root.keys = [mid_key]
+        new_root.posting_lists = [mid_posting]
+        new_root.children = [left, right]
+        if self.copy_on_write:
+            self._private.add(new_root)
+        self.root = new_root
     
-    def _split_node(self, node, new_key, new_posting, split_result):
-        """Split a full node"""
-        # Temporarily add new key
-        temp_keys = node.keys + [new_key]
-        temp_postings = node.posting_lists + [new_posting]
-        temp_children = node.children[:]
-        
-        if split_result:
-            # Insert split children
-            for i, key in enumerate(temp_keys[:-1]):
-                if new_key < key or (i == len(temp_keys) - 2):
-                    idx = i if new_key < key else i + 1
-                    temp_children[idx] = split_result[0]
-                    temp_children.insert(idx + 1, split_result[2])
-                    break
+    def _add_posting(self, path, node, i, doc_id):
+        """Add doc_id to the posting list of node.keys[i] (path leads to node)"""
+        posting_list = self._appendable(node.posting_lists[i], doc_id)
+        if posting_list is not node.posting_lists[i]:
+            node = self._writable(path, node)
+            node.posting_lists[i] = posting_list
+        posting_list.add(doc_id)
+    
+    def _copy_node(self, node):
+        """Private shallow copy of a node"""
+        clone = Node23()
+        clone.keys = node.keys[:]
+        clone.posting_lists = node.posting_lists[:]
+        clone.children = node.children[:]
+        self._private.add(clone)
+        return clone
+    
+    def _writable(self, path, node):
+        """
+        Node reached through path, safe to modify. In copy_on_write mode
+        published nodes are copied from the root down (path is updated in
+        place to the copies) and the new root is installed.
+        """
+        if not self.copy_on_write or node in self._private:
+            return node
+        if self.root not in self._private:
+            self.root = self._copy_node(self.root)
+        parent = self.root
+        for k, (_, child_idx) in enumerate(path):
+            path[k] = (parent, child_idx)
+            parent = self._writable_child(parent, child_idx)
+        return parent
+    
+    def _writable_child(self, parent, idx):
+        """Child idx of a writable parent, copied first if published"""
+        child = parent.children[idx]
+        if self.copy_on_write and child not in self._private:
+            child = self._copy_node(child)
+            parent.children[idx] = child
+        return child
+    
+    def _appendable(self, posting_list, first):
+        """
+        Posting list that ordinals from first upward can be added to. In
+        copy_on_write mode, adding below the published limit goes to a
+        private copy.
+        """
+        if (not self.copy_on_write or posting_list in self._private
+                or first >= self._limit):
+            return posting_list
+        clone = PostingList()
+        clone.extend(posting_list)
+        self._private.add(clone)
+        return clone
+    
+    def snapshot(self, limit=None):
+        """
+        Read-only view of the current version, isolated from later writes
+        in copy_on_write mode. Readers must ignore ordinals >= limit, which
+        may still be added in place; without a limit every later change to
+        a published posting list is copied.
+        """
+        view = Tree23InvertedIndex(analyzer=self.analyzer)
+        view.root = self.root
+        view.num_terms = self.num_terms
+        view.read_only = True
+        self._private = set()
+        self._limit = float('inf') if limit is None else limit
+        return view
+    
+    def _split_node(self, node, new_key, new_posting, split_children=None, child_idx=None):
+        """
+        Split a full node around its middle key.
+        For internal nodes, split_children replaces the child at child_idx.
+        Returns (left, middle_key, right, middle_posting).
+        """
+        if child_idx is None:
+            child_idx = 0
+            while child_idx < len(node.keys) and new_key > node.keys[child_idx]:
+                child_idx += 1
         
-        # Sort
-        sorted_pairs = sorted(zip(temp_keys, temp_postings))
-        temp_keys = [k for k, _ in sorted_pairs]
-        temp_postings = [p for _, p in sorted_pairs]
+        temp_keys = node.keys[:]
+        temp_keys.insert(child_idx, new_key)
+        temp_postings = node.posting_lists[:]
+        temp_postings.insert(child_idx, new_posting)
+        temp_children = node.children[:]
+        if split_children:
+            temp_children[child_idx:child_idx + 1] = list(split_children)
         
         # Create two new nodes
         left = Node23()
@@ -160,247 +271,1551 @@ class Tree23InvertedIndex:
         if temp_children:
             left.children = temp_children[:2]
             right.children = temp_children[2:]
+        if self.copy_on_write:
+            self._private.update((left, right))
         
         return (left, temp_keys[1], right, temp_postings[1])
     
-    def wildcard_search(self, pattern):
-        """Search with wildcard"""
-        if pattern.endswith('*'):
-            prefix = pattern[:-1]
-            results = []
-            self._collect_with_prefix(self.root, prefix, results)
-            return results
-        return []
-    
-    def _collect_with_prefix(self, node, prefix, results):
-        """Collect all terms starting with prefix"""
-        if node is None:
-            return
-        
-        for i, key in enumerate(node.keys):
-            if key.startswith(prefix):
-                results.append((key, node.posting_lists[i]))
+    def delete(self, term):
+        """
+        Remove a term and its posting list, rebalancing by borrowing from
+        or merging with a sibling. Returns False if the term was absent.
+        """
+        path = []  # (node, child_idx) from the root down
+        node = self.root
+        while term not in node.keys:
+            if node.is_leaf():
+                return False
+            child_idx = self._child_index(node, term)
+            path.append((node, child_idx))
+            node = node.children[child_idx]
+        i = node.keys.index(term)
         
         if not node.is_leaf():
-            for child in node.children:
-                self._collect_with_prefix(child, prefix, results)
+            # Swap with the in-order successor, which lives in a leaf
+            path.append((node, i + 1))
+            depth = len(path) - 1
+            leaf = node.children[i + 1]
+            while not leaf.is_leaf():
+                path.append((leaf, 0))
+                leaf = leaf.children[0]
+            leaf = self._writable(path, leaf)
+            node = path[depth][0]
+            node.keys[i] = leaf.keys[0]
+            node.posting_lists[i] = leaf.posting_lists[0]
+            node, i = leaf, 0
+        else:
+            node = self._writable(path, node)
+        
+        del node.keys[i]
+        del node.posting_lists[i]
+        
+        # An empty node is fixed by its parent, which may empty in turn
+        while not node.keys and path:
+            parent, child_idx = path.pop()
+            self._fix_underflow(parent, child_idx)
+            node = parent
+        if not self.root.keys and self.root.children:
+            self.root = self.root.children[0]
+        self.num_terms -= 1
+        return True
     
-    def add_document(self, doc_id, text):
-        """Add document to index"""
-        tokens = self.tokenize(text)
-        terms = self.normalize(tokens)
+    def _fix_underflow(self, parent, idx):
+        """Refill the empty child at idx from a sibling, or merge it into one"""
+        node = parent.children[idx]
+        left = parent.children[idx - 1] if idx > 0 else None
+        right = parent.children[idx + 1] if idx + 1 < len(parent.children) else None
         
+        if left is not None and left.is_full():
+            # Borrow through the parent from the left sibling
+            left = self._writable_child(parent, idx - 1)
+            node.keys.insert(0, parent.keys[idx - 1])
+            node.posting_lists.insert(0, parent.posting_lists[idx - 1])
+            parent.keys[idx - 1] = left.keys.pop()
+            parent.posting_lists[idx - 1] = left.posting_lists.pop()
+            if left.children:
+                node.children.insert(0, left.children.pop())
+        elif right is not None and right.is_full():
+            # Borrow through the parent from the right sibling
+            right = self._writable_child(parent, idx + 1)
+            node.keys.append(parent.keys[idx])
+            node.posting_lists.append(parent.posting_lists[idx])
+            parent.keys[idx] = right.keys.pop(0)
+            parent.posting_lists[idx] = right.posting_lists.pop(0)
+            if right.children:
+                node.children.append(right.children.pop(0))
+        elif left is not None:
+            # Merge into the left sibling, pulling down the separator
+            left = self._writable_child(parent, idx - 1)
+            left.keys.append(parent.keys.pop(idx - 1))
+            left.posting_lists.append(parent.posting_lists.pop(idx - 1))
+            left.children.extend(node.children)
+            parent.children.pop(idx)
+        else:
+            # Merge into the right sibling, pulling down the separator
+            right = self._writable_child(parent, idx + 1)
+            right.keys.insert(0, parent.keys.pop(idx))
+            right.posting_lists.insert(0, parent.posting_lists.pop(idx))
+            right.children[:0] = node.children
+            parent.children.pop(idx)
+    
+    def purge(self, tombstones):
+        """
+        Drop the sorted tombstoned ordinals from every posting list and
+        renumber the remaining ordinals densely. Terms left without
+        documents are deleted from the tree. Returns the deleted terms.
+        """
+        if self.copy_on_write:
+            # Rebuild instead of renumbering published posting lists in place
+            items, empty = [], []
+            for term, posting_list in self.range_scan():
+                posting_list = renumber(posting_list, tombstones)
+                if posting_list:
+                    items.append((term, posting_list))
+                else:
+                    empty.append(term)
+            self.root = self._build_balanced(items)
+            self.num_terms = len(items)
+            return empty
+        
+        empty = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            for i, key in enumerate(node.keys):
+                node.posting_lists[i] = renumber(node.posting_lists[i], tombstones)
+                if not node.posting_lists[i]:
+                    empty.append(key)
+            stack.extend(node.children)
+        for term in empty:
+            self.delete(term)
+        return empty
+    
+    def wildcard_search(self, pattern):
+        """Search with wildcard: range scan on the literal prefix, then filter"""
+        match = WILDCARD_CHARS.search(pattern)
+        if match is None:
+            posting_list = self.search(pattern)
+            return [(pattern, posting_list)] if posting_list else []
+        prefix = pattern[:match.start()]
+        results = self.range_scan(prefix, self._prefix_end(prefix))
+        if pattern == prefix + '*':
+            return list(results)
+        regex = wildcard_regex(pattern)
+        return [(term, posting_list) for term, posting_list in results if regex.match(term)]
+    
+    def _prefix_end(self, prefix):
+        """Smallest string greater than every string starting with prefix"""
+        if not prefix:
+            return None
+        return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    
+    def range_scan(self, lo=None, hi=None):
+        """
+        Lazily yield (term, posting_list) for lo <= term < hi in sorted order.
+        Only subtrees that can overlap the range are visited.
+        None leaves that end of the range open.
+        """
+        return self._range_scan(self.root, lo, hi)
+    
+    def _range_scan(self, node, lo, hi):
+        """In-order range scan of a subtree"""
+        leaf = node.is_leaf()
+        for i, key in enumerate(node.keys):
+            # children[i] holds the terms below key
+            if not leaf and (lo is None or lo < key):
+                yield from self._range_scan(node.children[i], lo, hi)
+            if hi is not None and key >= hi:
+                return
+            if lo is None or key >= lo:
+                yield key, node.posting_lists[i]
+        if not leaf:
+            yield from self._range_scan(node.children[-1], lo, hi)
+    
+    def stats(self):
+        """Shape, vocabulary and approximate memory of the tree (walks every node)"""
+        nodes = leaves = height = dense = 0
+        node_bytes = term_bytes = posting_bytes = 0
+        lengths = array('I')
+        stack = [(self.root, 1)] if self.root.keys else []
+        while stack:
+            node, depth = stack.pop()
+            nodes += 1
+            height = max(height, depth)
+            node_bytes += (sys.getsizeof(node) + sys.getsizeof(node.keys)
+                           + sys.getsizeof(node.posting_lists) + sys.getsizeof(node.children))
+            for term, posting_list in zip(node.keys, node.posting_lists):
+                term_bytes += sys.getsizeof(term)
+                lengths.append(len(posting_list))
+                posting_bytes += posting_list.nbytes()
+                dense += posting_list.bitmap is not None
+            if node.is_leaf():
+                leaves += 1
+            else:
+                stack.extend((child, depth + 1) for child in node.children)
+        return {
+            'terms': len(lengths), 'nodes': nodes, 'leaves': leaves, 'height': height,
+            'postings': sum(lengths), 'dense_terms': dense,
+            'posting_lengths': distribution(lengths),
+            'bytes': {'nodes': node_bytes, 'terms': term_bytes, 'postings': posting_bytes},
+        }
+    
+    def add_document(self, doc_id, text):
+        """Add document to index (doc_id is an integer document ordinal)"""
+        self.add_terms(doc_id, set(self.analyzer.terms(text)))
+    
+    def add_terms(self, doc_id, terms):
+        """Add an analyzed document's distinct terms"""
         for term in terms:
             self.insert(term, doc_id)
+
+    def bulk_load(self, documents):
+        """
+        Index a batch of (doc_id, text) pairs in one pass and rebuild the
+        tree bottom-up from the sorted terms. Doc ids are integer ordinals.
+        Returns the set of terms seen in the batch.
+        """
+        analyzer = self.analyzer
+        return self.bulk_load_terms((doc_id, set(analyzer.terms(text)))
+                                    for doc_id, text in documents)
     
-    def display_index(self):
-        """Display the index"""
+    def bulk_load_terms(self, documents):
+        """bulk_load for (doc_id, distinct terms) pairs, consumed lazily"""
+        postings = {}  # term -> sorted, unique doc ids
+        last = -1  # Highest doc id so far: a higher one can append to every run
+        for doc_id, terms in documents:
+            if doc_id > last:
+                last = doc_id
+                for term in terms:
+                    if term in postings:
+                        postings[term].append(doc_id)
+                    else:
+                        postings[term] = array('I', [doc_id])
+                continue
+            # Re-added document (its old ordinal), possibly twice in this batch
+            for term in terms:
+                if term in postings:
+                    insert_sorted(postings[term], doc_id)
+                else:
+                    postings[term] = array('I', [doc_id])
+
+        self.merge_segments([sorted(postings.items())])
+        return set(postings)
+
+    def merge_segments(self, segments):
+        """
+        Merge segments into the tree and rebuild it bottom-up, or insert
+        them in place when they hold few terms next to the tree's.
+        Each segment is a list of (term, sorted doc ids) sorted by term;
+        a term's doc ids are appended segment by segment, in order (a
+        re-added document's old ordinal is merged in, not appended).
+        """
+        if sum(len(segment) for segment in segments) * MERGE_IN_PLACE_RATIO < self.num_terms:
+            for segment in segments:
+                for term, doc_ids in segment:
+                    ordinals = iter(doc_ids)
+                    self.insert(term, next(ordinals))
+                    rest = array('I', ordinals)
+                    if rest:
+                        self.search(term).extend(rest)
+            return
+
+        streams = [((term, 0, posting_list) for term, posting_list in self.range_scan())]
+        for i, segment in enumerate(segments, 1):
+            streams.append((term, i, doc_ids) for term, doc_ids in segment)
+
+        # k-way merge of the sorted term dictionaries
+        items = []
+        for term, group in groupby(heapq.merge(*streams, key=lambda entry: entry[:2]),
+                                   key=lambda entry: entry[0]):
+            _, source, doc_ids = next(group)
+            if source == 0:
+                posting_list = doc_ids
+            else:
+                posting_list = PostingList()
+                posting_list.extend(doc_ids)
+            for _, _, doc_ids in group:
+                posting_list = self._appendable(posting_list, next(iter(doc_ids)))
+                posting_list.extend(doc_ids)
+            items.append((term, posting_list))
+        self.root = self._build_balanced(items)
+        self.num_terms = len(items)
+
+    def _build_balanced(self, items):
+        """Build a balanced 2-3 tree from sorted (term, posting_list) pairs"""
+        n = len(items)
+        if n == 0:
+            return Node23()
+
+        # Smallest height whose full 3-node tree (3^(h+1) - 1 keys) fits n
+        height = 0
+        while n > 3 ** (height + 1) - 1:
+            height += 1
+        return self._build_subtree(items, 0, n, height)
+
+    def _build_subtree(self, items, lo, hi, height):
+        """Build a subtree of the given height from items[lo:hi]"""
+        node = Node23()
+        if height == 0:
+            for term, posting_list in items[lo:hi]:
+                node.keys.append(term)
+                node.posting_lists.append(posting_list)
+            return node
+
+        # Use two children if they can hold the keys, otherwise three
+        n = hi - lo
+        fanout = 2 if n - 1 <= 2 * (3 ** height - 1) else 3
+        child_keys = n - (fanout - 1)
+        start = lo
+        for i in range(fanout):
+            size = child_keys // fanout + (1 if i < child_keys % fanout else 0)
+            node.children.append(self._build_subtree(items, start, start + size, height - 1))
+            start += size
+            if i < fanout - 1:
+                node.keys.append(items[start][0])
+                node.posting_lists.append(items[start][1])
+                start += 1
+        return node
+
+    def display_index(self, doc_names=None):
+        """Display the index, optionally mapping ordinals to doc names"""
         print("\n=== INVERTED INDEX (2-3 Tree) ===")
-        terms = []
-        self._collect_all_terms(self.root, terms)
-        terms.sort()
-        for term, posting_list in terms:
-            docs = ', '.join(posting_list)
+        for term, posting_list in self.range_scan():
+            if doc_names is None:
+                docs = ', '.join(str(doc_id) for doc_id in posting_list)
+            else:
+                docs = ', '.join(doc_names[doc_id] for doc_id in posting_list)
             print(f"{term} → [{docs}]")
-    
-    def _collect_all_terms(self, node, terms):
-        """Collect all terms from tree"""
-        if node is None:
-            return
-        
-        for i, key in enumerate(node.keys):
-            terms.append((key, node.posting_lists[i]))
-        
-        if not node.is_leaf():
-            for child in node.children:
-                self._collect_all_terms(child, terms)
 
 
 class PermutermIndex:
-    """Permuterm index for wildcard matching"""
-    def __init__(self):
+    """
+    Permuterm index for wildcard matching.
+    Rotations live in one large sorted run plus a small sorted run of
+    recently added ones; lookups binary-search both, and the small run is
+    merged into the large one once it holds PENDING_ROTATIONS, so adding a
+    term never makes the next lookup re-sort the vocabulary.
+    With compact=True the large run is not stored as strings: the index
+    keeps one "term$term$..." buffer plus the buffer offsets of every
+    rotation, sorted lexicographically (a suffix array over the vocabulary).
+    """
+    def __init__(self, compact=False):
+        self.compact = compact
         self.permuterms = {}  # permuterm -> original_term
+        self.terms = set()
+        self._sorted = []  # permuterms in sorted order
+        self._pending = []  # Sorted permuterms added since the last merge
+        
+        # Compact mode
+        self._buffer = ''  # Terms, each followed by $
+        self._term_starts = array('I')  # Buffer offset of each term
+        self._offsets = array('I')  # Rotation start offsets in sorted rotation order
+        self._pending_terms = set()  # Terms whose rotations are in _pending
     
     def add_term(self, term):
         """Add all rotations of a term to the permuterm index"""
-        # Add the term with $ marker
+        self.add_terms((term,))
+    
+    def add_terms(self, terms):
+        """Add several terms; a large batch is sorted and merged in one step"""
+        if self.compact:
+            self._add_compact(terms)
+            return
+        rotations = []
+        for term in terms:
+            if term in self.terms:
+                continue
+            self.terms.add(term)
+            for rotation in self._term_rotations(term):
+                self.permuterms[rotation] = term
+                rotations.append(rotation)
+        
+        if len(self._pending) + len(rotations) < PENDING_ROTATIONS:
+            for rotation in rotations:
+                insort(self._pending, rotation)
+        else:
+            self._pending.extend(rotations)
+            self._pending.sort()
+            self._merge_pending()
+    
+    def _add_compact(self, terms):
+        """Stage new terms' rotations as strings until there are enough to fold in"""
+        new_terms = []
+        for term in terms:
+            if term in self._pending_terms or self._folded_contains(term):
+                continue
+            self._pending_terms.add(term)
+            new_terms.append(term)
+        
+        if len(self._pending) + sum(len(term) + 1 for term in new_terms) < PENDING_ROTATIONS:
+            for term in new_terms:
+                for rotation in self._term_rotations(term):
+                    insort(self._pending, rotation)
+        else:
+            self._merge_pending()
+    
+    def _term_rotations(self, term):
+        """Every rotation of term$"""
         term_with_marker = term + '$'
+        return [term_with_marker[i:] + term_with_marker[:i] for i in range(len(term_with_marker))]
+    
+    def _rotation_term(self, permuterm):
+        """The term a rotation belongs to"""
+        if not self.compact:
+            return self.permuterms[permuterm]
+        tail, head = permuterm.split('$')
+        return head + tail
+    
+    def stats(self):
+        """Term and rotation counts and approximate memory"""
+        if self.compact:
+            return {'compact': True, 'terms': len(self._term_starts) + len(self._pending_terms),
+                    'entries': len(self._offsets) + len(self._pending),
+                    'pending_terms': len(self._pending_terms),
+                    'bytes': (sys.getsizeof(self._buffer) + array_bytes(self._term_starts)
+                              + array_bytes(self._offsets) + sizeof(self._pending)
+                              + sizeof(self._pending_terms))}
+        return {'compact': False, 'terms': len(self.terms), 'entries': len(self.permuterms),
+                'bytes': (sizeof(self.permuterms) + sys.getsizeof(self._sorted)
+                          + sys.getsizeof(self._pending))}
+    
+    def _merge_pending(self):
+        """Fold the pending run into the sorted permuterms (or the suffix array)"""
+        if self.compact:
+            self._fold_compact()
+            return
+        # Two sorted runs, so the merge is linear; a new list, as lookups may hold the old one
+        merged = self._sorted + self._pending
+        merged.sort()
+        self._sorted = merged
+        self._pending = []
+    
+    def remove_terms(self, terms):
+        """Drop every rotation of the given terms"""
+        removed = set(terms)
+        if self.compact:
+            remaining = [term for term in self._folded_terms() if term not in removed]
+            remaining.extend(self._pending_terms - removed)
+            self._build_compact(sorted(remaining))
+            self._pending, self._pending_terms = [], set()
+            return
+        stale = {rotation for rotation, term in self.permuterms.items() if term in removed}
+        for rotation in stale:
+            del self.permuterms[rotation]
+        self._sorted = [rotation for rotation in self._sorted if rotation not in stale]
+        self._pending = [rotation for rotation in self._pending if rotation not in stale]
+        self.terms -= removed
+    
+    def _build_compact(self, terms):
+        """Build the buffer and suffix array from scratch for sorted terms"""
+        self._buffer = ''.join(term + '$' for term in terms)
+        self._term_starts = array('I')
+        position = 0
+        for term in terms:
+            self._term_starts.append(position)
+            position += len(term) + 1
+        self._offsets = self._sort_rotations(range(len(self._buffer)))
+    
+    def _fold_compact(self):
+        """Append the pending terms to the buffer and merge their rotations into the suffix array"""
+        terms = sorted(self._pending_terms)
+        self._pending, self._pending_terms = [], set()
+        if not terms:
+            return
+        added = sum(len(term) + 1 for term in terms)
+        if added * 16 > len(self._offsets):
+            # Large relative to the index: one full sort is cheaper
+            self._build_compact(sorted(set(self._folded_terms()).union(terms)))
+            return
         
-        # Add all rotations
-        for i in range(len(term_with_marker)):
-            rotation = term_with_marker[i:] + term_with_marker[:i]
-            self.permuterms[rotation] = term
+        base = position = len(self._buffer)
+        for term in terms:
+            self._term_starts.append(position)
+            position += len(term) + 1
+        self._buffer += ''.join(term + '$' for term in terms)
+        
+        # Binary-search each new rotation's place among the old ones, then
+        # splice the old offsets around them in sorted runs
+        old, merged, previous = self._offsets, array('I'), 0
+        for offset in self._sort_rotations(range(base, len(self._buffer))):
+            place = self._bisect_offsets(self._rotation(offset), previous)
+            merged.extend(old[previous:place])
+            merged.append(offset)
+            previous = place
+        merged.extend(old[previous:])
+        self._offsets = merged
+    
+    def _sort_rotations(self, offsets):
+        """Buffer offsets in sorted rotation order"""
+        # Bucket by the first two characters so that only one bucket's
+        # rotations are ever materialized as sort keys at a time
+        buckets = {}
+        for offset in offsets:
+            buckets.setdefault(self._rotation(offset, 2), []).append(offset)
+        result = array('I')
+        for prefix in sorted(buckets):
+            bucket = buckets[prefix]
+            bucket.sort(key=self._rotation)
+            result.extend(bucket)
+        return result
+    
+    def _bisect_offsets(self, query, lo=0):
+        """First suffix-array index from lo whose rotation, cut to len(query), is >= query"""
+        offsets = self._offsets
+        n = len(query)
+        hi = len(offsets)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._rotation(offsets[mid], n) < query:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+    
+    def _folded_terms(self):
+        return (self._term_at(t) for t in range(len(self._term_starts)))
+    
+    def _folded_contains(self, term):
+        """Whether term is in the suffix array"""
+        # $term sorts first among the rotations starting with it
+        query = '$' + term
+        i = self._bisect_offsets(query)
+        return i < len(self._offsets) and self._rotation(self._offsets[i]) == query
+    
+    def _term_bounds(self, offset):
+        """(start, end) of the term$ block containing a buffer offset"""
+        t = bisect_right(self._term_starts, offset) - 1
+        start = self._term_starts[t]
+        if t + 1 < len(self._term_starts):
+            return start, self._term_starts[t + 1]
+        return start, len(self._buffer)
+    
+    def _term_at(self, t):
+        """The t-th term in the buffer"""
+        start = self._term_starts[t]
+        end = self._term_starts[t + 1] if t + 1 < len(self._term_starts) else len(self._buffer)
+        return self._buffer[start:end - 1]
+    
+    def _rotation(self, offset, limit=None):
+        """The first limit characters of the rotation starting at offset"""
+        start, end = self._term_bounds(offset)
+        if limit is not None and offset + limit <= end:
+            return self._buffer[offset:offset + limit]
+        tail = self._buffer[offset:end]
+        if limit is None:
+            return tail + self._buffer[start:offset]
+        return tail + self._buffer[start:min(offset, start + limit - len(tail))]
+    
+    def rotations(self):
+        """Yield (permuterm, term) pairs in sorted order"""
+        if self.compact:
+            folded = (self._rotation(offset) for offset in self._offsets)
+        else:
+            folded = self._sorted
+        for permuterm in heapq.merge(folded, self._pending):
+            yield permuterm, self._rotation_term(permuterm)
+    
+    def _prefix_lookup(self, query):
+        """Terms with a rotation starting with query (binary search)"""
+        if self.compact:
+            matches = self._compact_prefix_lookup(query)
+            runs = (self._pending,)
+        else:
+            matches = set()
+            runs = (self._sorted, self._pending)
+        for permuterms in runs:
+            i = bisect_left(permuterms, query)
+            while i < len(permuterms) and permuterms[i].startswith(query):
+                matches.add(self._rotation_term(permuterms[i]))
+                i += 1
+        return matches
+    
+    def _compact_prefix_lookup(self, query):
+        """Binary search over the rotation offsets, comparing in the buffer"""
+        offsets = self._offsets
+        n = len(query)
+        lo = self._bisect_offsets(query)
+        matches = set()
+        while lo < len(offsets) and self._rotation(offsets[lo], n) == query:
+            start, end = self._term_bounds(offsets[lo])
+            matches.add(self._buffer[start:end - 1])
+            lo += 1
+        return matches
     
     def wildcard_search(self, pattern):
         """Search for terms matching wildcard pattern"""
         if '*' not in pattern:
-            return [pattern] if pattern in self.permuterms.values() else []
-        
-        # Convert pattern to permuterm query
-        if pattern.endswith('*'):
-            # Prefix query: comp* -> comp$
-            query = pattern[:-1] + '$'
-        elif pattern.startswith('*'):
-            # Suffix query: *puter -> uter$
-            query = pattern[1:] + '$'
-        else:
-            # Contains query: *put* -> put$*
-            parts = pattern.split('*')
-            if len(parts) == 2:
-                query = parts[1] + '$' + parts[0]
+            if self.compact:
+                found = pattern in self._pending_terms or self._folded_contains(pattern)
             else:
-                return []
+                found = pattern in self.terms
+            return [pattern] if found else []
         
-        # Find matching terms
-        matches = []
-        for permuterm, original_term in self.permuterms.items():
-            if permuterm.startswith(query):
-                if original_term not in matches:
-                    matches.append(original_term)
-        
-        # If no matches found with startswith, try alternative approach for prefix queries
-        if not matches and pattern.endswith('*'):
-            prefix = pattern[:-1]
-            for permuterm, original_term in self.permuterms.items():
-                if permuterm.startswith(prefix) and permuterm.endswith('$'):
-                    if original_term not in matches:
-                        matches.append(original_term)
+        # Rotate the pattern so its last * ends the query:
+        #   comp* -> $comp, *puter -> puter$, co*er -> er$co
+        parts = pattern.split('*')
+        if len(parts) == 3 and not parts[0] and not parts[2]:
+            # Contains query: *put* -> put
+            query = parts[1]
+        else:
+            query = parts[-1] + '$' + parts[0]
+        matches = self._prefix_lookup(query)
         
-        return matches
+        # Inner segments (a*b*c) are checked against each candidate
+        if len(parts) > 3 or (len(parts) == 3 and (parts[0] or parts[2])):
+            regex = wildcard_regex(pattern)
+            matches = {term for term in matches if regex.match(term)}
+        
+        return sorted(matches)
+
+
+class KGramIndex:
+    """k-gram index (gram -> terms) for general wildcard patterns"""
+    def __init__(self, k=3):
+        self.k = k
+        self.grams = {}  # gram -> set of terms
+        self.terms = set()
+    
+    def add_term(self, term):
+        """Index every k-gram of $term$"""
+        if term in self.terms:
+            return
+        self.terms.add(term)
+        marked = '$' + term + '$'
+        for i in range(len(marked) - self.k + 1):
+            gram = marked[i:i + self.k]
+            if gram in self.grams:
+                self.grams[gram].add(term)
+            else:
+                self.grams[gram] = {term}
+    
+    def stats(self):
+        """Gram and (gram, term) entry counts and approximate memory"""
+        return {'k': self.k, 'terms': len(self.terms), 'grams': len(self.grams),
+                'entries': sum(map(len, self.grams.values())), 'bytes': sizeof(self.grams)}
+    
+    def remove_terms(self, terms):
+        """Drop terms from their gram lists"""
+        for term in terms:
+            if term not in self.terms:
+                continue
+            self.terms.discard(term)
+            marked = '$' + term + '$'
+            for i in range(len(marked) - self.k + 1):
+                gram = marked[i:i + self.k]
+                self.grams[gram].discard(term)
+                if not self.grams[gram]:
+                    del self.grams[gram]
+    
+    def _pattern_grams(self, pattern):
+        """k-grams that every term matching the pattern must contain"""
+        grams = set()
+        for segment in WILDCARD_CHARS.split('$' + pattern + '$'):
+            for i in range(len(segment) - self.k + 1):
+                grams.add(segment[i:i + self.k])
+        return grams
+    
+    def wildcard_search(self, pattern):
+        """Terms matching a pattern with any number of * and ? wildcards"""
+        grams = self._pattern_grams(pattern)
+        if grams:
+            # Intersect gram lists smallest first, then post-filter
+            gram_terms = sorted((self.grams.get(gram, set()) for gram in grams), key=len)
+            candidates = gram_terms[0].intersection(*gram_terms[1:])
+        else:
+            # Pattern has no literal run of k characters
+            candidates = self.terms
+        regex = wildcard_regex(pattern)
+        return sorted(term for term in candidates if regex.match(term))
+
+
+def _writer(method):
+    """Serialize a boolean_model write method with the other writers"""
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self._write_lock:
+            return method(self, *args, **kwargs)
+    return locked
 
 
 class boolean_model:
-    """Boolean query processor with inverted index and permuterm index"""
+    """
+    Boolean query processor with inverted index, permuterm and k-gram indexes.
     
-    def __init__(self):
-        self.inverted_index = Tree23InvertedIndex()
-        self.permuterm_index = PermutermIndex()
-        self.documents = {}  # doc_id -> document text
-        self.all_doc_ids = set()
+    With ranked=True, term frequencies and document lengths are kept as
+    well, and ranked_query returns the top k documents by BM25. With
+    positional=True, token positions are kept for phrase ("a b") and
+    proximity (a NEAR/k b) queries.
+    
+    The analyzer (see analysis.py) turns documents into terms; each
+    document is analyzed once, and query terms go through the same
+    folding and stemming stages. Raw text goes to the doc_store (see
+    docstore.py) and is only read back on request.
+    
+    With concurrent=True the inverted index is copy-on-write and every
+    completed write publishes a new version. Queries run lock-free against
+    a snapshot of the latest version, so they can be served from many
+    threads while documents are being added.
+    """
+    
+    UNIVERSE_TAG = '$all'  # Cache tag for results that depend on every doc (NOT)
+    _term_memo = None  # term -> posting list, while evaluating a batch
+    _trace = None  # QueryTrace of the query being evaluated (see instrumentation.py)
+    
+    def __init__(self, compact_permuterms=False, cache_bytes=32 * 1024 * 1024,
+                 segment_docs=None, concurrent=False, ranked=False, positional=False,
+                 analyzer=None, doc_store=None):
+        self.compact_permuterms = compact_permuterms
+        self.concurrent = concurrent
+        self.ranked = ranked
+        self.positional = positional
+        self.analyzer = analyzer or Analyzer()
+        self.mapped_file = None  # Set when loaded from disk (see storage.py)
+        if segment_docs:
+            # LSM-style write segment + sealed segments (see segments.py)
+            from segments import SegmentedIndex
+            self.inverted_index = SegmentedIndex(segment_docs, copy_on_write=concurrent,
+                                                 analyzer=self.analyzer)
+        else:
+            self.inverted_index = Tree23InvertedIndex(concurrent, self.analyzer)
+        self.permuterm_index = PermutermIndex(compact=compact_permuterms)
+        self.kgram_index = KGramIndex()
+        self.documents = make_store(doc_store)  # doc_id -> document text
+        self.doc_ids = []  # ordinal -> doc_id
+        self.doc_ordinals = {}  # doc_id -> ordinal
+        self.tombstones = PostingList()  # Ordinals of removed documents
+        # Ranked mode: per-ordinal term frequencies and lengths
+        self.term_freqs = {}  # term -> TermFrequencies
+        self.doc_lengths = array('I')  # ordinal -> number of indexed terms
+        self.total_length = 0  # Of the live documents
+        self.min_doc_length = 0  # Lower bound over live documents
+        self.max_tfs = {}  # term -> upper bound on its frequency in any document
+        self.positions = {}  # term -> PositionalPostings (positional mode)
+        # Parsed queries, wildcard expansions and query results
+        self.cache = LRUCache(cache_bytes)
+        
+        self.version = 0  # Bumped by every completed write
+        self._write_lock = threading.RLock()  # One writer at a time
+        self._lock = threading.RLock()  # Vocabulary indexes, cache invalidation, publishing
+        self._stale = set()  # Cache tags to drop when the current write is published
+        self._published = None  # Latest snapshot state (concurrent mode)
+        self.trace_hooks = []  # Called with each query's QueryTrace; replaced, never mutated
+        self._publish()
+    
+    def _assign_ordinal(self, doc_id):
+        """Return the ordinal for doc_id, allocating the next one if new"""
+        ordinal = self.doc_ordinals.get(doc_id)
+        if ordinal is None:
+            ordinal = len(self.doc_ids)
+            self.doc_ids.append(doc_id)
+            self.doc_ordinals[doc_id] = ordinal
+        return ordinal
+    
+    def save(self, path):
+        """Write the index to a binary file (see storage.py), compacting first"""
+        from storage import save_index
+        if self.tombstones:
+            self.compact()
+        save_index(self, path)
+    
+    @classmethod
+    def load(cls, path):
+        """Memory-map a saved index; it becomes writable on the first add"""
+        from storage import load_index
+        return load_index(path)
     
+    def close(self):
+        """Release the memory-mapped file, if any"""
+        if self.mapped_file is not None:
+            self.cache.clear()
+            self.mapped_file.close()
+            self.mapped_file = None
+    
+    def _ensure_writable(self):
+        """Copy a memory-mapped index into the in-memory structures"""
+        if not self.inverted_index.read_only:
+            return
+        items = [(term, PostingList(posting_list))
+                 for term, posting_list in self.inverted_index.range_scan()]
+        self.inverted_index = Tree23InvertedIndex(analyzer=self.analyzer)
+        self.inverted_index.root = self.inverted_index._build_balanced(items)
+        self.inverted_index.num_terms = len(items)
+        self.permuterm_index = PermutermIndex(compact=self.compact_permuterms)
+        self.kgram_index = KGramIndex(self.kgram_index.k)
+        self.permuterm_index.add_terms(term for term, _ in items)
+        for term, _ in items:
+            self.kgram_index.add_term(term)
+        
+        if self.ranked:
+            self.term_freqs = {term: tfs.copy() for term, tfs in self.term_freqs.items()}
+            self.max_tfs = dict(self.max_tfs.items())
+            self.doc_lengths = array('I', self.doc_lengths)
+        if self.positional:
+            self.positions = {term: postings.copy() for term, postings in self.positions.items()}
+        
+        self.doc_ids = list(self.doc_ids)
+        self.doc_ordinals = {doc_id: i for i, doc_id in enumerate(self.doc_ids)}
+        self.close()
+    
+    @_writer
     def add_document(self, doc_id, text):
         """Add document to both indices"""
+        self._ensure_writable()
         self.documents[doc_id] = text
-        self.all_doc_ids.add(doc_id)
+        self._index_document(doc_id, text)
+    
+    @_writer
+    def add_file(self, doc_id, path, encoding='utf-8'):
+        """
+        Add a text file as one document, analyzed chunk by chunk so it is
+        never held in memory. Its text isn't kept in documents.
+        """
+        self._ensure_writable()
+        self.documents.pop(doc_id, None)
+        with open(path, encoding=encoding) as f:
+            self._index_document(doc_id, f)
+    
+    def _index_document(self, doc_id, text):
+        """Analyze a document once and feed every index from the result"""
+        ordinal = self._assign_ordinal(doc_id)
+        terms = self._analyze(ordinal, text)
+        self.inverted_index.add_terms(ordinal, terms)
+        
+        # Add terms to permuterm and k-gram indexes
+        self._add_terms(terms)
+    
+    def _analyze(self, ordinal, text):
+        """A document's distinct terms, recording its ranked and positional data"""
+        if self.ranked or self.positional:
+            positions = self.analyzer.term_positions(text)
+            self._record_document(ordinal, positions)
+            return positions.keys()
+        return set(self.analyzer.terms(text))
+
+    @_writer
+    def add_documents(self, documents):
+        """Add a batch of documents using the bulk-load path"""
+        self._ensure_writable()
+        if isinstance(documents, dict):
+            documents = documents.items()
+        
+        def analyzed():
+            for doc_id, text in documents:
+                self.documents[doc_id] = text
+                ordinal = self._assign_ordinal(doc_id)
+                yield ordinal, self._analyze(ordinal, text)
+
+        self._add_terms(self.inverted_index.bulk_load_terms(analyzed()))
+    
+    @_writer
+    def add_documents_parallel(self, documents, processes=None):
+        """Add a batch of documents, tokenizing shards in worker processes"""
+        from parallel import add_documents_parallel
+        add_documents_parallel(self, documents, processes)
+    
+    def _record_document(self, ordinal, positions):
+        """Ranked and positional data for a document, from its term positions"""
+        if self.ranked:
+            self._record_stats(ordinal, {term: len(offsets)
+                                         for term, offsets in positions.items()})
+        if self.positional:
+            self._record_positions(ordinal, positions)
+    
+    def _record_positions(self, ordinal, positions):
+        for term, offsets in positions.items():
+            postings = self.positions.get(term)
+            if postings is None:
+                postings = self.positions[term] = PositionalPostings()
+            postings.add(ordinal, offsets)
+    
+    def _record_stats(self, ordinal, counts):
+        """Store a document's term frequencies for ranked retrieval"""
+        length = sum(counts.values())
+        if ordinal < len(self.doc_lengths):
+            # Re-added document keeps its ordinal
+            self.total_length -= self.doc_lengths[ordinal]
+            self.doc_lengths[ordinal] = length
+        else:
+            self.doc_lengths.append(length)
+        self.total_length += length
+        if length < self.min_doc_length or len(self.doc_lengths) == 1:
+            self.min_doc_length = length
+        term_freqs, max_tfs = self.term_freqs, self.max_tfs
+        for term, tf in counts.items():
+            tfs = term_freqs.get(term)
+            if tfs is None:
+                tfs = term_freqs[term] = TermFrequencies()
+            tfs.add(ordinal, tf)
+            if tf > max_tfs.get(term, 0):
+                max_tfs[term] = tf
+    
+    @_writer
+    def remove_document(self, doc_id):
+        """
+        Delete a document. Its ordinal is tombstoned and filtered out of
+        query results; compact() reclaims the space.
+        """
+        self._remove_document(doc_id)
+        self._publish()
+    
+    def _remove_document(self, doc_id):
+        self._ensure_writable()
+        if doc_id not in self.doc_ordinals:
+            raise KeyError(doc_id)
+        ordinal = self.doc_ordinals.pop(doc_id)
+        if self.concurrent:
+            # Published tombstones are shared with snapshots
+            tombstones = PostingList()
+            tombstones.extend(self.tombstones)
+            self.tombstones = tombstones
+        self.tombstones.add(ordinal)
+        if self.ranked:
+            self.total_length -= self.doc_lengths[ordinal]
+        text = self.documents.pop(doc_id, None)
         
-        # Add to inverted index
-        self.inverted_index.add_document(doc_id, text)
+        self._stale.add(self.UNIVERSE_TAG)
+        if text is None:
+            # Text unknown (not stored, or loaded from disk): any result may hold the doc
+            self._stale.update(self.cache.tags())
+        else:
+            self._stale.update(self.analyzer.terms(text))
+    
+    @_writer
+    def update_document(self, doc_id, text):
+        """
+        Replace a document's text; the new version is indexed under a fresh
+        ordinal and published together with the removal of the old one
+        """
+        self._remove_document(doc_id)
+        self.add_document(doc_id, text)
+    
+    @_writer
+    def compact(self):
+        """
+        Purge tombstoned ordinals from every posting list, renumber the
+        remaining documents densely and drop terms no document uses.
+        The document store drops removed and replaced text too.
+        """
+        self.documents.compact()
+        if not self.tombstones:
+            return
+        self._ensure_writable()
+        tombstones = array('I', self.tombstones)
+        empty = self.inverted_index.purge(tombstones)
         
-        # Add terms to permuterm index
-        tokens = self.inverted_index.tokenize(text)
-        terms = self.inverted_index.normalize(tokens)
-        for term in set(terms):  # Remove duplicates
-            self.permuterm_index.add_term(term)
+        dead = set(tombstones)
+        doc_ids = [doc_id for ordinal, doc_id in enumerate(self.doc_ids) if ordinal not in dead]
+        if self.ranked:
+            # Replaced, not filtered in place: snapshots share the old ones
+            self.term_freqs = {term: tfs.renumber(tombstones)
+                               for term, tfs in self.term_freqs.items() if term not in empty}
+            self.doc_lengths = array('I', (length for ordinal, length in enumerate(self.doc_lengths)
+                                           if ordinal not in dead))
+            self.max_tfs = {term: tf for term, tf in self.max_tfs.items() if term not in empty}
+        if self.positional:
+            self.positions = {term: postings.renumber(tombstones)
+                              for term, postings in self.positions.items() if term not in empty}
+        with self._lock:
+            self.permuterm_index.remove_terms(empty)
+            self.kgram_index.remove_terms(empty)
+            self.doc_ids = doc_ids
+            self.doc_ordinals = {doc_id: i for i, doc_id in enumerate(doc_ids)}
+            self.tombstones = PostingList()
+            self.cache.clear()
+            self._publish()
+    
+    def _add_terms(self, terms):
+        """Register a new document's terms and publish the write"""
+        with self._lock:
+            new_terms = [term for term in terms if term not in self.kgram_index.terms]
+            self.permuterm_index.add_terms(new_terms)
+            for term in new_terms:
+                self.kgram_index.add_term(term)
+            
+            # Results for these terms (and every NOT query) changed; wildcard
+            # patterns only change if one of the new terms matches them
+            self._stale.update(terms)
+            self._stale.add(self.UNIVERSE_TAG)
+            if new_terms:
+                for tag in self.cache.tags():
+                    if WILDCARD_CHARS.search(tag):
+                        regex = wildcard_regex(tag)
+                        if any(regex.match(term) for term in new_terms):
+                            self._stale.add(tag)
+            self._publish()
+    
+    def _publish(self):
+        """
+        Drop the cache entries the write made stale and, in concurrent
+        mode, make its result visible to new snapshots, in one step
+        """
+        with self._lock:
+            self.cache.invalidate(self._stale)
+            self._stale = set()
+            self.version += 1
+            if self.concurrent:
+                doc_limit = len(self.doc_ids)
+                self._published = (self.version, self.inverted_index.snapshot(doc_limit),
+                                   self.doc_ids, doc_limit, self.tombstones,
+                                   {name: getattr(self, name) for name in Snapshot.VERSIONED})
+    
+    def snapshot(self):
+        """Read-only view of the latest published version (concurrent mode)"""
+        if not self.concurrent:
+            raise ValueError("Snapshots need boolean_model(concurrent=True)")
+        return Snapshot(self, *self._published)
+    
+    def cache_stats(self):
+        """Hit/miss counters and memory use of the query cache"""
+        return self.cache.stats()
+    
+    def stats(self):
+        """Sizes and approximate memory of every structure (walks the indexes)"""
+        with self._write_lock, self._lock:
+            stats = {
+                'documents': self._live_docs(),
+                'ordinals': self._live_docs() + len(self.tombstones),
+                'tombstones': len(self.tombstones),
+                'version': self.version,
+                'inverted_index': self.inverted_index.stats(),
+                'permuterm_index': self.permuterm_index.stats(),
+                'kgram_index': self.kgram_index.stats(),
+                'cache': self.cache.stats(),
+                'document_store': {'type': type(self.documents).__name__,
+                                   'documents': len(self.documents),
+                                   'bytes': self.documents.nbytes()},
+            }
+            if self.ranked:
+                live = stats['documents']
+                stats['ranked'] = {'total_length': self.total_length,
+                                   'average_length': self.total_length / live if live else 0,
+                                   'bytes': array_bytes(self.doc_lengths)
+                                            + sum(tfs.nbytes() for tfs in self.term_freqs.values())
+                                            + sizeof(self.max_tfs)}
+            if self.positional:
+                stats['positions'] = {'terms': len(self.positions),
+                                      'bytes': sum(len(postings.data)
+                                                   for postings in self.positions.values())}
+        return stats
+    
+    def add_trace_hook(self, hook):
+        """
+        Call hook(trace) after every boolean_query, query_page, counted_page
+        and ranked_query with its QueryTrace (see instrumentation.py)
+        """
+        self.trace_hooks = self.trace_hooks + [hook]
+    
+    def remove_trace_hook(self, hook):
+        self.trace_hooks = [other for other in self.trace_hooks if other != hook]
+    
+    def _traced(self, method, query, *args):
+        """Run a query method on an instrumented copy and pass its trace to the hooks"""
+        trace = QueryTrace(query, method)
+        view = instrument(self, trace)
+        try:
+            return trace.run(getattr(view, method), query, *args)
+        finally:
+            for hook in self.trace_hooks:
+                hook(trace)
     
+    def get_document(self, doc_id):
+        """Stored text of a document, or None if the store doesn't keep it"""
+        return self.documents.get(doc_id)
+    
+    def fetch_documents(self, doc_ids):
+        """Lazily yield (doc_id, text) for query hits, e.g. to display a page"""
+        for doc_id in doc_ids:
+            yield doc_id, self.documents.get(doc_id)
+
     def _get_posting_list(self, term):
         """Get posting list for a term, handling wildcards"""
-        if '*' in term:
-            # Handle wildcard
-            matching_terms = self.permuterm_index.wildcard_search(term)
-            all_docs = set()
-            for matching_term in matching_terms:
-                docs = self.inverted_index.search(matching_term)
-                all_docs.update(docs)
-            return list(all_docs)
-        else:
-            return self.inverted_index.search(term)
+        memo = self._term_memo
+        if memo is not None:
+            postings = memo.get(term)
+            if postings is None:
+                postings = memo[term] = self._fetch_posting_list(term)
+            return postings
+        return self._fetch_posting_list(term)
+    
+    def _fetch_posting_list(self, term):
+        if not WILDCARD_CHARS.search(term):
+            return self._term_postings(term)
+        return union_all(self._term_postings(matching_term)
+                         for matching_term in self._expand_wildcard(term))
+    
+    def _expand_wildcard(self, pattern):
+        """Terms matching a wildcard pattern (cached)"""
+        key = ('wildcard', pattern)
+        # Held across lookup and put so a concurrent write can't be missed
+        with self._lock:
+            terms = self.cache.get(key)
+            if terms is None:
+                terms = self._lookup_wildcard(pattern)
+                self.cache.put(key, terms, tags=(pattern,))
+        return terms
     
+    def _lookup_wildcard(self, pattern):
+        """Terms matching a wildcard pattern, using the cheapest index"""
+        if '?' not in pattern:
+            # The live tree may be mid-write in concurrent mode
+            if pattern.endswith('*') and pattern.count('*') == 1 and not self.concurrent:
+                # Prefix wildcard: range scan over the ordered tree
+                return [term for term, _ in self.inverted_index.wildcard_search(pattern)]
+            if pattern.count('*') <= 2:
+                return self.permuterm_index.wildcard_search(pattern)
+        # Several * or any ?: intersect k-gram lists, then post-filter
+        return self.kgram_index.wildcard_search(pattern)
+    
+    def _term_postings(self, term):
+        """Sorted ordinals for an exact term"""
+        posting_list = self.inverted_index.search(term, self._trace)
+        return posting_list.postings() if posting_list else []
+    
+    # Posting lists are sorted ordinals; every operation merges them in order.
+    # NOT results stay lazy Complement objects so that A AND NOT B costs O(|A|)
     def _and_operation(self, list1, list2):
         """AND operation: intersection of two posting lists"""
-        return list(set(list1) & set(list2))
+        if isinstance(list1, Complement) and isinstance(list2, Complement):
+            return self._complement(union(list1.excluded, list2.excluded))
+        if isinstance(list1, Complement):
+            return difference(list2, list1.excluded)
+        if isinstance(list2, Complement):
+            return difference(list1, list2.excluded)
+        return intersect(list1, list2)
     
     def _or_operation(self, list1, list2):
         """OR operation: union of two posting lists"""
-        return list(set(list1) | set(list2))
+        if isinstance(list1, Complement) and isinstance(list2, Complement):
+            return self._complement(intersect(list1.excluded, list2.excluded))
+        if isinstance(list1, Complement):
+            return self._complement(difference(list1.excluded, list2))
+        if isinstance(list2, Complement):
+            return self._complement(difference(list2.excluded, list1))
+        return union(list1, list2)
     
     def _not_operation(self, list1):
         """NOT operation: all documents not in the list"""
-        return list(self.all_doc_ids - set(list1))
+        if isinstance(list1, Complement):
+            return list1.excluded
+        return self._complement(list1)
     
     def _xor_operation(self, list1, list2):
         """XOR operation: documents in exactly one of the lists"""
-        set1, set2 = set(list1), set(list2)
-        return list((set1 - set2) | (set2 - set1))
+        if isinstance(list1, Complement) and isinstance(list2, Complement):
+            return symmetric_difference(list1.excluded, list2.excluded)
+        if isinstance(list1, Complement):
+            return self._complement(symmetric_difference(list1.excluded, list2))
+        if isinstance(list2, Complement):
+            return self._complement(symmetric_difference(list1, list2.excluded))
+        return symmetric_difference(list1, list2)
     
     def _and_not_operation(self, list1, list2):
         """AND NOT operation: documents in list1 but not in list2"""
-        return list(set(list1) - set(list2))
+        return self._and_operation(list1, self._not_operation(list2))
     
     def _or_not_operation(self, list1, list2):
         """OR NOT operation: documents in list1 or not in list2"""
-        return list(set(list1) | (self.all_doc_ids - set(list2)))
+        return self._or_operation(list1, self._not_operation(list2))
+    
+    def _complement(self, excluded):
+        """Lazy complement against every indexed document"""
+        return Complement(excluded, len(self.doc_ids))
     
     def boolean_query(self, query):
         """
-        Process Boolean query with up to two terms and one operator
-        Supported operators: AND, OR, NOT, XOR, AND NOT, OR NOT
+        Process a Boolean query of any length
+        Supported operators: AND, OR, NOT, XOR, AND NOT, OR NOT, parentheses
+        Returns matching doc ids in the order they were added.
         """
-        import re
+        if self.concurrent:
+            return self.snapshot().boolean_query(query)
+        if self.trace_hooks and self._trace is None:
+            return self._traced('boolean_query', query)
+        return [self.doc_ids[ordinal] for ordinal in self._evaluate_query(query)]
+    
+    def iter_query(self, query):
+        """Lazily yield matching doc ids; NOT results are never materialized"""
+        if self.concurrent:
+            yield from self.snapshot().iter_query(query)
+            return
+        for ordinal in self._evaluate_query(query):
+            yield self.doc_ids[ordinal]
+    
+    def query_page(self, query, offset=0, limit=10):
+        """Return one page of matching doc ids"""
+        if self.concurrent:
+            return self.snapshot().query_page(query, offset, limit)
+        if self.trace_hooks and self._trace is None:
+            return self._traced('query_page', query, offset, limit)
+        return self._page(self._evaluate_query(query), offset, limit)
+    
+    def _page(self, result, offset, limit):
+        """Doc ids of result[offset:offset + limit] (to the end if limit is None)"""
+        if isinstance(result, Complement):
+            ordinals = result.page(offset, len(result) - offset if limit is None else limit)
+        elif isinstance(result, RoaringBitmap):
+            ordinals = islice(result, offset, None if limit is None else offset + limit)
+        else:
+            ordinals = result[offset:None if limit is None else offset + limit]
+        return [self.doc_ids[ordinal] for ordinal in ordinals]
+    
+    def counted_page(self, query, offset=0, limit=10):
+        """Return (number of matching docs, one page of their doc ids)"""
+        if self.concurrent:
+            return self.snapshot().counted_page(query, offset, limit)
+        if self.trace_hooks and self._trace is None:
+            return self._traced('counted_page', query, offset, limit)
+        result = self._evaluate_query(query)
+        return len(result), self._page(result, offset, limit)
+    
+    def batch_query(self, queries, pages=None):
+        """
+        Evaluate several queries against one version of the index, fetching
+        each distinct term's (or wildcard's) posting list once for the whole
+        batch. Returns a doc id list per query, or the QuerySyntaxError for
+        a malformed one. With pages, an (offset, limit) per query, each
+        result is (total matches, doc ids of that page) instead, and only
+        the page is looked up.
+        """
+        if self.concurrent:
+            return self.snapshot().batch_query(queries, pages)
+        # Shallow copy: shares every index, adds a private term memo
+        view = copy.copy(self)
+        view._term_memo = {}
+        results = []
+        for i, query in enumerate(queries):
+            try:
+                if pages is None:
+                    results.append(view.boolean_query(query))
+                else:
+                    results.append(view.counted_page(query, *pages[i]))
+            except QuerySyntaxError as error:
+                results.append(error)
+        return results
+    
+    def ranked_query(self, query, k=10):
+        """
+        The k best matching documents by BM25, as (doc_id, score) pairs.
+        A plain term or OR of terms is ranked as a disjunction; any other
+        query restricts the ranking to its Boolean matches and scores the
+        terms that aren't negated.
+        """
+        if self.concurrent:
+            return self.snapshot().ranked_query(query, k)
+        if self.trace_hooks and self._trace is None:
+            return self._traced('ranked_query', query, k)
+        if not self.ranked:
+            raise ValueError("Ranked retrieval needs boolean_model(ranked=True)")
+        
+        node = self._parse(query.strip())
+        if node[0] == 'term' or (node[0] == 'or' and all(child[0] == 'term' for child in node[1])):
+            # Disjunction: every document with a query term is a candidate
+            accept = None
+            if self.tombstones:
+                removed = member_test(self.tombstones.postings())
+                accept = lambda doc: not removed(doc)
+        else:
+            accept = member_test(self._evaluate_query(query))
+        
+        num_docs = max(1, self._live_docs())
+        avg_length = self.total_length / num_docs or 1
+        cursors = []
+        for term in sorted(self._scored_terms(node)):
+            postings = self._term_postings(term)
+            if not len(postings):
+                continue
+            if isinstance(postings, RoaringBitmap):
+                postings = array('I', postings)
+            doc_freq = len(postings)
+            if self.tombstones:
+                # Removed documents still in the list don't count
+                contains = member_test(postings)
+                doc_freq -= sum(1 for doc in self.tombstones.postings() if contains(doc))
+            term_idf = idf(num_docs, doc_freq)
+            bound = term_idf * term_weight(self.max_tfs.get(term, 1), self.min_doc_length, avg_length)
+            cursors.append(TermCursor(term, postings, term_idf, bound))
+        
+        # Documents are scored in increasing order, so each term's reader decodes forward
+        tf_readers = {cursor.term: self.term_freqs[cursor.term].reader() for cursor in cursors}
+        doc_lengths = self.doc_lengths
+        def score(doc, matched):
+            length = doc_lengths[doc]
+            return sum(cursor.idf * term_weight(tf_readers[cursor.term](doc), length, avg_length)
+                       for cursor in matched)
+        
+        if not cursors:
+            # Nothing to score (e.g. only negations): first k matches, unranked
+            if accept is None:
+                return []
+            return [(doc_id, 0.0) for doc_id in self.query_page(query, 0, k)]
+        return [(self.doc_ids[doc], doc_score)
+                for doc_score, doc in top_k(cursors, score, k, accept)]
+    
+    def _live_docs(self):
+        return len(self.doc_ids) - len(self.tombstones)
+    
+    @property
+    def all_doc_ids(self):
+        """Set of live doc ids (built on each access; queries never need it)"""
+        doc_ids, removed = self.doc_ids, self.tombstones
+        return {doc_ids[ordinal] for ordinal in range(self._live_docs() + len(removed))
+                if ordinal not in removed}
+    
+    def _scored_terms(self, node):
+        """Terms of a query AST that count toward the score (not negated)"""
+        kind = node[0]
+        if kind == 'term':
+            if WILDCARD_CHARS.search(node[1]):
+                return set(self._expand_wildcard(node[1]))
+            return {node[1]}
+        if kind == 'not':
+            return set()
+        if kind == 'phrase':
+            return {term for term, _ in self._phrase_terms(node[1])}
+        terms = set()
+        for child in node[1]:
+            terms |= self._scored_terms(child)
+        return terms
+    
+    def _evaluate_query(self, query):
+        """Evaluate a Boolean query to sorted document ordinals (cached)"""
         query = query.strip()
+        key = ('result', query)
+        result = self.cache.get(key)
+        if result is None:
+            node = self._parse(query)
+            result = self._live(self._evaluate(node))
+            self.cache.put(key, result, tags=self._query_tags(node))
+        return result
+    
+    def _live(self, result):
+        """Drop tombstoned (removed) documents from a result"""
+        if not self.tombstones:
+            return result
+        tombstones = self.tombstones.postings()
+        if isinstance(result, Complement):
+            return Complement(union(result.excluded, tombstones), result.universe)
+        return difference(result, tombstones)
+    
+    def _parse(self, query):
+        """Parse a query, reusing the cached AST"""
+        key = ('parse', query)
+        node = self.cache.get(key)
+        if node is None:
+            node = parse_query(query)
+            if self.analyzer.fold or self.analyzer.stem:
+                node = self._analyze_terms(node)
+            self.cache.put(key, node)
+        return node
+    
+    def _analyze_terms(self, node):
+        """Query AST with its terms folded and stemmed like the documents'"""
+        kind = node[0]
+        if kind == 'term':
+            term = node[1]
+            return ('term', self.analyzer.query_term(term, bool(WILDCARD_CHARS.search(term))))
+        if kind == 'phrase':
+            return node  # Analyzed with the document analyzer when evaluated
+        if kind == 'not':
+            return ('not', self._analyze_terms(node[1]))
+        children = tuple(self._analyze_terms(child) for child in node[1])
+        return (kind, children) + node[2:]
+    
+    def _query_tags(self, node):
+        """Cache tags for a query result: its terms, patterns and expansions"""
+        kind = node[0]
+        if kind == 'term':
+            if WILDCARD_CHARS.search(node[1]):
+                return {node[1], *self._expand_wildcard(node[1])}
+            return {node[1]}
+        if kind == 'not':
+            return self._query_tags(node[1]) | {self.UNIVERSE_TAG}
+        if kind == 'phrase':
+            return {term for term, _ in self._phrase_terms(node[1])}
+        tags = set()
+        for child in node[1]:
+            tags |= self._query_tags(child)
+        return tags
+    
+    def _evaluate(self, node):
+        """Evaluate an optimized query AST (see query.py)"""
+        kind = node[0]
+        if kind == 'term':
+            return self._get_posting_list(node[1])
+        if kind == 'phrase':
+            return self._phrase_postings(node[1])
+        if kind == 'near':
+            return self._near_postings(node[1], node[2])
+        if kind == 'not':
+            return self._not_operation(self._evaluate(node[1]))
+        if kind == 'xor':
+            left, right = node[1]
+            return self._xor_operation(self._evaluate(left), self._evaluate(right))
+        if kind == 'or':
+            result = self._evaluate(node[1][0])
+            for child in node[1][1:]:
+                result = self._or_operation(result, self._evaluate(child))
+            return result
+        return self._evaluate_and(node[1])
+    
+    def _evaluate_and(self, children):
+        """AND: intersect the shortest lists first, then subtract negations"""
+        positives = [child for child in children if child[0] != 'not']
+        negatives = [child[1] for child in children if child[0] == 'not']
+        if not positives:
+            # NOT a AND NOT b == NOT (a OR b)
+            return self._not_operation(self._evaluate(('or', tuple(negatives))))
         
-        # Handle single term (no operator)
-        if not any(re.search(r'\b' + op.strip() + r'\b', query.upper()) for op in [' AND ', ' OR ', ' NOT ', ' XOR ', ' AND NOT ', ' OR NOT ']):
-            return self._get_posting_list(query)
-        
-        # Parse query to find operator and terms using regex
-        operators = [
-            (r'\bAND NOT\b', ' AND NOT '),
-            (r'\bOR NOT\b', ' OR NOT '),
-            (r'\bAND\b', ' AND '),
-            (r'\bOR\b', ' OR '),
-            (r'\bXOR\b', ' XOR '),
-            (r'\bNOT\b', ' NOT ')
-        ]
-        
-        for pattern, op in operators:
-            match = re.search(pattern, query.upper())
-            if match:
-                # Split the query at the operator position
-                parts = re.split(pattern, query.upper(), maxsplit=1)
-                if len(parts) == 2:
-                    # Get original case terms
-                    original_parts = re.split(pattern, query, maxsplit=1)
-                    if len(original_parts) == 2:
-                        term1 = original_parts[0].strip()
-                        term2 = original_parts[1].strip()
-                    else:
-                        term1 = parts[0].strip()
-                        term2 = parts[1].strip()
-                    
-                    # Get posting lists
-                    list1 = self._get_posting_list(term1)
-                    
-                    if op == ' NOT ':
-                        # NOT operation (unary)
-                        return self._not_operation(list1)
-                    else:
-                        # Binary operations
-                        list2 = self._get_posting_list(term2)
-                        
-                        if op == ' AND ':
-                            return self._and_operation(list1, list2)
-                        elif op == ' OR ':
-                            return self._or_operation(list1, list2)
-                        elif op == ' XOR ':
-                            return self._xor_operation(list1, list2)
-                        elif op == ' AND NOT ':
-                            return self._and_not_operation(list1, list2)
-                        elif op == ' OR NOT ':
-                            return self._or_not_operation(list1, list2)
-        
-        return []  # Invalid query format
+        # Term lookups are cheap, so fetch them all and order by size;
+        # composite operands are only evaluated while the result is non-empty
+        operands = sorted((self._evaluate(child) for child in positives
+                           if child[0] == 'term'), key=len)
+        composites = [child for child in positives if child[0] != 'term']
+        if not operands:
+            operands.append(self._evaluate(composites.pop(0)))
+        result = operands[0]
+        for operand in operands[1:]:
+            if not len(result):
+                return []
+            result = self._and_operation(result, operand)
+        for child in composites:
+            if not len(result):
+                return []
+            result = self._and_operation(result, self._evaluate(child))
+        for child in negatives:
+            result = self._and_not_operation(result, self._evaluate(child))
+            if not len(result):
+                return []
+        return result
+    
+    # Phrase and proximity queries: candidates come from the posting lists,
+    # positions are only decoded for documents that contain every term
+    def _phrase_terms(self, text):
+        """(term, offset) pairs of a phrase; stop words keep their offsets"""
+        return list(self.analyzer.analyze(text))
+    
+    def _require_positions(self):
+        if not self.positional:
+            raise QuerySyntaxError("Phrase and NEAR queries need boolean_model(positional=True)")
+    
+    def _phrase_postings(self, text):
+        """Documents containing the phrase"""
+        self._require_positions()
+        terms = self._phrase_terms(text)
+        if len(terms) <= 1:
+            return self._get_posting_list(terms[0][0]) if terms else []
+        candidates = self._evaluate_and(tuple(('term', term) for term, _ in terms))
+        docs = list(candidates)
+        return [doc for doc, starts in zip(docs, self._phrase_starts(terms, docs)) if starts]
+    
+    def _phrase_starts(self, terms, docs):
+        """Start positions of a phrase in each of the sorted docs"""
+        empty = PositionalPostings()
+        streams = [self.positions.get(term, empty).positions_for(docs) for term, _ in terms]
+        offsets = [offset - terms[0][1] for _, offset in terms]
+        for position_lists in zip(*streams):
+            yield phrase_starts(position_lists, offsets)
+    
+    def _near_postings(self, operands, distance):
+        """Documents where the two operands occur within distance tokens"""
+        self._require_positions()
+        left, right = operands
+        docs = list(self._and_operation(self._evaluate(left), self._evaluate(right)))
+        (left_spans, left_length), (right_spans, right_length) = (
+            self._spans(left, docs), self._spans(right, docs))
+        return [doc for doc, starts1, starts2 in zip(docs, left_spans, right_spans)
+                if within(starts1, left_length, starts2, right_length, distance)]
+    
+    def _spans(self, node, docs):
+        """(start positions per doc, span length) of a term or phrase operand"""
+        empty = PositionalPostings()
+        if node[0] == 'phrase':
+            terms = self._phrase_terms(node[1])
+            if not terms:
+                return iter(()), 1
+            return self._phrase_starts(terms, docs), terms[-1][1] - terms[0][1] + 1
+        term = node[1]
+        if not WILDCARD_CHARS.search(term):
+            return self.positions.get(term, empty).positions_for(docs), 1
+        # Wildcard: positions of every expansion, merged per document
+        streams = [self.positions.get(expansion, empty).positions_for(docs)
+                   for expansion in self._expand_wildcard(term)]
+        return (list(heapq.merge(*lists)) for lists in zip(*streams)), 1
     
     def display_index(self):
         """Display the inverted index"""
-        self.inverted_index.display_index()
+        self.inverted_index.display_index(self.doc_ids)
     
     def display_permuterm_index(self):
         """Display the permuterm index"""
         print("\n=== PERMUTERM INDEX ===")
-        for permuterm, original in sorted(self.permuterm_index.permuterms.items()):
+        for permuterm, original in self.permuterm_index.rotations():
             print(f"{permuterm} -> {original}")
 
 
+class Snapshot(boolean_model):
+    """
+    One published version of a concurrent boolean_model. Queries read the
+    version's immutable tree without locks; only the shared vocabulary
+    indexes and cache are touched under the model's lock.
+    """
+    # Model attributes every version shares with the live model
+    SHARED = ('compact_permuterms', 'permuterm_index', 'kgram_index', 'analyzer', 'documents',
+              'ranked', 'positional', 'trace_hooks', 'cache', '_lock', '_write_lock')
+    # Ranked and positional state, captured by _publish with each version
+    # (compact() replaces it with renumbered copies)
+    VERSIONED = ('term_freqs', 'doc_lengths', 'total_length', 'min_doc_length', 'max_tfs',
+                 'positions')
+    
+    def __init__(self, model, version, inverted_index, doc_ids, doc_limit, tombstones, state):
+        for name in self.SHARED:
+            setattr(self, name, getattr(model, name))
+        for name, value in state.items():
+            setattr(self, name, value)
+        self.model = model
+        self.version = version
+        self.concurrent = False
+        self.mapped_file = None
+        self.inverted_index = inverted_index
+        self.doc_ids = doc_ids  # Shared and append-only; only doc_limit entries belong here
+        self.doc_limit = doc_limit
+        self.tombstones = tombstones
+    
+    def _ensure_writable(self):
+        raise TypeError("Snapshots are read-only")
+    
+    def _expand_wildcard(self, pattern):
+        # The model's vocabulary only grows past this version's, and the
+        # extra terms have no postings here
+        return self.model._expand_wildcard(pattern)
+    
+    def _term_postings(self, term):
+        """Sorted ordinals for an exact term, as of this version"""
+        posting_list = self.inverted_index.search(term, self._trace)
+        return truncate(posting_list.postings(), self.doc_limit) if posting_list else []
+    
+    def _complement(self, excluded):
+        return Complement(excluded, self.doc_limit)
+    
+    def _live_docs(self):
+        return self.doc_limit - len(self.tombstones)
+    
+    def _evaluate_query(self, query):
+        """Evaluate a query; the shared result cache is used only while this version is current"""
+        query = query.strip()
+        key = ('result', query)
+        with self._lock:
+            result = self.cache.get(key) if self.version == self.model.version else None
+        if result is None:
+            node = self._parse(query)
+            result = self._live(self._evaluate(node))
+            tags = self._query_tags(node)
+            with self._lock:
+                if self.version == self.model.version:
+                    self.cache.put(key, result, tags=tags)
+        return result
+
+
 # Main execution
 if __name__ == "__main__":
     # Initialize the documents